@@ -5,4 +5,6 @@ from .simple import *  # noqa
 from .query import *  # noqa
 from .invalidation import *  # noqa
 from .reaper import *  # noqa
+from .explain import *  # noqa
+from .stats import *  # noqa
 from .templatetags.cacheops import *  # noqa
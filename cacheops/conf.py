@@ -16,17 +16,33 @@ class Defaults:
     CACHEOPS = {}
     CACHEOPS_PREFIX = lambda query: ''
     CACHEOPS_INSIDEOUT = False
+    CACHEOPS_GENERATIONS = False
+    CACHEOPS_SORTED_CONJS = False
+    CACHEOPS_DIRTY_BY_TABLE = False
+    CACHEOPS_TRANSACTION_CACHE = False
+    CACHEOPS_TRANSACTION_CACHE_MAXSIZE = 1000
     CACHEOPS_CLIENT_CLASS = None
+    CACHEOPS_ASYNC_CLIENT_CLASS = None
     CACHEOPS_DEGRADE_ON_FAILURE = False
     CACHEOPS_SENTINEL = {}
     # NOTE: we don't use this fields in invalidator conditions since their values could be very long
     #       and one should not filter by their equality anyway.
     CACHEOPS_SKIP_FIELDS = "FileField", "TextField", "BinaryField", "JSONField", "ArrayField"
     CACHEOPS_LONG_DISJUNCTION = 8
+    # Longer __in lookups are invalidated by hashed partitions of values if this is set
+    CACHEOPS_LONG_DISJUNCTION_PARTITIONS = None
+    # Queries with more conjunctions are invalidated by conds common to all of them
+    CACHEOPS_MAX_CONJS = 32
+    CACHEOPS_LOCAL_GET_MAXSIZE = 10000
+    # Seconds the oldest queued async invalidation may wait before we fall back to sync ones
+    CACHEOPS_ASYNC_INVALIDATION_LAG = 10
     CACHEOPS_SERIALIZER = 'pickle'
 
     FILE_CACHE_DIR = '/tmp/cacheops_file_cache'
     FILE_CACHE_TIMEOUT = 60*60*24*30
+    # Least recently used files are evicted to fit these, bytes and number of files
+    FILE_CACHE_MAX_SIZE = None
+    FILE_CACHE_MAX_ENTRIES = None
 
 
 class Settings(object):
@@ -65,6 +81,10 @@ def prepare_profiles():
         'local_get': False,
         'db_agnostic': True,
         'lock': False,
+        'snapshot_on_load': False,
+        'local_get_timeout': None,
+        'async_invalidation': False,
+        'buckets': {},
     }
     profile_defaults.update(settings.CACHEOPS_DEFAULTS)
 
@@ -0,0 +1,162 @@
+"""
+Shows what invalidation would do and what cached querysets depend on, without changing anything.
+
+Use these to find over-broad querysets: ones with few conditions end up in large conj sets
+and are wiped by most writes to their tables.
+"""
+from django.db import DEFAULT_DB_ALIAS
+from funcy import chunks
+
+from .conf import settings
+from .getset import dnfs_to_conj_keys, dnfs_to_gen_keys, dnfs_to_schemes
+from .invalidation import get_obj_dict
+from .redis import redis_client
+from .schemes import registry, conj_key
+from .sharding import get_prefix
+
+__all__ = ('explain_invalidation', 'explain_cache')
+
+CHUNK_SIZE = 1000
+SAMPLE = 100
+
+
+def explain_invalidation(obj_or_dict, model=None, using=DEFAULT_DB_ALIAS, sample=SAMPLE):
+    """
+    Tells what saving or deleting an object would invalidate, pass either a model instance
+    or an obj dict along with its model.
+
+    Returns a dict with prefix, table, schemes known for it, a list of conjs, each with scheme,
+    conj key and number of cache keys it references, and total number and size in bytes of
+    keys, which would be deleted. Totals are estimated from sample random cache keys of each
+    conj, 'estimated' tells whether any conj is larger than that. Insideout mode doesn't track
+    cache keys, so these are None there and dependent cache keys just expire.
+    """
+    if isinstance(obj_or_dict, dict):
+        if model is None:
+            raise TypeError('Pass a model along with an obj dict')
+        obj_dict = obj_or_dict
+    else:
+        model = model or obj_or_dict.__class__
+        obj_dict = get_obj_dict(model._meta.concrete_model, obj_or_dict)
+    model = model._meta.concrete_model
+    db_table = model._meta.db_table
+    prefix = get_prefix(_cond_dnfs=[(db_table, list(obj_dict.items()))], dbs=[using])
+
+    # Schemes might have been added by other processes, so we don't rely on local registry
+    _, schemes = registry.refresh(prefix, [db_table])[db_table]
+    conj_keys = [conj_key(prefix, db_table, scheme, obj_dict) for scheme in schemes]
+    sizes, cache_keys, nbytes = _conj_keys_info(conj_keys, sample=sample)
+    conjs = [{'scheme': scheme, 'conj_key': key, 'cache_keys': size}
+             for scheme, key, size in zip(schemes, conj_keys, sizes)]
+    if cache_keys is not None:
+        conjs.sort(key=lambda conj: -conj['cache_keys'])
+
+    return {
+        'prefix': prefix,
+        'table': db_table,
+        'schemes': schemes,
+        'conjs': conjs,
+        'cache_keys': cache_keys,
+        'bytes': nbytes,
+        'estimated': cache_keys is not None and any(size > sample for size in sizes),
+    }
+
+
+def explain_cache(queryset):
+    """
+    Tells how a queryset is cached: its cache key, DNF of its conditions, schemes and
+    conj keys it registers with number of cache keys each of them currently references,
+    and generation stamps it depends on if CACHEOPS_GENERATIONS is on.
+    """
+    prefix = queryset._prefix
+    cond_dnfs = queryset._cond_dnfs
+    gen_keys = dnfs_to_gen_keys(prefix, cond_dnfs)
+    if gen_keys and not settings.CACHEOPS_INSIDEOUT:
+        # Same as in cache_thing(), unconditional conjs are replaced with generation stamps
+        cond_dnfs = {table: [conj for conj in disj if conj] for table, disj in cond_dnfs.items()}
+    conj_keys = dnfs_to_conj_keys(prefix, cond_dnfs)
+    sizes, _, _ = _conj_keys_info(conj_keys, members=False)
+
+    return {
+        'cache_key': queryset._cache_key(),
+        'prefix': prefix,
+        'dnfs': queryset._cond_dnfs,
+        'schemes': dnfs_to_schemes(cond_dnfs),
+        'conj_keys': dict(zip(conj_keys, sizes)),
+        'gen_keys': gen_keys,
+    }
+
+
+def _conj_keys_info(conj_keys, members=True, sample=SAMPLE):
+    """
+    Returns sizes of conj sets, number of unique cache keys referenced by them, some of which
+    might have already expired, and bytes used by these cache keys and conj keys.
+    The latter two are estimated from up to sample members of each conj set, so these are exact
+    for smaller sets. Only sizes are returned if members is False, all are None in insideout
+    mode, where conj keys are just stamps.
+    """
+    if settings.CACHEOPS_INSIDEOUT:
+        return [None] * len(conj_keys), None, None
+
+    now = redis_client.time()[0]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for key in conj_keys:
+            if settings.CACHEOPS_SORTED_CONJS:
+                pipe.zcount(key, now, '+inf')
+            else:
+                pipe.scard(key)
+        sizes = pipe.execute()
+    if not members:
+        return sizes, None, None
+
+    with redis_client.pipeline(transaction=False) as pipe:
+        for key in conj_keys:
+            if settings.CACHEOPS_SORTED_CONJS:
+                pipe.zrangebyscore(key, now, '+inf', start=0, num=sample)
+            else:
+                pipe.srandmember(key, sample)
+        samples = pipe.execute()
+
+    # A cache key referenced by several conjs is seen from each of them,
+    # so it's weighted down not to be counted several times
+    weights, usage = _sample_info(conj_keys, set().union(*samples), now)
+    cache_keys = nbytes = 0
+    for size, members in zip(sizes, samples):
+        if members:
+            scale = size / len(members)
+            cache_keys += scale * sum(weights[m] for m in members)
+            nbytes += scale * sum(weights[m] * usage[m] for m in members)
+    return sizes, round(cache_keys), round(nbytes) + _memory_usage(conj_keys)
+
+
+def _sample_info(conj_keys, members, now):
+    """Returns 1 / number of conj sets referencing each member and its memory usage"""
+    weights, usage = {}, {}
+    for chunk in chunks(CHUNK_SIZE, members):
+        with redis_client.pipeline(transaction=False) as pipe:
+            for member in chunk:
+                for key in conj_keys:
+                    if settings.CACHEOPS_SORTED_CONJS:
+                        pipe.zscore(key, member)
+                    else:
+                        pipe.sismember(key, member)
+                pipe.memory_usage(member)
+            res = iter(pipe.execute())
+        for member in chunk:
+            refs = [next(res) for _ in conj_keys]
+            if settings.CACHEOPS_SORTED_CONJS:
+                refs = [score is not None and score >= now for score in refs]
+            weights[member] = 1 / max(sum(map(bool, refs)), 1)
+            usage[member] = next(res) or 0
+    return weights, usage
+
+
+def _memory_usage(keys):
+    """Sums memory used by keys, missing ones are skipped"""
+    total = 0
+    for chunk in chunks(CHUNK_SIZE, keys):
+        with redis_client.pipeline(transaction=False) as pipe:
+            for key in chunk:
+                pipe.memory_usage(key)
+            total += sum(size or 0 for size in pipe.execute())
+    return total
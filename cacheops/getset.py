@@ -1,13 +1,17 @@
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 import hashlib
 import json
 import random
 
 from .conf import settings
 from .redis import redis_client, handle_connection_failure, load_script
+from .redis import async_redis_client, handle_async_connection_failure, load_async_script
+from .redis import alua_null
+from .schemes import registry, scheme_versions, ascheme_versions, conj_key
 from .transaction import transaction_states
 
 
+LOCK = b'LOCK'
 LOCK_TIMEOUT = 60
 
 
@@ -23,110 +27,249 @@ def cache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=(), precall_key
     If expected_checksum is set and does not match the actual one then cache won't be written.
     """
     # Could have changed after last check, sometimes superficially
-    if transaction_states.is_dirty(dbs):
+    if transaction_states.is_dirty(dbs, cond_dnfs):
         return
 
+    cond_dnfs, gen_keys = _strip_unconditional(prefix, cond_dnfs)
+    # Scripts skip adding schemes, which we know are already there
+    versions = scheme_versions(prefix, dnfs_to_schemes(cond_dnfs))
+    script, keys, args = _cache_thing_call(prefix, cache_key, data, cond_dnfs, timeout, gen_keys,
+                                           versions, precall_key, expected_checksum)
+    result = load_script(script)(keys=keys, args=args)
+
+    # New schemes might have been added, we will refetch them on next use
+    registry.forget(prefix, [table for table, version in versions.items() if version is None])
+    return result
+
+
+@handle_async_connection_failure
+async def acache_thing(prefix, cache_key, data, cond_dnfs, timeout, dbs=(), precall_key='',
+                       expected_checksum=''):
+    """
+    Same as cache_thing(), but talks to redis with an asyncio client.
+    """
+    if transaction_states.is_dirty(dbs, cond_dnfs):
+        return
+
+    cond_dnfs, gen_keys = _strip_unconditional(prefix, cond_dnfs)
+    versions = await ascheme_versions(prefix, dnfs_to_schemes(cond_dnfs))
+    if not settings.CACHEOPS_INSIDEOUT:
+        await alua_null()  # Used to format None in conj keys, fetch it without blocking
+    script, keys, args = _cache_thing_call(prefix, cache_key, data, cond_dnfs, timeout, gen_keys,
+                                           versions, precall_key, expected_checksum)
+    script = await load_async_script(script)
+    result = await script(keys=keys, args=args)
+
+    registry.forget(prefix, [table for table, version in versions.items() if version is None])
+    return result
+
+
+def _strip_unconditional(prefix, cond_dnfs):
+    gen_keys = dnfs_to_gen_keys(prefix, cond_dnfs)
+    if gen_keys and not settings.CACHEOPS_INSIDEOUT:
+        # Unconditional conjs are replaced with table "any" generation stamps
+        cond_dnfs = {table: [conj for conj in disj if conj] for table, disj in cond_dnfs.items()}
+    return cond_dnfs, gen_keys
+
+
+def _cache_thing_call(prefix, cache_key, data, cond_dnfs, timeout, gen_keys, versions,
+                      precall_key, expected_checksum):
+    """Returns script name, keys and args to cache data with"""
+    schemes = dnfs_to_schemes(cond_dnfs)
+    conj_index = {table: dnfs_to_conj_keys(prefix, {table: disj})
+                  for table, disj in cond_dnfs.items() if disj}
+
     if settings.CACHEOPS_INSIDEOUT:
-        schemes = dnfs_to_schemes(cond_dnfs)
-        conj_keys = dnfs_to_conj_keys(prefix, cond_dnfs)
-        return load_script('cache_thing_insideout')(
-            keys=[prefix, cache_key],
-            args=[
-                settings.CACHEOPS_SERIALIZER.dumps(data),
-                json.dumps(schemes),
-                json.dumps(conj_keys),
-                timeout,
-                # Need to pass it from here since random inside is not seeded in Redis pre 7.0
-                random.random(),
-                expected_checksum,
-            ]
-        )
+        return 'cache_thing_insideout', [prefix, cache_key], [
+            settings.CACHEOPS_SERIALIZER.dumps(data),
+            json.dumps(schemes),
+            json.dumps(dnfs_to_conj_keys(prefix, cond_dnfs)),
+            timeout,
+            # Need to pass it from here since random inside is not seeded in Redis pre 7.0
+            random.random(),
+            expected_checksum,
+            json.dumps(conj_index),
+            json.dumps(gen_keys),
+            json.dumps(versions),
+        ]
     else:
         if prefix and precall_key == "":
             precall_key = prefix
-        load_script('cache_thing')(
-            keys=[prefix, cache_key, precall_key],
-            args=[
-                settings.CACHEOPS_SERIALIZER.dumps(data),
-                json.dumps(cond_dnfs, default=str),
-                timeout
-            ]
-        )
+        return 'cache_thing', [prefix, cache_key, precall_key], [
+            settings.CACHEOPS_SERIALIZER.dumps(data),
+            json.dumps(schemes),
+            json.dumps(versions),
+            json.dumps(conj_index),
+            timeout,
+            json.dumps(gen_keys),
+            random.random(),
+            int(settings.CACHEOPS_SORTED_CONJS),
+        ]
 
 
 @contextmanager
 def getting(key, cond_dnfs, prefix, lock=False):
+    with reading(key, lambda: _read(key, cond_dnfs, prefix), lock=lock) as data:
+        yield data
+
+
+@asynccontextmanager
+async def agetting(key, cond_dnfs, prefix, lock=False):
+    async with areading(key, lambda: _aread(key, cond_dnfs, prefix), lock=lock) as data:
+        yield data
+
+
+@contextmanager
+def reading(key, read, lock=False, conn=None):
+    """
+    Yields data returned by read(), None on miss. With lock=True on a miss key is locked
+    until the block exits, so that others wait for it to be filled in instead of computing it.
+    Locks are kept in conn, which should be the one read() uses, redis_client by default.
+    """
     if not lock:
-        yield _read(key, cond_dnfs, prefix)
+        yield read()
     else:
+        conn = conn or redis_client
         locked = False
         try:
-            data = _get_or_lock(key, cond_dnfs, prefix)
+            data = _get_or_lock(key, read, conn)
             locked = data is None
             yield data
         finally:
             if locked:
-                _release_lock(key)
+                _release_lock(key, conn)
+
+
+@asynccontextmanager
+async def areading(key, read, lock=False, conn=None):
+    """
+    Same as reading(), but read() is a coroutine function and waiting doesn't block a loop.
+    """
+    if not lock:
+        yield await read()
+    else:
+        conn = conn or async_redis_client()
+        locked = False
+        try:
+            data = await _aget_or_lock(key, read, conn)
+            locked = data is None
+            yield data
+        finally:
+            if locked:
+                await _arelease_lock(key, conn)
 
 
 @handle_connection_failure
 def _read(key, cond_dnfs, prefix):
-    if not settings.CACHEOPS_INSIDEOUT:
+    if not settings.CACHEOPS_INSIDEOUT and not settings.CACHEOPS_GENERATIONS:
         return redis_client.get(key)
 
-    conj_keys = dnfs_to_conj_keys(prefix, cond_dnfs)
-    coded, *stamps = redis_client.mget(key, *conj_keys)
-    if coded is None or coded == b'LOCK':
+    coded, *stamps = redis_client.mget(key, *_stamp_keys(cond_dnfs, prefix))
+    data = _check_stamps(coded, stamps)
+    if data is None and coded is not None:
+        redis_client.unlink(key)
+    return data
+
+
+@handle_async_connection_failure
+async def _aread(key, cond_dnfs, prefix):
+    client = async_redis_client()
+    if not settings.CACHEOPS_INSIDEOUT and not settings.CACHEOPS_GENERATIONS:
+        return await client.get(key)
+
+    coded, *stamps = await client.mget(key, *_stamp_keys(cond_dnfs, prefix))
+    data = _check_stamps(coded, stamps)
+    if data is None and coded is not None:
+        await client.unlink(key)
+    return data
+
+
+def _stamp_keys(cond_dnfs, prefix):
+    stamp_keys = dnfs_to_gen_keys(prefix, cond_dnfs)
+    if settings.CACHEOPS_INSIDEOUT:
+        stamp_keys = dnfs_to_conj_keys(prefix, cond_dnfs) + stamp_keys
+    return stamp_keys
+
+
+def _check_stamps(coded, stamps):
+    """Returns data if stamps it was cached with are intact, None otherwise"""
+    if coded is None or coded == LOCK:
         return coded
 
     if None in stamps:
-        redis_client.unlink(key)
         return None
 
     stamp_checksum, data = coded.split(b':', 1)
     if stamp_checksum.decode() != join_stamps(stamps):
-        redis_client.unlink(key)
         return None
 
     return data
 
 
+LOCK_SCRIPT = """
+    local locked = redis.call('set', KEYS[1], 'LOCK', 'nx', 'ex', ARGV[1])
+    if locked then
+        redis.call('del', KEYS[2])
+    end
+    return locked
+"""
+
+UNLOCK_SCRIPT = """
+    if redis.call('get', KEYS[1]) == 'LOCK' then
+        redis.call('del', KEYS[1])
+    end
+    redis.call('lpush', KEYS[2], 1)
+    redis.call('expire', KEYS[2], 1)
+"""
+
+
 @handle_connection_failure
-def _get_or_lock(key, cond_dnfs, prefix):
-    _lock = redis_client.register_script("""
-        local locked = redis.call('set', KEYS[1], 'LOCK', 'nx', 'ex', ARGV[1])
-        if locked then
-            redis.call('del', KEYS[2])
-        end
-        return locked
-    """)
+def _get_or_lock(key, read, conn):
+    _lock = conn.register_script(LOCK_SCRIPT)
     signal_key = key + ':signal'
 
     while True:
-        data = _read(key, cond_dnfs, prefix)
+        data = read()
         if data is None:
             if _lock(keys=[key, signal_key], args=[LOCK_TIMEOUT]):
                 return None
-        elif data != b'LOCK':
+        elif data != LOCK:
             return data
 
         # No data and not locked, wait
-        redis_client.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
+        conn.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
+
+
+@handle_async_connection_failure
+async def _aget_or_lock(key, read, conn):
+    _lock = conn.register_script(LOCK_SCRIPT)
+    signal_key = key + ':signal'
+
+    while True:
+        data = await read()
+        if data is None:
+            if await _lock(keys=[key, signal_key], args=[LOCK_TIMEOUT]):
+                return None
+        elif data != LOCK:
+            return data
+
+        await conn.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
 
 
 @handle_connection_failure
-def _release_lock(key):
-    _unlock = redis_client.register_script("""
-        if redis.call('get', KEYS[1]) == 'LOCK' then
-            redis.call('del', KEYS[1])
-        end
-        redis.call('lpush', KEYS[2], 1)
-        redis.call('expire', KEYS[2], 1)
-    """)
+def _release_lock(key, conn):
+    _unlock = conn.register_script(UNLOCK_SCRIPT)
     signal_key = key + ':signal'
     _unlock(keys=[key, signal_key])
 
 
+@handle_async_connection_failure
+async def _arelease_lock(key, conn):
+    _unlock = conn.register_script(UNLOCK_SCRIPT)
+    signal_key = key + ':signal'
+    await _unlock(keys=[key, signal_key])
+
+
 # Key manipulation helpers
 
 def join_stamps(stamps):
@@ -134,13 +277,23 @@ def join_stamps(stamps):
 
 
 def dnfs_to_conj_keys(prefix, cond_dnfs):
-    def _conj_cache_key(table, conj):
-        conj_str = '&'.join(f'{field}={val}' for field, val in sorted(conj.items()))
-        return f'{prefix}conj:{table}:{conj_str}'
-
-    return [_conj_cache_key(table, conj) for table, disj in cond_dnfs.items()
-                                         for conj in disj]
+    return [conj_key(prefix, table, sorted(conj), conj) for table, disj in cond_dnfs.items()
+                                                        for conj in disj]
 
 def dnfs_to_schemes(cond_dnfs):
     return {table: list({",".join(sorted(conj)) for conj in disj})
             for table, disj in cond_dnfs.items() if disj}
+
+def dnfs_to_gen_keys(prefix, cond_dnfs):
+    """
+    Generation stamp keys, dropping any of these invalidates all dependent cache keys
+    """
+    if not settings.CACHEOPS_GENERATIONS:
+        return []
+
+    tables = sorted(cond_dnfs)
+    gen_keys = [prefix + 'gen'] + [f'{prefix}gen:{table}' for table in tables]
+    # An unconditional conj set is hit by any write to the table, a single stamp is cheaper
+    if not settings.CACHEOPS_INSIDEOUT:
+        gen_keys += [f'{prefix}gen:{table}:any' for table in tables if {} in cond_dnfs[table]]
+    return gen_keys
@@ -1,18 +1,26 @@
 import json
 import threading
+from datetime import date, datetime, timedelta, timezone
+from collections import defaultdict
 from funcy import memoize, post_processing, ContextDecorator, decorator, walk_values
-from django.db import DEFAULT_DB_ALIAS
+from funcy import chain, chunks, lsplit
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.db.models.expressions import F, Expression
 
-from .conf import settings
+from .conf import settings, model_profile
+from . import local, schemes
 from .sharding import get_prefix
 from .redis import redis_client, handle_connection_failure, load_script
 from .signals import cache_invalidated
-from .transaction import queue_when_in_transaction
+from .transaction import transaction_states
 
 
 __all__ = ('invalidate_obj', 'invalidate_model', 'invalidate_all', 'no_invalidation')
 
+INVALIDATE_CHUNK_SIZE = 1000
+INVALIDATION_STREAM = 'invalidations'
+
 
 @decorator
 def skip_on_no_invalidation(call):
@@ -21,24 +29,111 @@ def skip_on_no_invalidation(call):
     return call()
 
 
-@skip_on_no_invalidation
-@queue_when_in_transaction
-@handle_connection_failure
 def invalidate_dict(model, obj_dict, using=DEFAULT_DB_ALIAS):
-    if no_invalidation.active or not settings.CACHEOPS_ENABLED:
-        return
+    invalidate_dicts([(model, obj_dict)], using=using)
 
-    model = model._meta.concrete_model
-    prefix = get_prefix(_cond_dnfs=[(model._meta.db_table, list(obj_dict.items()))], dbs=[using])
 
-    if settings.CACHEOPS_INSIDEOUT:
-        script = 'invalidate_insideout'
-        serialized_dict = json.dumps(walk_values(str, obj_dict))
+@skip_on_no_invalidation
+def invalidate_dicts(model_dicts, using=DEFAULT_DB_ALIAS):
+    """
+    Invalidates several objects, passed as (model, obj_dict) pairs, at once.
+    Makes a single script call per prefix, objects mostly share conj keys, so these are deduped.
+    """
+    if transaction_states[using]:
+        transaction_states[using].drop_results(
+            {model._meta.concrete_model._meta.db_table for model, _ in model_dicts})
+        for model, obj_dict in model_dicts:
+            model = model._meta.concrete_model
+            key = ('dict', model, json.dumps(obj_dict, sort_keys=True, default=str))
+            transaction_states[using].push_batched(
+                _invalidate_queued, key, (using, model, obj_dict, False))
     else:
-        script = 'invalidate'
-        serialized_dict = json.dumps(obj_dict, default=str)
-    load_script(script)(keys=[prefix], args=[model._meta.db_table, serialized_dict])
-    cache_invalidated.send(sender=model, obj_dict=obj_dict)
+        _invalidate_dicts(model_dicts, using)
+
+
+@handle_connection_failure
+def _invalidate_dicts(model_dicts, using):
+    entries = defaultdict(list)
+    for model, obj_dict in model_dicts:
+        model = model._meta.concrete_model
+        db_table = model._meta.db_table
+        prefix = get_prefix(_cond_dnfs=[(db_table, list(obj_dict.items()))], dbs=[using])
+        entries[prefix].append((model, obj_dict))
+
+    for prefix, group in entries.items():
+        async_group, group = lsplit(lambda entry: _is_async(entry[0]), group)
+        if async_group and not _queue_entries(prefix, async_group):
+            # Workers fall behind, catch up for them so that queued invalidations
+            # are not left unapplied for longer than allowed
+            from .invalidator import drain_queue
+            drain_queue(prefix)
+            group += async_group
+        if group:
+            _invalidate_group(prefix, group)
+
+
+def _is_async(model):
+    profile = model_profile(model)
+    return bool(profile and profile['async_invalidation'])
+
+
+def _invalidate_group(prefix, entries):
+    _invalidate_entries(prefix, entries)
+    # Other processes are notified by scripts
+    for db_table in {model._meta.db_table for model, _ in entries}:
+        local.cache.invalidate(db_table)
+    for model, obj_dict in entries:
+        cache_invalidated.send(sender=model, obj_dict=obj_dict)
+
+
+def _queue_entries(prefix, entries):
+    """
+    Queues invalidations to be applied by cacheops_invalidator workers.
+    Returns False if workers lag behind too much, then caller should invalidate by itself.
+    """
+    data = json.dumps({
+        'prefix': prefix,
+        'dicts': [(model._meta.label, obj_dict) for model, obj_dict in entries],
+    }, default=str)
+    return bool(load_script('queue_invalidation')(
+        keys=[prefix + INVALIDATION_STREAM],
+        args=[settings.CACHEOPS_ASYNC_INVALIDATION_LAG, data]
+    ))
+
+
+def _invalidate_entries(prefix, entries):
+    # Conj keys are calculated from locally known schemes, script checks that those are
+    # up to date and if not returns outdated tables for us to refresh them and try again.
+    tables = {model._meta.db_table for model, _ in entries}
+    outdated = tables
+    while outdated:
+        known = schemes.registry.get(prefix, tables)
+        conj_keys = {table: {} for table in tables}
+        for model, obj_dict in entries:
+            db_table = model._meta.db_table
+            for scheme in known[db_table][1]:
+                conj_keys[db_table][schemes.conj_key(prefix, db_table, scheme, obj_dict)] = True
+        versions = {table: version for table, (version, _) in known.items()}
+        conj_keys = walk_values(list, conj_keys)
+
+        if settings.CACHEOPS_INSIDEOUT:
+            outdated = load_script('invalidate_insideout')(
+                keys=[prefix],
+                args=[json.dumps(versions), json.dumps(conj_keys), local.channel()]
+            )
+        else:
+            outdated = load_script('invalidate')(
+                keys=[prefix],
+                args=[
+                    json.dumps(versions),
+                    json.dumps(conj_keys),
+                    int(settings.CACHEOPS_GENERATIONS),
+                    int(settings.CACHEOPS_SORTED_CONJS),
+                    local.channel(),
+                ]
+            )
+        if outdated:
+            schemes.registry.refresh(prefix, [table.decode() for table in outdated])
 
 
 @skip_on_no_invalidation
@@ -51,36 +146,107 @@ def invalidate_obj(obj, using=DEFAULT_DB_ALIAS):
 
 
 @skip_on_no_invalidation
-@queue_when_in_transaction
-@handle_connection_failure
-def invalidate_model(model, using=DEFAULT_DB_ALIAS):
+def invalidate_model(model, using=DEFAULT_DB_ALIAS, scan=False):
     """
     Invalidates all caches for given model.
-    NOTE: This is a heavy artillery which uses redis KEYS request,
-          which could be relatively slow on large datasets.
+    Conj keys are looked up in a per table index and deleted in chunks.
+
+    Pass scan=True to also find conj keys written before they were indexed.
+    NOTE: this SCANs the whole keyspace, which could be relatively slow on large datasets.
     """
     model = model._meta.concrete_model
+    if transaction_states[using]:
+        transaction_states[using].drop_results({model._meta.db_table})
+        transaction_states[using].push_batched(
+            _invalidate_queued, ('model', model, scan), (using, model, None, scan))
+    else:
+        _invalidate_model(model, using, scan)
+
+
+@handle_connection_failure
+def _invalidate_model(model, using, scan):
+    db_table = model._meta.db_table
     # NOTE: if we use sharding dependent on DNF then this will fail,
     #       which is ok, since it's hard/impossible to predict all the shards
-    prefix = get_prefix(tables=[model._meta.db_table], dbs=[using])
-    conjs_keys = redis_client.keys('%sconj:%s:*' % (prefix, model._meta.db_table))
-    if conjs_keys:
-        if settings.CACHEOPS_INSIDEOUT:
-            redis_client.unlink(*conjs_keys)
-        else:
-            cache_keys = redis_client.sunion(conjs_keys)
-            keys = list(cache_keys) + conjs_keys
-            redis_client.unlink(*keys)
+    prefix = get_prefix(tables=[db_table], dbs=[using])
+    if settings.CACHEOPS_GENERATIONS:
+        # All cache keys for the model will fail to validate and expire on their own
+        redis_client.unlink('%sgen:%s' % (prefix, db_table))
+        _invalidate_local(db_table)
+        cache_invalidated.send(sender=model, obj_dict=None)
+        return
+
+    index_key = '%sconjs:%s' % (prefix, db_table)
+
+    conjs_keys = redis_client.sscan_iter(index_key, count=INVALIDATE_CHUNK_SIZE)
+    if scan:
+        match = '%sconj:%s:*' % (prefix, db_table)
+        conjs_keys = chain(conjs_keys,
+                           redis_client.scan_iter(match, count=INVALIDATE_CHUNK_SIZE))
+    for chunk in chunks(INVALIDATE_CHUNK_SIZE, conjs_keys):
+        load_script('invalidate_conjs')(
+            keys=[index_key],
+            args=[int(settings.CACHEOPS_INSIDEOUT), int(settings.CACHEOPS_SORTED_CONJS)] + chunk
+        )
+    _invalidate_local(db_table)
     cache_invalidated.send(sender=model, obj_dict=None)
 
 
+def _invalidate_queued(items):
+    """
+    Runs invalidations queued in a transaction on its commit.
+    Objects of models invalidated as a whole are skipped, the rest are invalidated at once.
+    """
+    models = defaultdict(bool)
+    for using, model, obj_dict, scan in items:
+        if obj_dict is None:
+            models[using, model] |= scan
+
+    model_dicts = defaultdict(list)
+    for using, model, obj_dict, _ in items:
+        if obj_dict is not None and (using, model) not in models:
+            model_dicts[using].append((model, obj_dict))
+
+    for using, group in model_dicts.items():
+        _invalidate_dicts(group, using)
+    for (using, model), scan in models.items():
+        _invalidate_model(model, using, scan)
+
+
 @skip_on_no_invalidation
 @handle_connection_failure
 def invalidate_all():
-    redis_client.flushdb()
+    prefixes = _gen_prefixes() if settings.CACHEOPS_GENERATIONS else None
+    if prefixes:
+        # Only drop global stamps, this won't affect anything else stored in the same redis db
+        redis_client.unlink(*(prefix + 'gen' for prefix in prefixes))
+    else:
+        redis_client.flushdb()
+    _invalidate_local()
     cache_invalidated.send(sender=None, obj_dict=None)
 
 
+def _gen_prefixes():
+    """
+    Returns all prefixes global stamps could be stored under or None if we can't tell.
+
+    NOTE: prefixes depending on anything besides dbs and tables, e.g. query conditions,
+          make prefix function fail here, then we flush the whole redis db instead.
+    """
+    tables = {model._meta.db_table for model in apps.get_models(include_auto_created=True)}
+    try:
+        return {get_prefix(dbs=[db], tables=[table]) for db in connections for table in tables}
+    except Exception:
+        return None
+
+
+def _invalidate_local(db_table=None):
+    """Clears a table or everything in local caches of this and other processes"""
+    local.cache.invalidate(db_table)
+    if local.is_used():
+        redis_client.publish(local.cache.channel, db_table or '')
+
+
 class InvalidationState(threading.local):
     def __init__(self):
         self.depth = 0
@@ -122,4 +288,36 @@ def get_obj_dict(model, obj):
         elif isinstance(value, (F, Expression)):
             continue
         else:
-            yield field.attname, field.get_prep_value(value)
+            value = field.get_prep_value(value)
+            yield field.attname, value
+            if field in bucket_sizes(model):
+                yield bucket_attname(field), bucket(value, bucket_sizes(model)[field])
+
+
+### Bucketed invalidation
+
+@memoize
+def bucket_sizes(model):
+    """
+    Returns a dict field -> bucket size for fields configured in "buckets" profile option.
+    Range queries on these are invalidated by buckets of values instead of as a whole.
+    """
+    sizes = {}
+    for field in serializable_fields(model):
+        profile = model_profile(field.model)
+        if profile and profile['buckets'].get(field.name):
+            sizes[field] = profile['buckets'][field.name]
+    return sizes
+
+def bucket_attname(field):
+    return field.attname + '__bucket'
+
+def bucket(value, size):
+    """Maps a value to a number of bucket, size is a number or a timedelta for dates"""
+    if isinstance(size, timedelta):
+        size = size.total_seconds()
+        if isinstance(value, datetime):
+            value = (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+        elif isinstance(value, date):
+            value = value.toordinal() * 86400
+    return int(float(value) // size)
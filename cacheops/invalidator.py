@@ -0,0 +1,155 @@
+"""
+Applies invalidations queued for models with async_invalidation profile option.
+
+These are appended to a Redis stream by writing processes and consumed here by a group of
+workers. Applied entries are deleted from the stream, so its first entry is always the oldest
+one not applied yet, writers compare its age with CACHEOPS_ASYNC_INVALIDATION_LAG and
+invalidate synchronously once it's exceeded, applying overdue queued entries too. Entries,
+which can't be applied, are moved to a dead letter stream for inspection, not to block workers.
+"""
+import json
+import logging
+from collections import defaultdict
+
+import redis
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS
+
+from .conf import settings
+from .invalidation import INVALIDATION_STREAM, _invalidate_group
+from .redis import redis_client
+from .sharding import get_prefix
+
+__all__ = ('run_invalidator', 'invalidator_stats')
+
+logger = logging.getLogger(__name__)
+
+GROUP = 'cacheops'
+FAILED_SUFFIX = ':failed'
+FAILED_MAXLEN = 10000
+
+
+def run_invalidator(consumer, count=100, block=1000, claim_idle=60, once=False,
+                    using=DEFAULT_DB_ALIAS):
+    """
+    Reads queued invalidations as a consumer of a group and applies them.
+
+    Entries read by consumers, which then died, are claimed after claim_idle seconds.
+    Pass once=True to stop as soon as there is nothing to process.
+    """
+    stream = get_prefix(dbs=[using]) + INVALIDATION_STREAM
+    while True:
+        try:
+            _, entries, *_ = redis_client.xautoclaim(
+                stream, GROUP, consumer, claim_idle * 1000, count=count)
+            if not entries:
+                res = redis_client.xreadgroup(
+                    GROUP, consumer, {stream: '>'}, count=count, block=block)
+                entries = res[0][1] if res else []
+        except redis.ResponseError as e:
+            # Stream and group are created lazily and are lost on flush
+            if 'NOGROUP' not in str(e):
+                raise
+            _create_group(stream)
+            continue
+
+        if entries:
+            _apply(stream, entries)
+        elif once:
+            return
+
+
+def _create_group(stream):
+    try:
+        # Read from the start, entries might be added before any worker started
+        redis_client.xgroup_create(stream, GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def _apply(stream, entries):
+    groups = defaultdict(list)
+    failed = []
+    for entry_id, fields in entries:
+        # Deleted entries are claimed with no fields
+        if not fields:
+            continue
+        try:
+            data = json.loads(fields[b'data'])
+            model_dicts = [(apps.get_model(label), obj_dict) for label, obj_dict in data['dicts']]
+        except Exception:
+            # E.g. a model was removed or renamed since this was queued
+            logger.exception('Failed to read queued invalidation %s', entry_id)
+            failed.append(fields)
+            continue
+        groups[data['prefix']].append((fields, model_dicts))
+
+    for prefix, group in groups.items():
+        try:
+            _invalidate_group(prefix, [pair for _, model_dicts in group for pair in model_dicts])
+        except (redis.ConnectionError, redis.TimeoutError):
+            # Entries are left pending to be claimed later
+            raise
+        except Exception:
+            # Find out which entries fail not to lose others
+            for fields, model_dicts in group:
+                try:
+                    _invalidate_group(prefix, model_dicts)
+                except (redis.ConnectionError, redis.TimeoutError):
+                    raise
+                except Exception:
+                    logger.exception('Failed to apply queued invalidation')
+                    failed.append(fields)
+
+    ids = [entry_id for entry_id, _ in entries if entry_id]
+    with redis_client.pipeline(transaction=True) as pipe:
+        for fields in failed:
+            pipe.xadd(stream + FAILED_SUFFIX, fields, maxlen=FAILED_MAXLEN, approximate=True)
+        pipe.xack(stream, GROUP, *ids)
+        pipe.xdel(stream, *ids)
+        pipe.execute()
+    logger.debug('Applied %d queued invalidations, %d failed', len(ids) - len(failed),
+                 len(failed))
+
+
+def drain_queue(prefix, count=100):
+    """
+    Applies queued invalidations older than CACHEOPS_ASYNC_INVALIDATION_LAG.
+    Called by writers once workers fall behind or are not running at all,
+    otherwise already queued invalidations would stay unapplied.
+    """
+    stream = prefix + INVALIDATION_STREAM
+    seconds, microseconds = redis_client.time()
+    deadline = (seconds - settings.CACHEOPS_ASYNC_INVALIDATION_LAG) * 1000 + microseconds // 1000
+    while True:
+        entries = redis_client.xrange(stream, count=count)
+        overdue = [entry for entry in entries if int(entry[0].split(b'-')[0]) < deadline]
+        if overdue:
+            _apply(stream, overdue)
+        if len(overdue) < count:
+            return
+
+
+def invalidator_stats(using=DEFAULT_DB_ALIAS):
+    """
+    Returns a dict with number of queued invalidations, how many of them are being processed,
+    the age of the oldest one in seconds and number of failed ones.
+    """
+    stream = get_prefix(dbs=[using]) + INVALIDATION_STREAM
+    with redis_client.pipeline(transaction=True) as pipe:
+        pipe.xlen(stream)
+        pipe.xrange(stream, count=1)
+        pipe.time()
+        pipe.xlen(stream + FAILED_SUFFIX)
+        length, oldest, (seconds, microseconds), failed = pipe.execute()
+    try:
+        pending = redis_client.xpending(stream, GROUP)['pending']
+    except redis.ResponseError:
+        pending = 0
+
+    lag = 0
+    if oldest:
+        added = int(oldest[0][0].split(b'-')[0])
+        lag = max(0, seconds + microseconds / 1e6 - added / 1000)
+    return {'queued': length, 'pending': pending, 'lag': lag, 'failed': failed}
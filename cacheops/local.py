@@ -0,0 +1,149 @@
+"""
+Process local cache for local_get and TieredCache.
+
+It's a bounded LRU with TTL, which is cleared by table invalidation messages published
+by invalidation scripts and received by a listener thread. Until the listener subscribes
+we don't know what we could have missed, so cache is not used.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from funcy import cached_property, memoize
+
+from .conf import settings, prepare_profiles
+from .redis import redis_client
+
+
+CHANNEL = 'cacheops:local_get'
+# Dependencies are hashed into these many version counters, collisions just skip some stores
+VERSION_SLOTS = 4096
+
+
+class LocalCache(object):
+    """
+    Values depend on tables or any other strings, invalidated by publishing them to channel
+    on a redis conn.
+    """
+    def __init__(self, channel=CHANNEL, maxsize=None, conn=redis_client):
+        self._channel = channel
+        self.maxsize = maxsize
+        self.conn = conn
+        self._init()
+        # Not available on Windows, no forks there either
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._init)
+
+    def _init(self):
+        # Called again after fork: listener thread is not copied and locks might be held
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires, tables, value)
+        self._by_table = defaultdict(set)
+        self._listener = None
+        self._listening = False
+        self.epoch = 0  # Bumped when everything is invalidated
+        self._versions = [0] * VERSION_SLOTS
+
+    @cached_property
+    def channel(self):
+        return db_channel(self._channel, self.conn)
+
+    def active(self):
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(
+                        target=self._listen, name=self.channel, daemon=True)
+                    self._listener.start()
+        return self._listening
+
+    def get(self, key):
+        with self._lock:
+            expires, _, value = self._data[key]
+            if expires < time.monotonic():
+                self._delete(key)
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def stamp(self, tables):
+        """Versions of given tables, should be taken before fetching a value to set()"""
+        return (self.epoch,) + tuple(self._versions[hash(table) % VERSION_SLOTS]
+                                     for table in tables)
+
+    def set(self, key, value, timeout, tables, stamp):
+        """
+        Stores value dependent on given tables, stamp should be taken before it was fetched,
+        if any of tables was invalidated since then we don't store it.
+        """
+        with self._lock:
+            if stamp != self.stamp(tables):
+                return
+            if key in self._data:
+                self._delete(key)
+            self._data[key] = (time.monotonic() + timeout, tables, value)
+            for table in tables:
+                self._by_table[table].add(key)
+            maxsize = self.maxsize or settings.CACHEOPS_LOCAL_GET_MAXSIZE
+            while len(self._data) > maxsize:
+                self._delete(next(iter(self._data)))
+
+    def invalidate(self, table=None):
+        with self._lock:
+            if table is None:
+                self.epoch += 1
+                self._data.clear()
+                self._by_table.clear()
+            else:
+                self._versions[hash(table) % VERSION_SLOTS] += 1
+                for key in self._by_table.pop(table, ()):
+                    self._delete(key)
+
+    def _delete(self, key):
+        _, tables, _ = self._data.pop(key)
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    def _listen(self):
+        while True:
+            pubsub = self.conn.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                while True:
+                    message = pubsub.get_message(timeout=1)
+                    if message is None:
+                        continue
+                    if message['type'] == 'subscribe':
+                        # Anything could have changed while we were not listening
+                        self.invalidate()
+                        self._listening = True
+                    elif message['type'] == 'message':
+                        self.invalidate(message['data'].decode() or None)
+            except Exception:
+                self._listening = False
+                self.invalidate()
+            finally:
+                pubsub.close()
+            time.sleep(1)
+
+
+def db_channel(channel, conn):
+    """Pub/sub is server wide, so channels are told apart by redis db"""
+    return '%s:%s' % (channel, conn.connection_pool.connection_kwargs.get('db', 0))
+
+
+cache = LocalCache()
+
+
+@memoize
+def is_used():
+    return any(profile and profile['local_get'] for profile in prepare_profiles().values())
+
+def channel():
+    """A channel for invalidation scripts to publish to, empty if no one listens."""
+    return cache.channel if is_used() else ''
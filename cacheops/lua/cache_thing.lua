@@ -2,8 +2,23 @@ local prefix = KEYS[1]
 local key = KEYS[2]
 local precall_key = KEYS[3]
 local data = ARGV[1]
-local dnfs = cjson.decode(ARGV[2])
-local timeout = tonumber(ARGV[3])
+local schemes = cjson.decode(ARGV[2])
+local versions = cjson.decode(ARGV[3])  -- Known schemes versions, null for unknown
+local conj_index = cjson.decode(ARGV[4])
+local timeout = tonumber(ARGV[5])
+local gen_keys = cjson.decode(ARGV[6])
+local rnd = ARGV[7]  -- A new value for empty stamps and schemes version
+local sorted = ARGV[8] == '1'
+local generations = next(gen_keys) ~= nil
+
+-- Sorted conjs are scored with expiry time, TIME is only safe to use with effects replication
+local now
+if sorted then
+    -- REDIS_4
+    redis.replicate_commands()
+    -- /REDIS_4
+    now = tonumber(redis.call('time')[1])
+end
 
 if precall_key ~= prefix and redis.call('exists', precall_key) == 0 then
   -- Cached data was invalidated during the function call. The data is
@@ -11,40 +26,52 @@ if precall_key ~= prefix and redis.call('exists', precall_key) == 0 then
   return
 end
 
+-- Prepend data with a checksum of generation stamps, these are checked on read
+if generations then
+    local stamps = {}
+    for _, gen_key in ipairs(gen_keys) do
+        -- REDIS_7
+        local stamp = redis.call('set', gen_key, rnd, 'nx', 'get') or rnd
+        -- /REDIS_7
+        -- REDIS_4
+        local stamp = redis.call('get', gen_key)
+        if not stamp then
+            stamp = rnd
+            redis.call('set', gen_key, rnd)
+        end
+        -- /REDIS_4
+        table.insert(stamps, stamp)
+    end
+    data = redis.sha1hex(table.concat(stamps, ' ')) .. ':' .. data
+end
+
 -- Write data to cache
 redis.call('setex', key, timeout, data)
 
 
--- A pair of funcs
--- NOTE: we depend here on keys order being stable
-local conj_schema = function (conj)
-    local parts = {}
-    for field, _ in pairs(conj) do
-        table.insert(parts, field)
-    end
-
-    return table.concat(parts, ',')
-end
-
-local conj_cache_key = function (db_table, conj)
-    local parts = {}
-    for field, val in pairs(conj) do
-        table.insert(parts, field .. '=' .. tostring(val))
+-- Ensure schemes are known, unless we know they already are
+for db_table, _schemes in pairs(schemes) do
+    local version_key = prefix .. 'schemes_version:' .. db_table
+    local version = redis.call('get', version_key)
+    if versions[db_table] == cjson.null or version ~= versions[db_table] then
+        local added = redis.call('sadd', prefix .. 'schemes:' .. db_table, unpack(_schemes))
+        if added > 0 or not version then
+            redis.call('set', version_key, rnd)
+        end
     end
-
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
 end
 
-
--- Update schemes and invalidators
-for db_table, disj in pairs(dnfs) do
-    for _, conj in ipairs(disj) do
-        -- Ensure scheme is known
-        redis.call('sadd', prefix .. 'schemes:' .. db_table, conj_schema(conj))
-
+-- Update invalidators
+for db_table, conj_keys in pairs(conj_index) do
+    for _, conj_key in ipairs(conj_keys) do
         -- Add new cache_key to list of dependencies
-        local conj_key = conj_cache_key(db_table, conj)
-        redis.call('sadd', conj_key, key)
+        if sorted then
+            -- Trim expired cache keys as we go, so that conj sets stay bounded
+            redis.call('zremrangebyscore', conj_key, '-inf', '(' .. now)
+            redis.call('zadd', conj_key, now + timeout, key)
+        else
+            redis.call('sadd', conj_key, key)
+        end
         -- NOTE: an invalidator should live longer than any key it references.
         --       So we update its ttl on every key if needed.
         -- NOTE: we also can't use "EXPIRE conj_key timeout GT" because it will have no effect on
@@ -56,4 +83,12 @@ for db_table, disj in pairs(dnfs) do
             redis.call('expire', conj_key, timeout * 2 + 10)
         end
     end
+
+    -- Index conj keys by table, so that invalidate_model() won't need to scan keyspace.
+    -- Same as conj keys outlive cache keys, an index should outlive any conj key in it.
+    local index_key = prefix .. 'conjs:' .. db_table
+    redis.call('sadd', index_key, unpack(conj_keys))
+    if redis.call('ttl', index_key) < timeout * 2 + 10 then
+        redis.call('expire', index_key, timeout * 4 + 20)
+    end
 end
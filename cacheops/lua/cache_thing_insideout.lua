@@ -4,12 +4,22 @@ local data = ARGV[1]
 local schemes = cjson.decode(ARGV[2])
 local conj_keys = cjson.decode(ARGV[3])
 local timeout = tonumber(ARGV[4])
-local rnd = ARGV[5]  -- A new value for empty stamps
+local rnd = ARGV[5]  -- A new value for empty stamps and schemes version
 local expected_checksum = ARGV[6]
+local conj_index = cjson.decode(ARGV[7])
+local gen_keys = cjson.decode(ARGV[8])
+local versions = cjson.decode(ARGV[9])  -- Known schemes versions, null for unknown
 
--- Ensure schemes are known
+-- Ensure schemes are known, unless we know they already are
 for db_table, _schemes in pairs(schemes) do
-    redis.call('sadd', prefix .. 'schemes:' .. db_table, unpack(_schemes))
+    local version_key = prefix .. 'schemes_version:' .. db_table
+    local version = redis.call('get', version_key)
+    if versions[db_table] == cjson.null or version ~= versions[db_table] then
+        local added = redis.call('sadd', prefix .. 'schemes:' .. db_table, unpack(_schemes))
+        if added > 0 or not version then
+            redis.call('set', version_key, rnd)
+        end
+    end
 end
 
 -- Fill in invalidators and collect stamps
@@ -38,6 +48,30 @@ for _, conj_key in ipairs(conj_keys) do
     end
 end
 
+-- Collect generation stamps, unlike conj keys these don't expire
+for _, gen_key in ipairs(gen_keys) do
+    -- REDIS_7
+    local stamp = redis.call('set', gen_key, rnd, 'nx', 'get') or rnd
+    -- /REDIS_7
+    -- REDIS_4
+    local stamp = redis.call('get', gen_key)
+    if not stamp then
+        stamp = rnd
+        redis.call('set', gen_key, rnd)
+    end
+    -- /REDIS_4
+    table.insert(stamps, stamp)
+end
+
+-- Index conj keys by table, so that invalidate_model() won't need to scan keyspace
+for db_table, _conj_keys in pairs(conj_index) do
+    local index_key = prefix .. 'conjs:' .. db_table
+    redis.call('sadd', index_key, unpack(_conj_keys))
+    if redis.call('ttl', index_key) < timeout * 2 + 10 then
+        redis.call('expire', index_key, timeout * 4 + 20)
+    end
+end
+
 -- Write data to cache along with a checksum of the stamps to see if any of them changed
 local all_stamps = table.concat(stamps, ' ')
 local stamp_checksum = redis.sha1hex(all_stamps)
@@ -1,42 +1,87 @@
 local prefix = KEYS[1]
-local db_table = ARGV[1]
-local obj = cjson.decode(ARGV[2])
-
--- Utility functions
-local conj_cache_key = function (db_table, scheme, obj)
-    local parts = {}
-    for field in string.gmatch(scheme, "[^,]+") do
-        table.insert(parts, field .. '=' .. tostring(obj[field]))
-    end
-
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
-end
+local versions = cjson.decode(ARGV[1])  -- Schemes versions conj keys were calculated for
+local table_conj_keys = cjson.decode(ARGV[2])
+local generations = ARGV[3] == '1'
+local sorted = ARGV[4] == '1'
+local channel = ARGV[5]  -- Where to tell local caches to clear tables, if anywhere
 
-local call_in_chunks = function (command, args)
+local call_in_chunks = function (command, args, key)
     local step = 1000
     for i = 1, #args, step do
-        redis.call(command, unpack(args, i, math.min(i + step - 1, #args)))
+        if key then
+            redis.call(command, key, unpack(args, i, math.min(i + step - 1, #args)))
+        else
+            redis.call(command, unpack(args, i, math.min(i + step - 1, #args)))
+        end
     end
 end
 
 
--- Calculate conj keys
+-- If any schemes were added since client fetched them it needs to recalculate conj keys
+local outdated = {}
+for db_table, version in pairs(versions) do
+    if (redis.call('get', prefix .. 'schemes_version:' .. db_table) or '') ~= version then
+        table.insert(outdated, db_table)
+    end
+end
+if next(outdated) ~= nil then
+    return outdated
+end
+
 local conj_keys = {}
-local schemes = redis.call('smembers', prefix .. 'schemes:' .. db_table)
-for _, scheme in ipairs(schemes) do
-    table.insert(conj_keys, conj_cache_key(db_table, scheme, obj))
+for _, keys in pairs(table_conj_keys) do
+    for _, conj_key in ipairs(keys) do
+        table.insert(conj_keys, conj_key)
+    end
 end
 
 
 -- Delete cache keys and refering conj keys
 if next(conj_keys) ~= nil then
-    local cache_keys = redis.call('sunion', unpack(conj_keys))
+    local cache_keys = {}
+    if sorted then
+        -- REDIS_4
+        redis.replicate_commands()
+        -- /REDIS_4
+        -- Only live cache keys need to be deleted, expired ones are skipped
+        local now = redis.call('time')[1]
+        for _, conj_key in ipairs(conj_keys) do
+            for _, cache_key in ipairs(redis.call('zrangebyscore', conj_key, now, '+inf')) do
+                table.insert(cache_keys, cache_key)
+            end
+        end
+    else
+        local step = 1000
+        for i = 1, #conj_keys, step do
+            local keys = redis.call('sunion', unpack(conj_keys, i, math.min(i + step - 1, #conj_keys)))
+            for _, cache_key in ipairs(keys) do
+                table.insert(cache_keys, cache_key)
+            end
+        end
+    end
     -- we delete cache keys since they are invalid
     -- and conj keys as they will refer only deleted keys
-    redis.call("unlink", unpack(conj_keys))
-    if next(cache_keys) ~= nil then
-        -- NOTE: can't just do redis.call('del', unpack(...)) cause there is limit on number
-        --       of return values in lua.
-        call_in_chunks('del', cache_keys)
+    call_in_chunks('unlink', conj_keys)
+    for db_table, keys in pairs(table_conj_keys) do
+        if next(keys) ~= nil then
+            call_in_chunks('srem', keys, prefix .. 'conjs:' .. db_table)
+        end
+    end
+    -- NOTE: can't just do redis.call('del', unpack(...)) cause there is limit on number
+    --       of return values in lua.
+    call_in_chunks('del', cache_keys)
+end
+
+-- Queries without conditions on a table are checked against its "any" generation stamp
+if generations then
+    for db_table, _ in pairs(versions) do
+        redis.call('unlink', prefix .. 'gen:' .. db_table .. ':any')
+    end
+end
+
+if channel ~= '' then
+    for db_table, _ in pairs(versions) do
+        redis.call('publish', channel, db_table)
     end
 end
+return {}
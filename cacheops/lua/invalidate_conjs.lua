@@ -0,0 +1,34 @@
+local index_key = KEYS[1]
+local insideout = ARGV[1] == '1'
+local sorted = ARGV[2] == '1'
+local conj_keys = {unpack(ARGV, 3)}
+
+local call_in_chunks = function (command, args, key)
+    local step = 1000
+    for i = 1, #args, step do
+        if key then
+            redis.call(command, key, unpack(args, i, math.min(i + step - 1, #args)))
+        else
+            redis.call(command, unpack(args, i, math.min(i + step - 1, #args)))
+        end
+    end
+end
+
+
+-- In insideout mode cache keys refer conj keys and are checked on read,
+-- so dropping conj keys is enough, otherwise we also need to delete cache keys.
+if not insideout and sorted then
+    -- REDIS_4
+    redis.replicate_commands()
+    -- /REDIS_4
+    -- Only live cache keys need to be deleted, expired ones are skipped
+    local now = redis.call('time')[1]
+    for _, conj_key in ipairs(conj_keys) do
+        call_in_chunks('del', redis.call('zrangebyscore', conj_key, now, '+inf'))
+    end
+elseif not insideout then
+    local cache_keys = redis.call('sunion', unpack(conj_keys))
+    call_in_chunks('del', cache_keys)
+end
+call_in_chunks('unlink', conj_keys)
+call_in_chunks('srem', conj_keys, index_key)
@@ -1,20 +1,30 @@
 local prefix = KEYS[1]
-local db_table = ARGV[1]
-local obj = cjson.decode(ARGV[2])
+local versions = cjson.decode(ARGV[1])  -- Schemes versions conj keys were calculated for
+local table_conj_keys = cjson.decode(ARGV[2])
+local channel = ARGV[3]  -- Where to tell local caches to clear tables, if anywhere
 
-local conj_cache_key = function (db_table, scheme, obj)
-    local parts = {}
-    for field in string.gmatch(scheme, "[^,]+") do
-        -- All obj values are strings, we still use tostring() in case obj does not contain field
-        table.insert(parts, field .. '=' .. tostring(obj[field]))
+-- If any schemes were added since client fetched them it needs to recalculate conj keys
+local outdated = {}
+for db_table, version in pairs(versions) do
+    if (redis.call('get', prefix .. 'schemes_version:' .. db_table) or '') ~= version then
+        table.insert(outdated, db_table)
     end
-
-    return prefix .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+end
+if next(outdated) ~= nil then
+    return outdated
 end
 
 -- Drop conj keys
-local conj_keys = {}
-local schemes = redis.call('smembers', prefix .. 'schemes:' .. db_table)
-for _, scheme in ipairs(schemes) do
-    redis.call('unlink', conj_cache_key(db_table, scheme, obj))
+for db_table, conj_keys in pairs(table_conj_keys) do
+    if next(conj_keys) ~= nil then
+        redis.call('unlink', unpack(conj_keys))
+        redis.call('srem', prefix .. 'conjs:' .. db_table, unpack(conj_keys))
+    end
+end
+
+if channel ~= '' then
+    for db_table, _ in pairs(versions) do
+        redis.call('publish', channel, db_table)
+    end
 end
+return {}
@@ -0,0 +1,22 @@
+local stream = KEYS[1]
+local max_lag = tonumber(ARGV[1]) * 1000  -- In milliseconds, same as stream ids
+local data = ARGV[2]
+
+-- REDIS_4
+redis.replicate_commands()
+-- /REDIS_4
+
+-- Processed entries are deleted, so the first one is the oldest not yet applied.
+-- If workers fall behind, refuse to queue and let client invalidate synchronously.
+local oldest = redis.call('xrange', stream, '-', '+', 'count', 1)[1]
+if oldest then
+    local time = redis.call('time')
+    local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+    local added = tonumber(string.match(oldest[1], '^(%d+)'))
+    if now - added > max_lag then
+        return 0
+    end
+end
+
+redis.call('xadd', stream, '*', 'data', data)
+return 1
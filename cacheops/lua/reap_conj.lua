@@ -0,0 +1,31 @@
+local conj_key = KEYS[1]
+local state_key = KEYS[2]
+local cursor = ARGV[1]
+local count = ARGV[2]
+local dry_run = ARGV[3] == '1'
+
+local res = redis.call('sscan', conj_key, cursor, 'count', count)
+local next_cursor, cache_keys = res[1], res[2]
+
+-- Check expiry here, so that cache keys never leave redis
+local expired = {}
+for _, key in ipairs(cache_keys) do
+    if redis.call('exists', key) == 0 then
+        table.insert(expired, key)
+    end
+end
+
+if #expired > 0 and not dry_run then
+    redis.call('srem', conj_key, unpack(expired))
+end
+
+-- Remember where we stopped to be able to resume, several conj keys might be in progress
+if state_key then
+    if next_cursor == '0' then
+        redis.call('hdel', state_key, conj_key)
+    else
+        redis.call('hset', state_key, conj_key, next_cursor)
+    end
+end
+
+return {next_cursor, #cache_keys, #expired}
@@ -0,0 +1,36 @@
+import os
+import socket
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from cacheops.invalidator import run_invalidator, invalidator_stats
+
+
+class Command(BaseCommand):
+    help = 'Applies invalidations queued for models with async_invalidation.'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument('--consumer', default=None,
+                            help='Unique worker name, defaults to hostname and pid')
+        parser.add_argument('--count', type=int, default=100,
+                            help='Max invalidations to read at once')
+        parser.add_argument('--claim-idle', type=int, default=60,
+                            help='Seconds to wait before taking over entries of dead workers')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when there is nothing left to process')
+        parser.add_argument('--using', default=DEFAULT_DB_ALIAS,
+                            help='Database to apply invalidations for, matters for prefix')
+        parser.add_argument('--stats', action='store_true',
+                            help='Show queue length and lag and exit')
+
+    def handle(self, consumer: str, count: int, claim_idle: int, once: bool, using: str,
+               stats: bool, **kwargs):
+        if stats:
+            self.stdout.write('Queued: %(queued)s, pending: %(pending)s, lag: %(lag).3fs, '
+                              'failed: %(failed)s' % invalidator_stats(using=using))
+            return
+
+        consumer = consumer or '%s-%s' % (socket.gethostname(), os.getpid())
+        run_invalidator(consumer, count=count, claim_idle=claim_idle, once=once, using=using)
@@ -0,0 +1,54 @@
+import json
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand
+
+from cacheops.stats import keyspace_stats, TTL_LABELS
+
+
+class Command(BaseCommand):
+    help = 'Samples cacheops keyspace and shows memory, conj sets and schemes usage.'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of largest conj sets to show per table')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Stop after scanning this many keys')
+        parser.add_argument('--dead-sample', type=int, default=100,
+                            help='Members of each conj set to check for being expired')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--max-ops', type=int, default=None,
+                            help='Limit redis operations per second')
+        parser.add_argument('--json', action='store_true', dest='as_json', help='Output JSON')
+
+    def handle(self, top: int, limit: int, dead_sample: int, chunk_size: int, max_ops: int,
+               as_json: bool, **kwargs):
+        stats = keyspace_stats(top=top, limit=limit, dead_sample=dead_sample,
+                               chunk_size=chunk_size, max_ops=max_ops)
+        if as_json:
+            self.stdout.write(json.dumps(stats, indent=4))
+            return
+
+        self.stdout.write('Scanned %s keys\n' % stats['keys'])
+        self.stdout.write('%-16s %10s %14s  %s' % ('TYPE', 'KEYS', 'BYTES', 'TTL'))
+        for key_type, info in sorted(stats['types'].items()):
+            self.stdout.write('%-16s %10d %14d  %s' % (
+                key_type, info['keys'], info['bytes'], _format_ttl(info['ttl'])))
+
+        self.stdout.write('\n%-30s %7s %10s %12s %6s %14s  %s' % (
+            'TABLE', 'SCHEMES', 'CONJS', 'MEMBERS', 'DEAD', 'BYTES', 'TTL'))
+        for table, info in stats['tables'].items():
+            dead = '-' if info['dead_ratio'] is None else '%d%%' % (info['dead_ratio'] * 100)
+            self.stdout.write('%-30s %7d %10d %12d %6s %14d  %s' % (
+                table, info['schemes'], info['conj_keys'], info['members'], dead,
+                info['bytes'], _format_ttl(info['ttl'])))
+
+        for table, info in stats['tables'].items():
+            if info['top_conjs']:
+                self.stdout.write('\nLargest conj sets of %s:' % table)
+                for key, size in info['top_conjs']:
+                    self.stdout.write('%12d  %s' % (size, key))
+
+
+def _format_ttl(counts):
+    return ', '.join('%s: %s' % (label, counts[label]) for label in TTL_LABELS if label in counts)
@@ -1,8 +1,7 @@
-import os
-
 from django.core.management.base import BaseCommand
 
 from cacheops.conf import settings
+from cacheops.simple import FileCache
 
 
 class Command(BaseCommand):
@@ -10,9 +9,21 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('path', nargs='*', default=['default'])
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of threads to process subdirectories with')
+        parser.add_argument('--max-size', type=int, default=None,
+                            help='Evict least recently used files to fit this many bytes')
+        parser.add_argument('--max-entries', type=int, default=None,
+                            help='Evict least recently used files to fit this many files')
 
     def handle(self, **options):
         for path in options['path']:
+            max_size, max_entries = options['max_size'], options['max_entries']
             if path == 'default':
                 path = settings.FILE_CACHE_DIR
-            os.system(r'find %s -type f \! -iname "\." -mmin +0 -delete' % path)
+                max_size = max_size or settings.FILE_CACHE_MAX_SIZE
+                max_entries = max_entries or settings.FILE_CACHE_MAX_ENTRIES
+            cache = FileCache(path, max_size=max_size, max_entries=max_entries)
+            stats = cache.clean(workers=options['workers'])
+            self.stdout.write('Removed %(files)s files, reclaimed %(bytes)s bytes in ' % stats
+                              + path)
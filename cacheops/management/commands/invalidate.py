@@ -9,7 +9,13 @@ class Command(LabelCommand):
     args = '(all | <app> | <app>.<model> | <app>.<model>.<pk>) +'
     label = 'app or model or object'
 
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--scan', action='store_true',
+                            help='Also scan keyspace for conj keys missing from table indexes')
+
     def handle_label(self, label, **options):
+        self.scan = options['scan']
         if label == 'all':
             self.handle_all()
         else:
@@ -29,10 +35,10 @@ class Command(LabelCommand):
 
     def handle_app(self, app_name):
         for model in self.get_app(app_name).get_models(include_auto_created=True):
-            invalidate_model(model)
+            invalidate_model(model, scan=self.scan)
 
     def handle_model(self, app_name, model_name):
-        invalidate_model(self.get_model(app_name, model_name))
+        invalidate_model(self.get_model(app_name, model_name), scan=self.scan)
 
     def handle_obj(self, app_name, model_name, obj_pk):
         model = self.get_model(app_name, model_name)
@@ -12,10 +12,22 @@ class Command(BaseCommand):
         parser.add_argument('--chunk-size', type=int, default=1000)
         parser.add_argument('--min-conj-set-size', type=int, default=1000)
         parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--max-ops', type=int, default=None,
+                            help='Limit redis operations per second')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--reset', action='store_true',
+                            help='Start over instead of resuming an interrupted run')
 
-    def handle(self, chunk_size: int, min_conj_set_size: int, dry_run: bool, **kwargs):
-        reap_conjs(
+    def handle(self, chunk_size: int, min_conj_set_size: int, dry_run: bool,
+               max_ops: int, workers: int, reset: bool, **kwargs):
+        stats = reap_conjs(
             chunk_size=chunk_size,
             min_conj_set_size=min_conj_set_size,
             dry_run=dry_run,
+            max_ops=max_ops,
+            workers=workers,
+            reset=reset,
         )
+        self.stdout.write('Removed %(removed)s of %(scanned)s cache keys '
+                          'in %(conj_keys)s conj sets, %(index_removed)s expired conj keys '
+                          'from indexes, reclaimed %(bytes)s bytes' % stats)
@@ -1,9 +1,10 @@
+import inspect
 import sys
 import threading
 from random import random
 
 from funcy import select_keys, cached_property, once, once_per, monkey, wraps, walk, chain
-from funcy import lmap, lcat, join_with
+from funcy import lmap, lcat, join_with, merge, omit, project
 
 from django.utils.encoding import force_str
 from django.core.exceptions import ImproperlyConfigured, EmptyResultSet
@@ -16,18 +17,18 @@ from django.db.transaction import atomic
 from .conf import model_profile, settings, ALL_OPS
 from .utils import monkey_mix, stamp_fields, get_cache_key, cached_view_fab, family_has_profile
 from .utils import md5
-from .getset import cache_thing, getting
+from .getset import cache_thing, getting, acache_thing, agetting
+from . import local
 from .sharding import get_prefix
 from .tree import dnfs
-from .invalidation import invalidate_obj, invalidate_dict, skip_on_no_invalidation
+from .invalidation import invalidate_obj, invalidate_dict, invalidate_dicts, skip_on_no_invalidation
+from .invalidation import get_obj_dict, serializable_fields
 from .transaction import transaction_states
 from .signals import cache_read
 
 
 __all__ = ('cached_as', 'cached_view_as', 'install_cacheops')
 
-_local_get_cache = {}
-
 
 def cached_as(*samples, timeout=None, extra=None, lock=None, keep_fresh=False):
     """
@@ -37,6 +38,8 @@ def cached_as(*samples, timeout=None, extra=None, lock=None, keep_fresh=False):
     If keep_fresh is True, this will prevent caching if the given querysets are
     invalidated during the function call. This prevents prolonged caching of
     stale data.
+
+    Coroutine functions get async wrappers, which talk to redis via redis.asyncio.
     """
     if not samples:
         raise TypeError('Pass a queryset, a model or an object to cache like')
@@ -60,22 +63,29 @@ def cached_as(*samples, timeout=None, extra=None, lock=None, keep_fresh=False):
 
     querysets = lmap(_get_queryset, samples)
     dbs = list({qs.db for qs in querysets})
-    cond_dnfs = join_with(lcat, map(dnfs, querysets))  # TODO: use cached version?
+    cond_dnfs = join_with(lcat, (qs._cond_dnfs for qs in querysets))
     qs_keys = [qs._cache_key(prefix=False) for qs in querysets]
     if timeout is None:
         timeout = min(qs._cacheprofile['timeout'] for qs in querysets)
     if lock is None:
         lock = any(qs._cacheprofile['lock'] for qs in querysets)
 
+    def _get_key(func, args, kwargs):
+        prefix = get_prefix(func=func, _cond_dnfs=cond_dnfs, dbs=dbs)
+        extra_val = extra(*args, **kwargs) if callable(extra) else extra
+        cache_key = prefix + 'as:' + get_cache_key(func, args, kwargs, qs_keys, extra_val)
+        return prefix, cache_key, extra_val
+
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            return async_decorator(func)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if not settings.CACHEOPS_ENABLED or transaction_states.is_dirty(dbs):
+            if not settings.CACHEOPS_ENABLED or transaction_states.is_dirty(dbs, cond_dnfs):
                 return func(*args, **kwargs)
 
-            prefix = get_prefix(func=func, _cond_dnfs=cond_dnfs, dbs=dbs)
-            extra_val = extra(*args, **kwargs) if callable(extra) else extra
-            cache_key = prefix + 'as:' + get_cache_key(func, args, kwargs, qs_keys, extra_val)
+            prefix, cache_key, extra_val = _get_key(func, args, kwargs)
 
             with getting(cache_key, cond_dnfs, prefix, lock=lock) as cache_data:
                 cache_read.send(sender=None, func=func, hit=cache_data is not None)
@@ -112,6 +122,40 @@ def cached_as(*samples, timeout=None, extra=None, lock=None, keep_fresh=False):
                     return result
 
         return wrapper
+
+    def async_decorator(func):
+        # Same as above, but talks to redis with an asyncio client
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not settings.CACHEOPS_ENABLED or transaction_states.is_dirty(dbs, cond_dnfs):
+                return await func(*args, **kwargs)
+
+            prefix, cache_key, extra_val = _get_key(func, args, kwargs)
+
+            async with agetting(cache_key, cond_dnfs, prefix, lock=lock) as cache_data:
+                cache_read.send(sender=None, func=func, hit=cache_data is not None)
+                if cache_data is not None:
+                    return settings.CACHEOPS_SERIALIZER.loads(cache_data)
+                else:
+                    precall_key = ''
+                    expected_checksum = ''
+                    if keep_fresh and settings.CACHEOPS_INSIDEOUT:
+                        expected_checksum = await acache_thing(
+                            prefix, cache_key, '', cond_dnfs, timeout,
+                            dbs=dbs, expected_checksum='never match')
+                    elif keep_fresh:
+                        suffix = get_cache_key(func, args, kwargs, qs_keys, extra_val, random())
+                        precall_key = prefix + 'asp:' + suffix
+                        await acache_thing(prefix, precall_key, 'PRECALL', cond_dnfs, timeout,
+                                           dbs=dbs)
+
+                    result = await func(*args, **kwargs)
+                    await acache_thing(prefix, cache_key, result, cond_dnfs, timeout, dbs=dbs,
+                                       precall_key=precall_key,
+                                       expected_checksum=expected_checksum)
+                    return result
+
+        return wrapper
     return decorator
 
 
@@ -181,10 +225,17 @@ class QuerySetMixin(object):
 
     def _should_cache(self, op):
         # If cache and op are enabled and not within write or dirty transaction
+        return self._may_cache(op) and not transaction_states[self.db].is_dirty(self._cond_dnfs)
+
+    def _should_cache_in_transaction(self, op):
+        # Dirty transaction could still keep results in memory until next write
+        return settings.CACHEOPS_TRANSACTION_CACHE \
+            and self._may_cache(op) and transaction_states[self.db].is_dirty(self._cond_dnfs)
+
+    def _may_cache(self, op):
         return settings.CACHEOPS_ENABLED \
             and self._cacheprofile and op in self._cacheprofile['ops'] \
-            and not self._for_write \
-            and not transaction_states[self.db].is_dirty()
+            and not self._for_write
 
     def cache(self, ops=None, timeout=None, lock=None):
         """
@@ -245,6 +296,9 @@ class QuerySetMixin(object):
         return clone
 
     def _fetch_all(self):
+        if self._result_cache is None and self._should_cache_in_transaction('fetch'):
+            self._fetch_in_transaction()
+
         # If already fetched or should pass by then fall back
         if self._result_cache is not None or not self._should_cache('fetch'):
             return self._no_monkey._fetch_all(self)
@@ -262,6 +316,16 @@ class QuerySetMixin(object):
 
         return self._no_monkey._fetch_all(self)
 
+    def _fetch_in_transaction(self):
+        cache_key = self._cache_key()
+        state = transaction_states[self.db]
+        try:
+            self._result_cache = settings.CACHEOPS_SERIALIZER.loads(state.get_result(cache_key))
+        except KeyError:
+            self._result_cache = list(self._iterable_class(self))
+            state.set_result(cache_key, self._cond_dnfs,
+                             settings.CACHEOPS_SERIALIZER.dumps(self._result_cache))
+
     def count(self):
         if self._should_cache('count'):
             # Optmization borrowed from overridden method:
@@ -309,7 +373,7 @@ class QuerySetMixin(object):
         # so here we add 'fetch' to ops
         if self._should_cache('get'):
             # NOTE: local_get=True enables caching of simple gets in local memory,
-            #       which is very fast, but not invalidated.
+            #       which is very fast, but only invalidated by table.
             # Don't bother with Q-objects, select_related and previous filters,
             # simple gets - thats what we are really up to here.
             #
@@ -319,18 +383,26 @@ class QuerySetMixin(object):
             #       - ...
             # TODO: don't distinguish between pk, pk__exaxt, id, id__exact
             # TOOD: work with .filter(**kwargs).get() ?
-            if self._cacheprofile['local_get']        \
-                    and not args                      \
-                    and not self.query.select_related \
-                    and not self.query.where.children:
+            if self._cacheprofile['local_get']                     \
+                    and not args                                   \
+                    and not self.query.select_related              \
+                    and not self.query.where.children              \
+                    and not transaction_states[self.db].is_dirty() \
+                    and local.cache.active():
                 # NOTE: We use simpler way to generate a cache key to cut costs.
                 #       Some day it could produce same key for different requests.
                 key = (self.__class__, self.model) + tuple(sorted(kwargs.items()))
                 try:
-                    return _local_get_cache[key]
+                    return local.cache.get(key)
                 except KeyError:
-                    _local_get_cache[key] = self._no_monkey.get(self, *args, **kwargs)
-                    return _local_get_cache[key]
+                    # Lookups might span several tables, any of them changing should clear this
+                    tables = list(self._clone().filter(**kwargs)._cond_dnfs)
+                    stamp = local.cache.stamp(tables)
+                    obj = self._no_monkey.get(self, *args, **kwargs)
+                    timeout = self._cacheprofile.get('local_get_timeout') \
+                        or self._cacheprofile['timeout']
+                    local.cache.set(key, obj, timeout, tables, stamp)
+                    return obj
                 except TypeError:
                     # If some arg is unhashable we can't save it to dict key,
                     # we just skip local cache in that case
@@ -424,25 +496,39 @@ class ManagerMixin(object):
     @skip_on_no_invalidation
     def _pre_save(self, sender, instance, using, **kwargs):
         if instance.pk is not None and not instance._state.adding:
+            model = sender._meta.concrete_model
+            fields = serializable_fields(model)
+            # Use values snapshotted on load if we have all of them
+            snapshot = instance.__dict__.get('_cacheops_snapshot')
+            pk_field = model._meta.pk
+            if snapshot is not None and all(f.attname in snapshot for f in fields) \
+                    and instance._state.db == using \
+                    and snapshot[pk_field.attname] == pk_field.get_prep_value(instance.pk):
+                _old_objs.__dict__[sender, instance.pk] = snapshot
+                return
             try:
-                # TODO: do not fetch non-serializable fields
-                _old_objs.__dict__[sender, instance.pk] \
-                    = sender.objects.using(using).get(pk=instance.pk)
+                old = sender.objects.using(using).only(*(f.attname for f in fields)) \
+                                    .get(pk=instance.pk)
+                _old_objs.__dict__[sender, instance.pk] = get_obj_dict(model, old)
             except sender.DoesNotExist:
                 pass
 
     @skip_on_no_invalidation
     def _post_save(self, sender, instance, using, **kwargs):
-        # Invoke invalidations for both old and new versions of saved object
+        # Invoke invalidations for both old and new versions of saved object and o2o reverse
+        # queries at once, old and new mostly share conj keys, so this saves redis some work.
+        model = sender._meta.concrete_model
         old = _old_objs.__dict__.pop((sender, instance.pk), None)
-        if old:
-            invalidate_obj(old, using=using)
-        invalidate_obj(instance, using=using)
-
-        invalidate_o2o(sender, old, instance, using=using)
+        obj_dict = get_obj_dict(model, instance)
+        model_dicts = [(model, old)] if old is not None and old != obj_dict else []
+        model_dicts.append((model, obj_dict))
+        model_dicts.extend(o2o_dicts(sender, old, instance))
+        invalidate_dicts(model_dicts, using=using)
 
         # We run invalidations but skip caching if we are dirty
         if transaction_states[using].is_dirty():
+            # Snapshot might get rolled back, so we will refetch old values next time
+            instance.__dict__.pop('_cacheops_snapshot', None)
             return
 
         # NOTE: it's possible for this to be a subclass, e.g. proxy, without cacheprofile,
@@ -452,6 +538,18 @@ class ManagerMixin(object):
         if not cacheprofile:
             return
 
+        # Saved values are now in db, remember them for the next save
+        if cacheprofile['snapshot_on_load']:
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                instance._cacheops_snapshot = obj_dict
+            elif old is not None:
+                # NOTE: unsaved fields might have been changed, so we only take saved ones,
+                #       any missing, e.g. updated with F(), will make us refetch next time.
+                attnames = {model._meta.get_field(name).attname for name in update_fields}
+                instance._cacheops_snapshot = merge(omit(old, attnames),
+                                                    project(obj_dict, attnames))
+
         # Enabled cache_on_save makes us write saved object to cache.
         # Later it can be retrieved with .get(<cache_on_save_field>=<value>)
         # <cache_on_save_field> is pk unless specified.
@@ -505,17 +603,51 @@ class ManagerMixin(object):
         return self.get_queryset().inplace().invalidated_update(**kwargs)
 
 
-def invalidate_o2o(sender, old, instance, using=DEFAULT_DB_ALIAS):
-    """Invoke invalidation for o2o reverse queries"""
+class ModelMixin(object):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = cls._no_monkey.from_db.__func__(cls, db, field_names, values)
+        # Remember loaded values to not refetch them on save,
+        # values seen in a dirty transaction might be rolled back so we don't trust them.
+        profile = model_profile(cls)
+        if profile and profile['snapshot_on_load'] and not transaction_states[db].is_dirty():
+            obj._cacheops_snapshot = get_obj_dict(cls._meta.concrete_model, obj)
+        return obj
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        self._no_monkey.refresh_from_db(self, using=using, fields=fields, **kwargs)
+        # Refreshed values are newer than snapshotted ones
+        snapshot = self.__dict__.pop('_cacheops_snapshot', None)
+        if snapshot is not None and not transaction_states[self._state.db].is_dirty():
+            obj_dict = get_obj_dict(self._meta.concrete_model, self)
+            if fields is not None:
+                attnames = {f.attname for f in self._meta.concrete_fields
+                            if f.name in fields or f.attname in fields}
+                obj_dict = merge(omit(snapshot, attnames), project(obj_dict, attnames))
+            self._cacheops_snapshot = obj_dict
+
+    def __getstate__(self):
+        state = self._no_monkey.__getstate__(self)
+        # Snapshot would bloat cached objects and might be older than db row when unpickled
+        if '_cacheops_snapshot' in state:
+            state = {k: v for k, v in state.items() if k != '_cacheops_snapshot'}
+        return state
+
+
+def o2o_dicts(sender, old, instance):
+    """
+    Yields (model, obj_dict) pairs to invalidate o2o reverse queries,
+    old is a dict of previously saved values.
+    """
     o2o_fields = [f for f in sender._meta.fields if isinstance(f, models.OneToOneField)]
     for f in o2o_fields:
-        old_value = getattr(old, f.attname, None)
+        old_value = old.get(f.attname) if old is not None else None
         value = getattr(instance, f.attname)
         if old_value != value:
             rmodel, rfield = f.related_model, f.remote_field.field_name
-            if old:
-                invalidate_dict(rmodel, {rfield: old_value}, using=using)
-            invalidate_dict(rmodel, {rfield: value}, using=using)
+            if old is not None:
+                yield rmodel, {rfield: old_value}
+            yield rmodel, {rfield: value}
 
 
 def invalidate_m2o(sender, instance, using=DEFAULT_DB_ALIAS):
@@ -573,6 +705,7 @@ def install_cacheops():
     """
     monkey_mix(BaseManager, ManagerMixin)
     monkey_mix(models.QuerySet, QuerySetMixin)
+    monkey_mix(models.Model, ModelMixin)
 
     # Use app registry to introspect used apps
     from django.apps import apps
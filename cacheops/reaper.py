@@ -1,10 +1,16 @@
 import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from django.db import DEFAULT_DB_ALIAS
 
-from .redis import redis_client
+from .redis import redis_client, load_script
 from .sharding import get_prefix
 
+__all__ = ('reap_conjs',)
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,6 +19,9 @@ def reap_conjs(
     min_conj_set_size: int = 1000,
     using=DEFAULT_DB_ALIAS,
     dry_run: bool = False,
+    max_ops: int = None,
+    workers: int = 1,
+    reset: bool = False,
 ):
     """
     Remove expired cache keys from invalidation sets.
@@ -27,39 +36,128 @@ def reap_conjs(
     to invalidate them.
 
     This function scans cacheops' conj keys for already-expired cache keys and removes them.
+    Same way conjs:<table> indexes are cleaned of conj keys, which expired themselves.
+    Expiry is checked by a script for each batch of cache keys, so they never leave Redis.
+    Conj keys are SCANned once and each chunk of them is split between workers. Cursors are
+    stored in Redis to resume from them if interrupted, unless reset is passed.
+    Workers share max_ops budget of Redis operations per second.
+
+    Returns a dict with number of scanned and removed cache keys, removed index members
+    and reclaimed bytes.
     """
     logger.info('Starting scan for large conj sets')
     prefix = get_prefix(dbs=[using])
-    for conj_key in redis_client.scan_iter(prefix + 'conj:*', count=chunk_size):
-        total = redis_client.scard(conj_key)
-        if total < min_conj_set_size:
-            continue
-        logger.info('Found %s cache keys in %s, scanning for expired keys', total, conj_key)
-        _clear_conj_key(conj_key, chunk_size, dry_run)
-    logger.info('Done scan for large conj sets')
+    state_key = prefix + 'reaper'
+    if reset and not dry_run:
+        redis_client.delete(state_key)
+    state = {} if dry_run else redis_client.hgetall(state_key)
+    cursor = int(state.pop(b'cursor', 0))
+    # The rest are cursors of conj sets being reaped when interrupted
+    conj_cursors = {key: int(conj_cursor) for key, conj_cursor in state.items()}
+    if cursor or conj_cursors:
+        logger.info('Resuming from cursor %s', cursor)
 
+    throttle = _throttler(max_ops)
 
-def _clear_conj_key(conj_key: bytes, chunk_size: int, dry_run: bool):
-    """Scan the cache keys in a conj set in batches and remove any that have expired."""
-    count, removed = 0, 0
-    for keys in _iter_keys_chunk(chunk_size, conj_key):
-        count += len(keys)
-        values = redis_client.mget(keys)
-        expired = [k for k, v in zip(keys, values) if not v]
-        if expired:
-            if not dry_run:
-                redis_client.srem(conj_key, *expired)
-            removed += len(expired)
-            logger.info('Removed %s/%s cache keys from %s', removed, count, conj_key)
-    if removed and not dry_run:
+    def reap_conj_key(conj_key):
+        return _reap_conj_key(conj_key, conj_cursors.get(conj_key, 0),
+                              None if dry_run else state_key,
+                              chunk_size, min_conj_set_size, dry_run, throttle)
+
+    def reap_index(index_key):
+        # Members are conj keys here, but expiry check is the same
+        index_stats = _reap_conj_key(index_key, 0, None, chunk_size, min_conj_set_size,
+                                     dry_run, throttle)
+        return Counter(index_removed=index_stats['removed'], bytes=index_stats['bytes'])
+
+    stats = Counter(conj_keys=0, scanned=0, removed=0, index_removed=0, bytes=0)
+    with ThreadPoolExecutor(workers) as executor:
+        def reap_all(keys, reap):
+            results = map(reap, keys) if workers == 1 else executor.map(reap, keys)
+            for key_stats in results:
+                stats.update(key_stats)
+
+        # A cursor is only saved once all of the chunk is processed
+        for cursor, conj_keys in _scan_sets(prefix + 'conj:*', cursor, chunk_size, throttle):
+            reap_all(conj_keys, reap_conj_key)
+            if cursor and not dry_run:
+                redis_client.hset(state_key, 'cursor', cursor)
+
+        # There is an index per table, so these are not worth resuming
+        for _, index_keys in _scan_sets(prefix + 'conjs:*', 0, chunk_size, throttle):
+            reap_all(index_keys, reap_index)
+
+    if not dry_run:
+        redis_client.delete(state_key)
+    if (stats['removed'] or stats['index_removed']) and not dry_run:
         redis_client.execute_command('MEMORY PURGE')
+    logger.info('Done scan for large conj sets, removed %s/%s cache keys, reclaimed %s bytes',
+                stats['removed'], stats['scanned'], stats['bytes'])
+    return dict(stats)
 
 
-def _iter_keys_chunk(chunk_size, key):
-    cursor = 0
+def _scan_sets(match, cursor, chunk_size, throttle):
+    """
+    Yields SCAN cursors along with set keys found before them.
+    Types are checked here, not by SCAN, to support Redis older than 6.0.
+    """
     while True:
-        cursor, items = redis_client.sscan(key, cursor, count=chunk_size)
-        if items:
-            yield items
+        cursor, keys = redis_client.scan(cursor, match=match, count=chunk_size)
+        if keys:
+            with redis_client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.type(key)
+                types = pipe.execute()
+            keys = [key for key, key_type in zip(keys, types) if key_type == b'set']
+        throttle(chunk_size + len(keys))
+        yield cursor, keys
         if cursor == 0:
             break
+
+
+def _reap_conj_key(conj_key, cursor, state_key, chunk_size, min_conj_set_size, dry_run, throttle):
+    """Scan the cache keys in a conj set in batches and remove any that have expired."""
+    stats = Counter()
+    total = redis_client.scard(conj_key)
+    if total < min_conj_set_size:
+        return stats
+    logger.info('Found %s cache keys in %s, scanning for expired keys', total, conj_key)
+
+    reap_conj = load_script('reap_conj')
+    keys = [conj_key, state_key] if state_key else [conj_key]
+    size_before = redis_client.memory_usage(conj_key) or 0
+    while True:
+        cursor, scanned, removed = reap_conj(keys=keys, args=[cursor, chunk_size, int(dry_run)])
+        cursor = int(cursor)
+        throttle(scanned + 1)
+        stats.update(scanned=scanned, removed=removed)
+        if removed:
+            logger.info('Removed %s/%s cache keys from %s',
+                        stats['removed'], stats['scanned'], conj_key)
+        if cursor == 0:
+            break
+
+    stats['conj_keys'] += 1
+    if stats['removed'] and not dry_run:
+        stats['bytes'] += max(0, size_before - (redis_client.memory_usage(conj_key) or 0))
+    return stats
+
+
+def _throttler(max_ops):
+    """
+    Returns a function to call after doing some ops, which sleeps to keep to max_ops/sec.
+    It could be shared by threads.
+    """
+    start, done = time.monotonic(), 0
+    lock = threading.Lock()
+
+    def throttle(ops):
+        nonlocal done
+        if not max_ops:
+            return
+        with lock:
+            done += ops
+            delay = done / max_ops - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+    return throttle
@@ -1,9 +1,10 @@
+import asyncio
 import warnings
 
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 
-from funcy import decorator, identity, memoize, omit, LazyObject
+from funcy import decorator, identity, memoize, omit, wraps, LazyObject
 import redis
 from redis.sentinel import Sentinel
 from .conf import settings
@@ -22,20 +23,64 @@ handle_connection_failure = _handle_connection_failure if settings.CACHEOPS_DEGR
     else identity
 
 
+def _handle_async_connection_failure(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except redis.ConnectionError as e:
+            warnings.warn("The cacheops cache is unreachable! Error: %s" % e, RuntimeWarning)
+        except redis.TimeoutError as e:
+            warnings.warn("The cacheops cache timed out! Error: %s" % e, RuntimeWarning)
+    return wrapper
+
+handle_async_connection_failure = _handle_async_connection_failure \
+    if settings.CACHEOPS_DEGRADE_ON_FAILURE else identity
+
+
 @LazyObject
 def redis_client():
-    if settings.CACHEOPS_REDIS and settings.CACHEOPS_SENTINEL:
-        raise ImproperlyConfigured("CACHEOPS_REDIS and CACHEOPS_SENTINEL are mutually exclusive")
-
     client_class = redis.Redis
     if settings.CACHEOPS_CLIENT_CLASS:
         client_class = import_string(settings.CACHEOPS_CLIENT_CLASS)
+    return _make_client(client_class, Sentinel)
+
+
+def async_redis_client():
+    """
+    Returns redis.asyncio client for running event loop, connections can't be shared by loops.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        # Not imported at module level, redis-py got asyncio support in 4.2
+        try:
+            import redis.asyncio
+            from redis.asyncio.sentinel import Sentinel as AsyncSentinel
+        except ImportError:
+            raise ImproperlyConfigured("Caching coroutine functions requires redis-py 4.2+")
+
+        # Clients hold on to their loops, so we drop them with the loops
+        for closed in [other for other in _async_clients if other.is_closed()]:
+            del _async_clients[closed]
+        client_class = redis.asyncio.Redis
+        if settings.CACHEOPS_ASYNC_CLIENT_CLASS:
+            client_class = import_string(settings.CACHEOPS_ASYNC_CLIENT_CLASS)
+        client = _async_clients[loop] = _make_client(client_class, AsyncSentinel)
+    return client
+
+_async_clients = {}
+
+
+def _make_client(client_class, sentinel_class):
+    if settings.CACHEOPS_REDIS and settings.CACHEOPS_SENTINEL:
+        raise ImproperlyConfigured("CACHEOPS_REDIS and CACHEOPS_SENTINEL are mutually exclusive")
 
     if settings.CACHEOPS_SENTINEL:
         if not {'locations', 'service_name'} <= set(settings.CACHEOPS_SENTINEL):
             raise ImproperlyConfigured("Specify locations and service_name for CACHEOPS_SENTINEL")
 
-        sentinel = Sentinel(
+        sentinel = sentinel_class(
             settings.CACHEOPS_SENTINEL['locations'],
             **omit(settings.CACHEOPS_SENTINEL, ('locations', 'service_name', 'db')))
         return sentinel.master_for(
@@ -59,18 +104,58 @@ import re
 
 @memoize
 def load_script(name):
+    return redis_client.register_script(script_code(name))
+
+
+async def load_async_script(name):
+    return async_redis_client().register_script(_script_code(name, await ais_redis_7()))
+
+
+def script_code(name):
+    return _script_code(name, is_redis_7())
+
+
+@memoize
+def _script_code(name, redis_7):
     filename = os.path.join(os.path.dirname(__file__), 'lua/%s.lua' % name)
     with open(filename) as f:
         code = f.read()
-    if is_redis_7():
+    if redis_7:
         code = re.sub(r'REDIS_4.*?/REDIS_4', '', code, flags=re.S)
     else:
         code = re.sub(r'REDIS_7.*?/REDIS_7', '', code, flags=re.S)
-    return redis_client.register_script(code)
+    return code
 
 
-@memoize
+# Shared by sync and async clients, these talk to the same redis
+_server = {}
+
 def is_redis_7():
+    if 'redis_7' not in _server:
+        _server['redis_7'] = _is_redis_7(redis_client.info('server'))
+    return _server['redis_7']
+
+async def ais_redis_7():
+    """Same as is_redis_7(), but doesn't block event loop on first call"""
+    if 'redis_7' not in _server:
+        _server['redis_7'] = _is_redis_7(await async_redis_client().info('server'))
+    return _server['redis_7']
+
+def lua_null():
+    if 'lua_null' not in _server:
+        _server['lua_null'] = redis_client.eval(LUA_NULL_SCRIPT, 0).decode()
+    return _server['lua_null']
+
+async def alua_null():
+    """Same as lua_null(), call before formatting conj values on async paths"""
+    if 'lua_null' not in _server:
+        _server['lua_null'] = (await async_redis_client().eval(LUA_NULL_SCRIPT, 0)).decode()
+    return _server['lua_null']
+
+# It's formatted as a pointer, which is platform dependent
+LUA_NULL_SCRIPT = 'return tostring(cjson.null)'
+
+def _is_redis_7(info):
     # Some arcane redis version may return X.X, which redis-py turns into float
-    redis_version = str(redis_client.info('server')['redis_version'])
+    redis_version = str(info['redis_version'])
     return int(redis_version.split('.')[0]) >= 7
@@ -0,0 +1,142 @@
+"""
+Process local registry of invalidation schemes.
+
+Schemes are sets of fields, which cached queries are conditioned on, for each table.
+Knowing them we can calculate conj keys on client and send only those to redis.
+Each time a new scheme is added to redis a random version token is updated along,
+scripts check it against one we saw and report back if ours is outdated.
+"""
+from binascii import crc32
+
+
+from .conf import settings
+from .redis import redis_client, async_redis_client, lua_null
+
+
+class SchemesRegistry(object):
+    def __init__(self):
+        self._data = {}  # (prefix, table) -> (version, [scheme, ...])
+
+    def get(self, prefix, tables):
+        """
+        Returns a dict of table -> (version, schemes), schemes are tuples of field names.
+        Fetches anything missing from redis.
+        """
+        result = {table: self._data.get((prefix, table)) for table in tables}
+        missing = [table for table, entry in result.items() if entry is None]
+        if missing:
+            result.update(self.refresh(prefix, missing))
+        return result
+
+    async def aget(self, prefix, tables):
+        result = {table: self._data.get((prefix, table)) for table in tables}
+        missing = [table for table, entry in result.items() if entry is None]
+        if missing:
+            result.update(await self.arefresh(prefix, missing))
+        return result
+
+    def refresh(self, prefix, tables):
+        with redis_client.pipeline(transaction=True) as pipe:
+            self._queue_fetch(pipe, prefix, tables)
+            res = pipe.execute()
+        return self._store(prefix, tables, res)
+
+    async def arefresh(self, prefix, tables):
+        async with async_redis_client().pipeline(transaction=True) as pipe:
+            self._queue_fetch(pipe, prefix, tables)
+            res = await pipe.execute()
+        return self._store(prefix, tables, res)
+
+    def _queue_fetch(self, pipe, prefix, tables):
+        for table in tables:
+            pipe.smembers(prefix + 'schemes:' + table)
+            pipe.get(prefix + 'schemes_version:' + table)
+
+    def _store(self, prefix, tables, res):
+        fetched = {}
+        for table, schemes, version in zip(tables, res[::2], res[1::2]):
+            # Fields are sorted same as when caching, schemes added by older versions might not be
+            schemes = list({tuple(sorted(s.decode().split(','))) if s else () for s in schemes})
+            fetched[table] = (version.decode() if version else '', schemes)
+        self._data.update(((prefix, table), entry) for table, entry in fetched.items())
+        return fetched
+
+    def forget(self, prefix, tables):
+        for table in tables:
+            self._data.pop((prefix, table), None)
+
+    def clear(self):
+        self._data.clear()
+
+registry = SchemesRegistry()
+
+
+def scheme_versions(prefix, cond_schemes):
+    """
+    Returns a dict of table -> known version for tables with all given schemes known,
+    unknown tables are mapped to None. Scripts skip adding schemes for known ones.
+    """
+    return _versions(cond_schemes, registry.get(prefix, list(cond_schemes)))
+
+
+async def ascheme_versions(prefix, cond_schemes):
+    return _versions(cond_schemes, await registry.aget(prefix, list(cond_schemes)))
+
+
+def _versions(cond_schemes, known):
+    versions = {}
+    for table, schemes in cond_schemes.items():
+        version, known_schemes = known[table]
+        known_schemes = set(map(frozenset, known_schemes))
+        all_known = all(frozenset(s.split(',') if s else ()) in known_schemes for s in schemes)
+        versions[table] = version if all_known else None
+    return versions
+
+
+def conj_key(prefix, table, scheme, obj_dict):
+    conj_str = '&'.join('%s=%s' % (field, conj_value(field_value(obj_dict, field)))
+                        for field in scheme)
+    return '%sconj:%s:%s' % (prefix, table, conj_str)
+
+
+def field_value(obj_dict, field):
+    # Partitions are calculated here to not bother when they are not used in schemes
+    # NOTE: schemes could be outdated, so partitions could be turned off by now
+    if field.endswith(PARTITION_SUFFIX) and field not in obj_dict:
+        value = obj_dict.get(field[:-len(PARTITION_SUFFIX)], MISSING)
+        if value is MISSING or not settings.CACHEOPS_LONG_DISJUNCTION_PARTITIONS:
+            return MISSING
+        return partition(value)
+    return obj_dict.get(field, MISSING)
+
+
+PARTITION_SUFFIX = '__part'
+
+def partition(value):
+    """Long __in lookups are converted to eq conds on hashed partitions of their values"""
+    return crc32(str(value).encode()) % settings.CACHEOPS_LONG_DISJUNCTION_PARTITIONS
+
+
+MISSING = object()
+
+def conj_value(value):
+    """
+    Formats a value for a conj key.
+
+    Insideout mode uses str(), classic one mimics what scripts did before conj keys were
+    calculated on client: json.dumps(default=str), cjson.decode() and tostring().
+    """
+    if value is MISSING:
+        return 'nil'
+    elif settings.CACHEOPS_INSIDEOUT:
+        return str(value)
+    elif value is None:
+        return lua_null()
+    elif value is True or value is False:
+        return 'true' if value else 'false'
+    elif isinstance(value, (int, float)):
+        # Lua numbers are doubles formatted with %.14g
+        return '%.14g' % value
+    else:
+        return str(value)
+
@@ -1,15 +1,36 @@
+import asyncio
+import inspect
+import mmap
 import os
+import pickle
+import random
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from copy import copy
 
-from funcy import wraps
+from django.core.exceptions import ImproperlyConfigured
+from funcy import constantly, wraps, chunks
 
 from .conf import settings
 from .utils import get_cache_key, cached_view_fab, md5hex
 from .redis import redis_client, handle_connection_failure
+from .redis import async_redis_client, handle_async_connection_failure
+from .getset import reading, areading, LOCK, LOCK_TIMEOUT
 from .sharding import get_prefix
+from .local import LocalCache
 
+try:
+    import fcntl
+except ImportError:
+    # Windows, file cache doesn't lock there
+    fcntl = None
 
-__all__ = ('cache', 'cached', 'cached_view', 'file_cache', 'CacheMiss', 'FileCache', 'RedisCache')
+
+__all__ = ('cache', 'cached', 'cached_view', 'file_cache', 'tiered_cache',
+           'CacheMiss', 'FileCache', 'RedisCache', 'TieredCache')
 
 
 class CacheMiss(Exception):
@@ -17,17 +38,21 @@ class CacheMiss(Exception):
 
 class CacheKey(str):
     @classmethod
-    def make(cls, value, cache=None, timeout=None):
+    def make(cls, value, cache=None, timeout=None, stale=None):
         self = CacheKey(value)
         self.cache = cache
         self.timeout = timeout
+        self.stale = stale if timeout is not None else None
         return self
 
     def get(self):
-        self.cache._get(self)
+        return self.cache._get(self)
 
     def set(self, value):
-        self.cache._set(self, value, self.timeout)
+        if self.stale:
+            self.cache._set_fresh(self, value, self.timeout, self.stale)
+        else:
+            self.cache._set(self, value, self.timeout)
 
     def delete(self):
         self.cache._delete(self)
@@ -36,39 +61,98 @@ class BaseCache(object):
     """
     Simple cache with time-based invalidation
     """
-    def cached(self, timeout=None, extra=None):
+    _serves_stale = False
+    _locks_async = False
+
+    def cached(self, timeout=None, extra=None, lock=False, stale=None):
         """
-        A decorator for caching function calls
+        A decorator for caching function calls, coroutine functions are awaited
+
+        Pass lock=True to compute a missing value once, while other callers wait for it.
+        Pass stale=seconds to keep values longer than timeout and serve them while
+        a single caller recomputes the expired one.
         """
         # Support @cached (without parentheses) form
         if callable(timeout):
             return self.cached()(timeout)
+        if stale and not self._serves_stale:
+            raise ImproperlyConfigured("%s can't serve stale data" % self.__class__.__name__)
 
         def _get_key(func, args, kwargs):
             extra_val = extra(*args, **kwargs) if callable(extra) else extra
             return get_prefix(func=func) + 'c:' + get_cache_key(func, args, kwargs, extra_val)
 
         def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                return async_decorator(func)
+
             @wraps(func)
             def wrapper(*args, **kwargs):
                 if not settings.CACHEOPS_ENABLED:
                     return func(*args, **kwargs)
 
                 cache_key = _get_key(func, args, kwargs)
-                try:
-                    result = self._get(cache_key)
-                except CacheMiss:
-                    result = func(*args, **kwargs)
-                    self._set(cache_key, result, timeout)
+                return self._fetch(cache_key, lambda: func(*args, **kwargs), timeout,
+                                   lock=lock, stale=stale)
 
-                return result
+            def invalidate(*args, **kwargs):
+                self._delete(_get_key(func, args, kwargs))
+            wrapper.invalidate = invalidate
+
+            def key(*args, **kwargs):
+                return CacheKey.make(_get_key(func, args, kwargs), cache=self, timeout=timeout,
+                                     stale=stale)
+            wrapper.key = key
+
+            def get_many(arg_tuples, workers=None):
+                """
+                Returns a list of results for tuples of args, reading and writing cache in batches.
+                Misses are computed in a thread pool if number of workers is passed.
+                """
+                arg_tuples = list(arg_tuples)
+                if not settings.CACHEOPS_ENABLED:
+                    return [func(*args) for args in arg_tuples]
+
+                cache_keys = [_get_key(func, args, {}) for args in arg_tuples]
+                results = self._get_many(cache_keys)
+                misses = {key: args for key, args in zip(cache_keys, arg_tuples)
+                          if key not in results}
+                if misses:
+                    if workers:
+                        with ThreadPoolExecutor(workers) as executor:
+                            computed = executor.map(lambda args: func(*args), misses.values())
+                            computed = dict(zip(misses, computed))
+                    else:
+                        computed = {key: func(*args) for key, args in misses.items()}
+                    self._fill_many(computed, timeout, stale=stale)
+                    results.update(computed)
+                return [results[key] for key in cache_keys]
+            wrapper.get_many = get_many
+
+            return wrapper
+
+        def async_decorator(func):
+            if (lock or stale) and not self._locks_async:
+                raise ImproperlyConfigured(
+                    "%s can't lock or serve stale data for coroutine functions"
+                    % self.__class__.__name__)
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not settings.CACHEOPS_ENABLED:
+                    return await func(*args, **kwargs)
+
+                cache_key = _get_key(func, args, kwargs)
+                return await self._afetch(cache_key, lambda: func(*args, **kwargs), timeout,
+                                          lock=lock, stale=stale)
 
             def invalidate(*args, **kwargs):
                 self._delete(_get_key(func, args, kwargs))
             wrapper.invalidate = invalidate
 
             def key(*args, **kwargs):
-                return CacheKey.make(_get_key(func, args, kwargs), cache=self, timeout=timeout)
+                return CacheKey.make(_get_key(func, args, kwargs), cache=self, timeout=timeout,
+                                     stale=stale)
             wrapper.key = key
 
             return wrapper
@@ -88,18 +172,176 @@ class BaseCache(object):
     def delete(self, cache_key):
         self._delete(get_prefix() + cache_key)
 
+    def get_many(self, cache_keys):
+        """
+        Returns a dict of found cache keys and their values, missing ones are skipped
+        """
+        prefix = get_prefix()
+        found = self._get_many([prefix + key for key in cache_keys])
+        return {key: found[prefix + key] for key in cache_keys if prefix + key in found}
+
+    def set_many(self, mapping, timeout=None):
+        prefix = get_prefix()
+        self._set_many({prefix + key: data for key, data in mapping.items()}, timeout)
+
+    def delete_many(self, cache_keys):
+        prefix = get_prefix()
+        self._delete_many([prefix + key for key in cache_keys])
+
+    def _fetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        """
+        Returns cached value or computes, caches and returns it
+        """
+        try:
+            return self._get(cache_key)
+        except CacheMiss:
+            result = compute()
+            self._fill(cache_key, result, timeout)
+            return result
+
+    async def _afetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        """
+        Same as _fetch(), but compute() returns an awaitable
+        """
+        try:
+            return self._get(cache_key)
+        except CacheMiss:
+            result = await compute()
+            self._fill(cache_key, result, timeout)
+            return result
+
+    # Fills store computed values, which replace nothing callers might have seen,
+    # unlike explicit sets. Caches telling others about sets override these.
+
+    def _fill(self, cache_key, data, timeout, stale=None):
+        self._set(cache_key, data, timeout)
+
+    def _fill_many(self, mapping, timeout, stale=None):
+        self._set_many(mapping, timeout, stale=stale)
+
+    # Caches able to do better in batches override these
+
+    def _get_many(self, cache_keys):
+        found = {}
+        for cache_key in cache_keys:
+            try:
+                found[cache_key] = self._get(cache_key)
+            except CacheMiss:
+                pass
+        return found
+
+    def _set_many(self, mapping, timeout=None, stale=None):
+        for cache_key, data in mapping.items():
+            self._set(cache_key, data, timeout)
+
+    def _delete_many(self, cache_keys):
+        for cache_key in cache_keys:
+            self._delete(cache_key)
+
 
 class RedisCache(BaseCache):
-    def __init__(self, conn):
+    """
+    Redis cache, coroutine functions are cached via async_conn if passed, it could be
+    a redis.asyncio client or a callable returning one for the running event loop.
+    """
+    _serves_stale = True
+
+    def __init__(self, conn, async_conn=None):
         self.conn = conn
         self._conn_get = handle_connection_failure(conn.get)
+        self._conn_mget = handle_connection_failure(conn.mget)
+        if async_conn is not None and not callable(async_conn):
+            async_conn = constantly(async_conn)
+        self._async_conn = async_conn
+
+    @property
+    def _locks_async(self):
+        # Sync client would block event loop while waiting
+        return self._async_conn is not None
 
     def _get(self, cache_key):
         data = self._conn_get(cache_key)
-        if data is None:
+        if data is None or data == LOCK:
             raise CacheMiss
         return settings.CACHEOPS_SERIALIZER.loads(data)
 
+    def _fetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        stale = stale if timeout is not None else None
+        if stale:
+            data, fresh = self._conn_mget([cache_key, cache_key + FRESH_SUFFIX]) or (None, None)
+            if data is not None and data != LOCK:
+                # Only one caller gets to refresh stale data, others are served it meanwhile
+                if fresh is not None or not self._lock_refresh(cache_key):
+                    return settings.CACHEOPS_SERIALIZER.loads(data)
+                try:
+                    result = compute()
+                except BaseException:
+                    self._delete(cache_key + FRESH_SUFFIX)
+                    raise
+                self._fill(cache_key, result, timeout, stale)
+                return result
+
+        with reading(cache_key, lambda: self._conn_get(cache_key), lock=lock,
+                     conn=self.conn) as data:
+            if data is not None and data != LOCK:
+                return settings.CACHEOPS_SERIALIZER.loads(data)
+            result = compute()
+            self._fill(cache_key, result, timeout, stale)
+            return result
+
+    async def _afetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        if self._async_conn is None:
+            # Coroutine functions with lock or stale are refused then, see BaseCache.cached()
+            return await super()._afetch(cache_key, compute, timeout)
+
+        stale = stale if timeout is not None else None
+        if stale:
+            data, fresh = await self._aconn_mget([cache_key, cache_key + FRESH_SUFFIX]) \
+                or (None, None)
+            if data is not None and data != LOCK:
+                if fresh is not None or not await self._alock_refresh(cache_key):
+                    return settings.CACHEOPS_SERIALIZER.loads(data)
+                try:
+                    result = await compute()
+                except BaseException:
+                    await self._adelete(cache_key + FRESH_SUFFIX)
+                    raise
+                await self._afill(cache_key, result, timeout, stale)
+                return result
+
+        async with areading(cache_key, lambda: self._aconn_get(cache_key), lock=lock,
+                            conn=self._async_conn()) as data:
+            if data is not None and data != LOCK:
+                return settings.CACHEOPS_SERIALIZER.loads(data)
+            result = await compute()
+            await self._afill(cache_key, result, timeout, stale)
+            return result
+
+    def _fill(self, cache_key, data, timeout, stale=None):
+        if stale:
+            self._set_fresh(cache_key, data, timeout, stale)
+        else:
+            self._set(cache_key, data, timeout)
+
+    async def _afill(self, cache_key, data, timeout, stale=None):
+        if stale:
+            await self._aset_fresh(cache_key, data, timeout, stale)
+        else:
+            await self._aset(cache_key, data, timeout)
+
+    @handle_connection_failure
+    def _lock_refresh(self, cache_key):
+        return self.conn.set(cache_key + FRESH_SUFFIX, LOCK, nx=True, ex=LOCK_TIMEOUT)
+
+    @handle_connection_failure
+    def _set_fresh(self, cache_key, data, timeout, stale):
+        """Stores data for timeout + stale seconds and marks it fresh for timeout ones"""
+        pickled_data = settings.CACHEOPS_SERIALIZER.dumps(data)
+        with self.conn.pipeline(transaction=False) as pipe:
+            pipe.setex(cache_key, timeout + stale, pickled_data)
+            pipe.setex(cache_key + FRESH_SUFFIX, timeout, 1)
+            pipe.execute()
+
     @handle_connection_failure
     def _set(self, cache_key, data, timeout=None):
         pickled_data = settings.CACHEOPS_SERIALIZER.dumps(data)
@@ -112,20 +354,266 @@ class RedisCache(BaseCache):
     def _delete(self, cache_key):
         self.conn.delete(cache_key)
 
-cache = RedisCache(redis_client)
+    # Async counterparts of the above
+
+    @handle_async_connection_failure
+    async def _aconn_get(self, cache_key):
+        return await self._async_conn().get(cache_key)
+
+    @handle_async_connection_failure
+    async def _aconn_mget(self, cache_keys):
+        return await self._async_conn().mget(cache_keys)
+
+    @handle_async_connection_failure
+    async def _alock_refresh(self, cache_key):
+        return await self._async_conn().set(cache_key + FRESH_SUFFIX, LOCK, nx=True,
+                                            ex=LOCK_TIMEOUT)
+
+    @handle_async_connection_failure
+    async def _aset_fresh(self, cache_key, data, timeout, stale):
+        pickled_data = settings.CACHEOPS_SERIALIZER.dumps(data)
+        async with self._async_conn().pipeline(transaction=False) as pipe:
+            pipe.setex(cache_key, timeout + stale, pickled_data)
+            pipe.setex(cache_key + FRESH_SUFFIX, timeout, 1)
+            await pipe.execute()
+
+    @handle_async_connection_failure
+    async def _aset(self, cache_key, data, timeout=None):
+        pickled_data = settings.CACHEOPS_SERIALIZER.dumps(data)
+        if timeout is not None:
+            await self._async_conn().setex(cache_key, timeout, pickled_data)
+        else:
+            await self._async_conn().set(cache_key, pickled_data)
+
+    @handle_async_connection_failure
+    async def _adelete(self, cache_key):
+        await self._async_conn().delete(cache_key)
+
+    def _get_many(self, cache_keys):
+        coded = self._conn_mget(cache_keys) if cache_keys else None
+        # Keys locked while computed are misses too
+        return {cache_key: settings.CACHEOPS_SERIALIZER.loads(data)
+                for cache_key, data in zip(cache_keys, coded or [])
+                if data is not None and data != LOCK}
+
+    @handle_connection_failure
+    def _set_many(self, mapping, timeout=None, stale=None):
+        with self.conn.pipeline(transaction=False) as pipe:
+            for cache_key, data in mapping.items():
+                pickled_data = settings.CACHEOPS_SERIALIZER.dumps(data)
+                if timeout is None:
+                    pipe.set(cache_key, pickled_data)
+                elif stale:
+                    pipe.setex(cache_key, timeout + stale, pickled_data)
+                    pipe.setex(cache_key + FRESH_SUFFIX, timeout, 1)
+                else:
+                    pipe.setex(cache_key, timeout, pickled_data)
+            pipe.execute()
+
+    @handle_connection_failure
+    def _delete_many(self, cache_keys):
+        if cache_keys:
+            self.conn.delete(*cache_keys)
+
+FRESH_SUFFIX = ':fresh'
+
+cache = RedisCache(redis_client, async_conn=async_redis_client)
 cached = cache.cached
 cached_view = cache.cached_view
 
 
+class TieredCache(RedisCache):
+    """
+    Redis cache with a bounded in-process LRU in front of it, for small values read often.
+
+    Values are kept locally for local_timeout seconds at most, which could be overridden
+    per decorated function. Explicit sets and deletes are propagated to other processes via
+    pub/sub, local cache is only used while we listen to those. Cached values are shared between
+    callers in a process, so they should not be mutated. View responses are an exception,
+    these are kept pickled and each hit gets its own copy.
+    """
+    _local_pickled = False
+
+    def __init__(self, conn, local_timeout=60, maxsize=1000, async_conn=None):
+        super().__init__(conn, async_conn=async_conn)
+        self._local_timeout = local_timeout
+        self._local = LocalCache(channel=TIERED_CHANNEL, maxsize=maxsize, conn=conn)
+
+    def cached(self, timeout=None, extra=None, lock=False, stale=None, local_timeout=None):
+        if callable(timeout):
+            return self.cached()(timeout)
+        return BaseCache.cached(self._with_local_timeout(local_timeout), timeout, extra,
+                                lock=lock, stale=stale)
+
+    def cached_view(self, timeout=None, extra=None, local_timeout=None):
+        if callable(timeout):
+            return self.cached_view()(timeout)
+        # Responses are changed by middleware, so each request should get its own copy
+        return BaseCache.cached_view(self._with_local_timeout(local_timeout, pickled=True),
+                                     timeout, extra)
+
+    def _with_local_timeout(self, local_timeout, pickled=False):
+        if local_timeout is None and not pickled:
+            return self
+        # Shares connection and local cache
+        clone = copy(self)
+        if local_timeout is not None:
+            clone._local_timeout = local_timeout
+        clone._local_pickled = pickled
+        return clone
+
+    def _local_get(self, cache_key):
+        data = self._local.get(cache_key)
+        return settings.CACHEOPS_SERIALIZER.loads(data) if self._local_pickled else data
+
+    def _local_stamp(self, cache_key):
+        return self._local.stamp((cache_key,))
+
+    def _local_set(self, cache_key, data, stamp):
+        if self._local_pickled:
+            data = settings.CACHEOPS_SERIALIZER.dumps(data)
+        self._local.set(cache_key, data, self._local_timeout, (cache_key,), stamp)
+
+    def _get(self, cache_key):
+        if not self._local.active():
+            return super()._get(cache_key)
+        try:
+            return self._local_get(cache_key)
+        except KeyError:
+            stamp = self._local_stamp(cache_key)
+            data = super()._get(cache_key)
+            self._local_set(cache_key, data, stamp)
+            return data
+
+    def _get_many(self, cache_keys):
+        if not self._local.active():
+            return super()._get_many(cache_keys)
+        found = {}
+        for cache_key in cache_keys:
+            try:
+                found[cache_key] = self._local_get(cache_key)
+            except KeyError:
+                pass
+        stamps = {key: self._local_stamp(key) for key in cache_keys if key not in found}
+        fetched = super()._get_many(list(stamps))
+        for cache_key, data in fetched.items():
+            self._local_set(cache_key, data, stamps[cache_key])
+        found.update(fetched)
+        return found
+
+    def _fetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        if not self._local.active():
+            return super()._fetch(cache_key, compute, timeout, lock=lock, stale=stale)
+        try:
+            return self._local_get(cache_key)
+        except KeyError:
+            stamp = self._local_stamp(cache_key)
+            data = super()._fetch(cache_key, compute, timeout, lock=lock, stale=stale)
+            self._local_set(cache_key, data, stamp)
+            return data
+
+    async def _afetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        if not self._local.active():
+            return await super()._afetch(cache_key, compute, timeout, lock=lock, stale=stale)
+        try:
+            return self._local_get(cache_key)
+        except KeyError:
+            stamp = self._local_stamp(cache_key)
+            data = await super()._afetch(cache_key, compute, timeout, lock=lock, stale=stale)
+            self._local_set(cache_key, data, stamp)
+            return data
+
+    # Filled values are not announced, other processes might only have missed these
+    # or have them expired, and keep their local copies for local_timeout at most
+
+    def _fill(self, cache_key, data, timeout, stale=None):
+        if stale:
+            super()._set_fresh(cache_key, data, timeout, stale)
+        else:
+            super()._set(cache_key, data, timeout)
+
+    async def _afill(self, cache_key, data, timeout, stale=None):
+        if stale:
+            await super()._aset_fresh(cache_key, data, timeout, stale)
+        else:
+            await super()._aset(cache_key, data, timeout)
+
+    def _fill_many(self, mapping, timeout, stale=None):
+        super()._set_many(mapping, timeout, stale=stale)
+
+    def _set(self, cache_key, data, timeout=None):
+        super()._set(cache_key, data, timeout)
+        self._invalidate_local([cache_key])
+
+    def _set_fresh(self, cache_key, data, timeout, stale):
+        super()._set_fresh(cache_key, data, timeout, stale)
+        self._invalidate_local([cache_key])
+
+    def _set_many(self, mapping, timeout=None, stale=None):
+        super()._set_many(mapping, timeout, stale=stale)
+        self._invalidate_local(list(mapping))
+
+    def _delete(self, cache_key):
+        super()._delete(cache_key)
+        self._invalidate_local([cache_key])
+
+    def _delete_many(self, cache_keys):
+        super()._delete_many(cache_keys)
+        self._invalidate_local(cache_keys)
+
+    @handle_connection_failure
+    def _invalidate_local(self, cache_keys):
+        with self.conn.pipeline(transaction=False) as pipe:
+            for cache_key in cache_keys:
+                self._local.invalidate(cache_key)
+                pipe.publish(self._local.channel, cache_key)
+            pipe.execute()
+
+    async def _aset(self, cache_key, data, timeout=None):
+        await super()._aset(cache_key, data, timeout)
+        await self._ainvalidate_local([cache_key])
+
+    async def _aset_fresh(self, cache_key, data, timeout, stale):
+        await super()._aset_fresh(cache_key, data, timeout, stale)
+        await self._ainvalidate_local([cache_key])
+
+    async def _adelete(self, cache_key):
+        await super()._adelete(cache_key)
+        await self._ainvalidate_local([cache_key])
+
+    @handle_async_connection_failure
+    async def _ainvalidate_local(self, cache_keys):
+        async with self._async_conn().pipeline(transaction=False) as pipe:
+            for cache_key in cache_keys:
+                self._local.invalidate(cache_key)
+                pipe.publish(self._local.channel, cache_key)
+            await pipe.execute()
+
+TIERED_CHANNEL = 'cacheops:tiered'
+
+tiered_cache = TieredCache(redis_client, async_conn=async_redis_client)
+
 class FileCache(BaseCache):
     """
     A file cache which fixes bugs and misdesign in django default one.
     Uses mtimes in the future to designate expire time. This makes unnecessary
     reading stale files.
+
+    Size could be limited by max_size in bytes and/or max_entries, least recently used
+    entries are evicted then, judging by atimes of a sample of subdirectories.
     """
-    def __init__(self, path, timeout=settings.FILE_CACHE_TIMEOUT):
+    _locks_async = True
+
+    def __init__(self, path, timeout=settings.FILE_CACHE_TIMEOUT, max_size=None,
+                 max_entries=None):
         self._dir = path
         self._default_timeout = timeout
+        self._max_size = max_size
+        self._max_entries = max_entries
+        # Other processes write here too, so we rescan occasionally
+        self._usage = None  # [size, entries]
+        self._usage_time = -USAGE_RESCAN_INTERVAL
+        self._lock = threading.Lock()
 
     def _key_to_filename(self, key):
         """
@@ -137,13 +625,21 @@ class FileCache(BaseCache):
     def _get(self, key):
         filename = self._key_to_filename(key)
         try:
-            # Remove file if it's stale
-            if time.time() >= os.stat(filename).st_mtime:
-                self.delete(filename)
-                raise CacheMiss
-
             with open(filename, 'rb') as f:
-                return settings.CACHEOPS_SERIALIZER.load(f)
+                stat = os.fstat(f.fileno())
+                # Remove file if it's stale
+                if time.time() >= stat.st_mtime:
+                    self._remove(filename)
+                    raise CacheMiss
+                if not stat.st_size:
+                    raise CacheMiss
+
+                # Unpickle right from mapped pages, not copying file contents first,
+                # other serializers might not accept anything but bytes
+                if settings.CACHEOPS_SERIALIZER is not pickle:
+                    return settings.CACHEOPS_SERIALIZER.loads(f.read())
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    return pickle.loads(buf)
         except (IOError, OSError, EOFError):
             raise CacheMiss
 
@@ -155,22 +651,106 @@ class FileCache(BaseCache):
             timeout = self._default_timeout
 
         try:
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
+            os.makedirs(dirname, exist_ok=True)
 
-            # Use open with exclusive rights to prevent data corruption
-            f = os.open(filename, os.O_EXCL | os.O_WRONLY | os.O_CREAT)
+            # Write to a temporary file and then move it in place, so that readers never see
+            # a partially written file and an existing one is overwritten atomically.
+            # Temporary files left by crashes are removed by cleanfilecache.
+            tmp_filename = '%s.%s%s' % (filename, os.urandom(4).hex(), TMP_SUFFIX)
+            fd = os.open(tmp_filename, os.O_EXCL | os.O_WRONLY | os.O_CREAT)
             try:
-                os.write(f, settings.CACHEOPS_SERIALIZER.dumps(data))
-            finally:
-                os.close(f)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(settings.CACHEOPS_SERIALIZER.dumps(data))
+                    size = f.tell()
+
+                # Set mtime to expire time, atime is used to evict least recently used
+                now = time.time()
+                os.utime(tmp_filename, (now, now + timeout))
+                replaced = self._is_limited() and _file_size(filename)
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                self._remove(tmp_filename)
+                raise
+        except (IOError, OSError):
+            return
+
+        if self._is_limited():
+            self._update_usage(size - (replaced or 0), 0 if replaced is not None else 1)
+
+    def _fetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        if not lock:
+            return super()._fetch(cache_key, compute, timeout)
+        try:
+            return self._get(cache_key)
+        except CacheMiss:
+            pass
+        # Processes on this host wait for the one holding the lock and then read what it wrote
+        with self._file_lock(self._key_to_filename(cache_key)):
+            return super()._fetch(cache_key, compute, timeout)
 
-            # Set mtime to expire time
-            os.utime(filename, (0, time.time() + timeout))
+    async def _afetch(self, cache_key, compute, timeout, lock=False, stale=None):
+        if not lock:
+            return await super()._afetch(cache_key, compute, timeout)
+        try:
+            return self._get(cache_key)
+        except CacheMiss:
+            pass
+        async with self._afile_lock(self._key_to_filename(cache_key)):
+            return await super()._afetch(cache_key, compute, timeout)
+
+    @contextmanager
+    def _file_lock(self, filename):
+        fd = self._open_lock(filename)
+        if fd is None:
+            # Can't lock, just compute it then
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            self._close_lock(filename, fd)
+
+    @asynccontextmanager
+    async def _afile_lock(self, filename):
+        """Same as _file_lock(), but polls the lock not to block event loop"""
+        fd = self._open_lock(filename)
+        if fd is None:
+            yield
+            return
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(LOCK_POLL_INTERVAL)
+            yield
+        finally:
+            self._close_lock(filename, fd)
+
+    def _open_lock(self, filename):
+        if fcntl is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            return os.open(filename + LOCK_SUFFIX, os.O_WRONLY | os.O_CREAT)
         except (IOError, OSError):
+            return None
+
+    def _close_lock(self, filename, fd):
+        # Whoever waits on this lock file rechecks cache after getting it,
+        # so it's safe to remove it before unlocking
+        try:
+            os.remove(filename + LOCK_SUFFIX)
+        except OSError:
             pass
+        os.close(fd)
+
+    def _delete(self, key):
+        self._remove(self._key_to_filename(key))
 
-    def _delete(self, fname):
+    def _remove(self, fname):
         try:
             os.remove(fname)
             # Trying to remove directory in case it's empty
@@ -179,4 +759,168 @@ class FileCache(BaseCache):
         except (IOError, OSError):
             pass
 
-file_cache = FileCache(settings.FILE_CACHE_DIR)
+    # Size limits
+
+    def _is_limited(self):
+        return self._max_size is not None or self._max_entries is not None
+
+    def _is_over(self, size, entries, ratio=1):
+        return self._max_size is not None and size > self._max_size * ratio \
+            or self._max_entries is not None and entries > self._max_entries * ratio
+
+    def _update_usage(self, size, entries):
+        with self._lock:
+            rescan = time.monotonic() - self._usage_time > USAGE_RESCAN_INTERVAL
+            if rescan:
+                # Only one thread rescans, others go on with the old estimate meanwhile
+                self._usage_time = time.monotonic()
+            elif self._usage is not None:
+                self._usage[0] += size
+                self._usage[1] += entries
+
+        if rescan:
+            usage = self._estimate_usage()
+            with self._lock:
+                self._usage = usage
+
+        with self._lock:
+            if self._usage is not None and self._is_over(*self._usage):
+                self._evict()
+
+    def _estimate_usage(self):
+        """
+        Files are spread evenly by hash, so we scan a sample of subdirectories
+        and extrapolate to all of them.
+        """
+        subdirs = self._subdirs()
+        sample = random.sample(subdirs, min(USAGE_SAMPLE, len(subdirs)))
+        size, entries = [sum(x) for x in zip(*map(self._scan, sample))] or [0, 0]
+        ratio = len(subdirs) / len(sample) if sample else 0
+        return [size * ratio, entries * ratio]
+
+    def _evict(self):
+        """
+        Evicts least recently used entries from random subdirs until we are a bit below limits,
+        this way we won't need to do this on each write.
+        """
+        subdirs = self._subdirs()
+        random.shuffle(subdirs)
+        for sample in chunks(EVICTION_SAMPLE, subdirs):
+            entries = [entry for subdir in sample for entry in self._entries(subdir)]
+            for _, _, path, size in sorted(entries):
+                self._remove(path)
+                self._usage[0] -= size
+                self._usage[1] -= 1
+                if not self._is_over(*self._usage, ratio=EVICTION_TARGET):
+                    return
+
+    def _subdirs(self):
+        try:
+            return [entry.path for entry in os.scandir(self._dir) if entry.is_dir()]
+        except OSError:
+            return []
+
+    def _entries(self, subdir):
+        """
+        Yields (is alive, atime, path, size) for each entry in a subdir,
+        expired ones are sorted first and then least recently used.
+        """
+        now = time.time()
+        try:
+            with os.scandir(subdir) as it:
+                for entry in it:
+                    if entry.name.endswith(AUX_SUFFIXES):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    yield stat.st_mtime > now, stat.st_atime, entry.path, stat.st_size
+        except OSError:
+            pass
+
+    def _scan(self, subdir):
+        size = entries = 0
+        for _, _, _, entry_size in self._entries(subdir):
+            size += entry_size
+            entries += 1
+        return size, entries
+
+    def clean(self, workers=1):
+        """
+        Removes expired entries and temporary files left by crashed writes,
+        then evicts least recently used entries to fit size limits if any.
+        Subdirectories are processed by several threads if workers > 1.
+
+        Returns a dict with number of removed files and reclaimed bytes.
+        """
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(self._clean_subdir, self._subdirs()))
+
+        stats = Counter(files=0, bytes=0)
+        alive = []
+        for subdir_stats, subdir_alive in results:
+            stats.update(subdir_stats)
+            alive.extend(subdir_alive)
+
+        if self._is_limited():
+            usage = [sum(entry[3] for entry in alive), len(alive)]
+            for _, _, path, size in sorted(alive):
+                if not self._is_over(*usage):
+                    break
+                self._remove(path)
+                usage[0] -= size
+                usage[1] -= 1
+                stats.update(files=1, bytes=size)
+            with self._lock:
+                self._usage, self._usage_time = usage, time.monotonic()
+        return dict(stats)
+
+    def _clean_subdir(self, subdir):
+        now = time.time()
+        stats = Counter()
+        alive = []
+        try:
+            with os.scandir(subdir) as it:
+                entries = list(it)
+        except OSError:
+            # Removed concurrently when became empty
+            return stats, alive
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(AUX_SUFFIXES):
+                # Could be still being written or locked, temporary files get expiry mtime
+                # right before rename
+                expired = stat.st_mtime < now - TMP_TIMEOUT
+            else:
+                expired = stat.st_mtime <= now
+            if expired:
+                self._remove(entry.path)
+                stats.update(files=1, bytes=stat.st_size)
+            elif not entry.name.endswith(AUX_SUFFIXES):
+                alive.append((True, stat.st_atime, entry.path, stat.st_size))
+        return stats, alive
+
+
+TMP_SUFFIX = '.tmp'
+LOCK_SUFFIX = '.lock'
+AUX_SUFFIXES = (TMP_SUFFIX, LOCK_SUFFIX)
+TMP_TIMEOUT = 60
+LOCK_POLL_INTERVAL = 0.05
+USAGE_RESCAN_INTERVAL = 60
+USAGE_SAMPLE = 16
+EVICTION_SAMPLE = 16
+EVICTION_TARGET = 0.9
+
+
+def _file_size(filename):
+    try:
+        return os.stat(filename).st_size
+    except OSError:
+        return None
+
+file_cache = FileCache(settings.FILE_CACHE_DIR, max_size=settings.FILE_CACHE_MAX_SIZE,
+                       max_entries=settings.FILE_CACHE_MAX_ENTRIES)
@@ -0,0 +1,169 @@
+import heapq
+import logging
+from collections import Counter, defaultdict
+
+from django.db import DEFAULT_DB_ALIAS
+from funcy import chunks
+
+from .conf import settings
+from .reaper import _throttler
+from .redis import redis_client
+from .sharding import get_prefix
+
+__all__ = ('keyspace_stats',)
+
+logger = logging.getLogger(__name__)
+
+KEY_TYPES = {'q', 'as', 'c', 'conj', 'conjs', 'schemes', 'schemes_version', 'gen'}
+TABLE_KEY_TYPES = {'conj', 'conjs', 'schemes', 'schemes_version', 'gen'}
+TTL_BUCKETS = [(60, '<1m'), (600, '<10m'), (3600, '<1h'), (86400, '<1d')]
+TTL_LABELS = ['persistent'] + [label for _, label in TTL_BUCKETS] + ['>=1d']
+
+
+def keyspace_stats(
+    using=DEFAULT_DB_ALIAS,
+    top: int = 10,
+    limit: int = None,
+    dead_sample: int = 100,
+    chunk_size: int = 1000,
+    max_ops: int = None,
+):
+    """
+    Samples cacheops keyspace and reports how it's used.
+
+    Keys are SCANned in chunks, each looked up for its memory usage and TTL, conj keys are
+    also checked for their size and a share of dead members, i.e. cache keys already expired.
+    For sorted conjs the latter is exact, for plain ones it's estimated from dead_sample
+    random members of each conj set, insideout conj keys have no members.
+    Stops after limit keys if passed, load on redis could be capped with max_ops per second.
+
+    Returns a dict with number of scanned keys, stats by key type: q, as, c, conj, etc.,
+    and stats by table: number of schemes, conj keys and their members, estimated dead ratio,
+    top largest conjs, memory used and TTL distribution of conj keys.
+    """
+    prefix = get_prefix(dbs=[using])
+    throttle = _throttler(max_ops)
+    now = redis_client.time()[0]
+
+    scanned = 0
+    types = defaultdict(lambda: {'keys': 0, 'bytes': 0, 'ttl': Counter()})
+    tables = defaultdict(lambda: {'schemes': 0, 'conj_keys': 0, 'members': 0, 'dead': 0,
+                                  'bytes': 0, 'ttl': Counter(), 'top_conjs': []})
+
+    keys = redis_client.scan_iter(match=prefix + '*', count=chunk_size)
+    for chunk in chunks(chunk_size, keys):
+        if limit is not None:
+            chunk = chunk[:limit - scanned]
+        scanned += len(chunk)
+        parsed = [_parse_key(prefix, key) for key in chunk]
+        conj_keys = [key for key, (key_type, _) in zip(chunk, parsed) if key_type == 'conj']
+
+        with redis_client.pipeline(transaction=False) as pipe:
+            for key, (key_type, _) in zip(chunk, parsed):
+                pipe.memory_usage(key)
+                pipe.ttl(key)
+                if key_type == 'schemes':
+                    pipe.scard(key)
+            res = iter(pipe.execute())
+        throttle(len(chunk) * 2)
+
+        for key, (key_type, table) in zip(chunk, parsed):
+            size, ttl = next(res), next(res)
+            count = next(res) if key_type == 'schemes' else None
+            if ttl == -2:
+                # Expired or deleted while we were looking
+                continue
+            stats = types[key_type]
+            stats['keys'] += 1
+            stats['bytes'] += size or 0
+            stats['ttl'][_ttl_bucket(ttl)] += 1
+            if table is not None:
+                tables[table]['bytes'] += size or 0
+                if key_type == 'conj':
+                    tables[table]['conj_keys'] += 1
+                    tables[table]['ttl'][_ttl_bucket(ttl)] += 1
+                elif key_type == 'schemes':
+                    tables[table]['schemes'] = count
+
+        for key, members, dead in _conj_sizes(conj_keys, now, dead_sample, throttle):
+            table_stats = tables[_parse_key(prefix, key)[1]]
+            table_stats['members'] += members
+            table_stats['dead'] += dead
+            _push_top(table_stats['top_conjs'], top, (members, key.decode()))
+
+        if limit is not None and scanned >= limit:
+            break
+    logger.info('Scanned %s keys', scanned)
+
+    for stats in tables.values():
+        dead = stats.pop('dead')
+        stats['dead_ratio'] = round(dead / stats['members'], 3) if stats['members'] else None
+        stats['top_conjs'] = [[key, size] for size, key in sorted(stats['top_conjs'],
+                                                                  reverse=True)]
+    return {
+        'keys': scanned,
+        'types': dict(types),
+        'tables': dict(sorted(tables.items())),
+    }
+
+
+def _parse_key(prefix, key):
+    """Returns key type and table it belongs to if any"""
+    key_type, _, rest = key.decode()[len(prefix):].partition(':')
+    if key_type not in KEY_TYPES:
+        return 'other', None
+    table = rest.split(':', 1)[0] if key_type in TABLE_KEY_TYPES and rest else None
+    return key_type, table
+
+
+def _conj_sizes(conj_keys, now, dead_sample, throttle):
+    """Yields conj keys with numbers of their members and estimated dead ones"""
+    if settings.CACHEOPS_INSIDEOUT or not conj_keys:
+        # Conj keys are just stamps here
+        return
+
+    with redis_client.pipeline(transaction=False) as pipe:
+        for key in conj_keys:
+            if settings.CACHEOPS_SORTED_CONJS:
+                pipe.zcard(key)
+                pipe.zcount(key, '-inf', '(%d' % now)
+            else:
+                pipe.scard(key)
+                pipe.srandmember(key, dead_sample)
+        res = pipe.execute()
+    throttle(len(conj_keys) * 2)
+
+    if settings.CACHEOPS_SORTED_CONJS:
+        yield from zip(conj_keys, res[::2], res[1::2])
+        return
+
+    # Check how many of sampled members are gone
+    sizes, samples = res[::2], res[1::2]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for sample in samples:
+            if sample:
+                pipe.exists(*sample)
+        alive = iter(pipe.execute())
+    throttle(len(conj_keys))
+
+    for key, size, sample in zip(conj_keys, sizes, samples):
+        if not sample:
+            yield key, size, 0
+        else:
+            yield key, size, round(size * (1 - next(alive) / len(sample)))
+
+
+def _push_top(heap, n, item):
+    if len(heap) < n:
+        heapq.heappush(heap, item)
+    elif n:
+        heapq.heappushpop(heap, item)
+
+
+def _ttl_bucket(ttl):
+    if ttl < 0:
+        return 'persistent'
+    for limit, label in TTL_BUCKETS:
+        if ttl < limit:
+            return label
+    return '>=1d'
@@ -1,12 +1,15 @@
+import re
 import threading
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
-from funcy import once, decorator
+from funcy import once, decorator, memoize, group_by
 
+from django.apps import apps
 from django.db import DEFAULT_DB_ALIAS, DatabaseError
 from django.db.backends.utils import CursorWrapper
 from django.db.transaction import Atomic, get_connection, on_commit
 
+from .conf import settings
 from .utils import monkey_mix
 
 
@@ -16,18 +19,26 @@ __all__ = ('queue_when_in_transaction', 'install_cacheops_transaction_support',
 
 class TransactionState(list):
     def begin(self):
-        self.append({'cbs': [], 'dirty': False})
+        self.append({'cbs': [], 'batches': {}, 'dirty': False, 'dirty_tables': set(),
+                     'results': OrderedDict()})
 
     def commit(self):
         context = self.pop()
         if self:
             # savepoint
             self[-1]['cbs'].extend(context['cbs'])
+            for func, items in context['batches'].items():
+                self[-1]['batches'].setdefault(func, {}).update(items)
             self[-1]['dirty'] = self[-1]['dirty'] or context['dirty']
+            self[-1]['dirty_tables'] |= context['dirty_tables']
+            self[-1]['results'].update(context['results'])
+            self._trim_results()
         else:
             # transaction
             for func, args, kwargs in context['cbs']:
                 func(*args, **kwargs)
+            for func, items in context['batches'].items():
+                func(list(items.values()))
 
     def rollback(self):
         self.pop()
@@ -35,11 +46,65 @@ class TransactionState(list):
     def push(self, item):
         self[-1]['cbs'].append(item)
 
-    def mark_dirty(self):
-        self[-1]['dirty'] = True
+    def push_batched(self, func, key, item):
+        """
+        Queues an item to be passed to func along with others on commit.
+        Items with the same key are only passed once.
+        """
+        self[-1]['batches'].setdefault(func, {})[key] = item
+
+    def mark_dirty(self, tables=None):
+        """Marks given tables dirty or, if they are unknown, the whole database"""
+        if tables is None:
+            self[-1]['dirty'] = True
+        else:
+            self[-1]['dirty_tables'].update(tables)
+        self.drop_results(tables)
+
+    def is_dirty(self, tables=None):
+        """
+        Checks if any of given tables were changed in this transaction.
+        Without tables checks if anything was changed at all.
+        """
+        for context in self:
+            if context['dirty']:
+                return True
+            if context['dirty_tables']:
+                if tables is None or not context['dirty_tables'].isdisjoint(tables):
+                    return True
+        return False
+
+    # Results cached in memory while dirty, these never leave transaction,
+    # least recently used are dropped to fit CACHEOPS_TRANSACTION_CACHE_MAXSIZE
+    def get_result(self, key):
+        for context in reversed(self):
+            if key in context['results']:
+                context['results'].move_to_end(key)
+                return context['results'][key][1]
+        raise KeyError(key)
+
+    def set_result(self, key, tables, data):
+        results = self[-1]['results']
+        results.pop(key, None)
+        results[key] = (set(tables), data)
+        self._trim_results()
+
+    def _trim_results(self):
+        results = self[-1]['results']
+        while len(results) > settings.CACHEOPS_TRANSACTION_CACHE_MAXSIZE:
+            results.popitem(last=False)
+
+    def drop_results(self, tables=None):
+        """Drops results dependent on any of given tables, all of them if tables are unknown"""
+        for context in self:
+            if tables is None:
+                context['results'].clear()
+            else:
+                context['results'] = OrderedDict(
+                    (key, (result_tables, data))
+                    for key, (result_tables, data) in context['results'].items()
+                    if result_tables.isdisjoint(tables))
 
-    def is_dirty(self):
-        return any(context['dirty'] for context in self)
 
 class TransactionStates(threading.local):
     def __init__(self):
@@ -49,8 +114,8 @@ class TransactionStates(threading.local):
     def __getitem__(self, key):
         return self._states[key or DEFAULT_DB_ALIAS]
 
-    def is_dirty(self, dbs):
-        return any(self[db].is_dirty() for db in dbs)
+    def is_dirty(self, dbs, tables=None):
+        return any(self[db].is_dirty(tables) for db in dbs)
 
 transaction_states = TransactionStates()
 
@@ -97,26 +162,30 @@ class CursorWrapperMixin(object):
     def execute(self, sql, params=None):
         result = self._no_monkey.execute(self, sql, params)
         if transaction_states[self.db.alias] and is_sql_dirty(sql):
-            transaction_states[self.db.alias].mark_dirty()
+            transaction_states[self.db.alias].mark_dirty(sql_dirty_tables(sql))
         return result
 
     def executemany(self, sql, param_list):
         result = self._no_monkey.executemany(self, sql, param_list)
         if transaction_states[self.db.alias] and is_sql_dirty(sql):
-            transaction_states[self.db.alias].mark_dirty()
+            transaction_states[self.db.alias].mark_dirty(sql_dirty_tables(sql))
         return result
 
 
 CHARS = set('abcdefghijklmnoprqstuvwxyz_')
 
-def is_sql_dirty(sql):
+def _sql_str(sql):
     # This should not happen as using bytes in Python 3 is against db protocol,
     # but some people will pass it anyway
     if isinstance(sql, bytes):
-        sql = sql.decode()
+        return sql.decode()
     # Handle psycopg2/psycopg3 sql.Composed/sql.SQL objects (see #377)
     elif not isinstance(sql, str):
-        sql = str(sql)
+        return str(sql)
+    return sql
+
+def is_sql_dirty(sql):
+    sql = _sql_str(sql)
     # NOTE: not using regex here for speed
     sql = sql.lower()
     for action in ('update', 'insert', 'delete'):
@@ -130,6 +199,36 @@ def is_sql_dirty(sql):
         return False
 
 
+WRITE_RE = re.compile(
+    r'\s*(?:insert\s+(?:or\s+\w+\s+)?into|(?:update|delete\s+from)(?:\s+only)?)\s+'
+    r'("[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)\s*([.,])?',
+    re.I)
+
+def sql_dirty_tables(sql):
+    """
+    Returns a set of tables written by a dirty statement
+    or None if it's off or these can't be determined.
+    """
+    if not settings.CACHEOPS_DIRTY_BY_TABLE:
+        return None
+    sql = _sql_str(sql)
+    # Only handle single INSERT/UPDATE/DELETE statements on unqualified tables,
+    # anything else like CTEs, multi-table updates or several statements is left to caller.
+    match = WRITE_RE.match(sql)
+    if not match or match.group(2) or ';' in sql.rstrip().rstrip(';'):
+        return None
+    table = match.group(1)
+    if table[0] in '"`[':
+        return {table[1:-1]}
+    # Unquoted names are case insensitive or folded, so we look for tables they could mean
+    return set(_tables_by_lower().get(table.lower(), ())) or None
+
+@memoize
+def _tables_by_lower():
+    tables = {model._meta.db_table for model in apps.get_models(include_auto_created=True)}
+    return group_by(str.lower, tables)
+
+
 @once
 def install_cacheops_transaction_support():
     monkey_mix(Atomic, AtomicMixIn)
@@ -1,5 +1,7 @@
+from collections import namedtuple
+from functools import lru_cache
 from itertools import product
-from funcy import group_by, join_with, lcat, lmap, cat
+from funcy import group_by, join_with, lcat, lmap, cat, distinct, ldistinct
 
 from django.db.models import Subquery
 from django.db.models.query import QuerySet
@@ -7,11 +9,16 @@ from django.db.models.sql import OR
 from django.db.models.sql.datastructures import Join
 from django.db.models.sql.query import Query, ExtraWhere
 from django.db.models.sql.where import NothingNode
-from django.db.models.lookups import Lookup, Exact, In, IsNull
+from django.db.models.lookups import Lookup, Exact, In, IsNull, Range
+from django.db.models.lookups import GreaterThan, GreaterThanOrEqual, LessThan, LessThanOrEqual
 from django.db.models.expressions import BaseExpression, Exists
 
 from .conf import settings
-from .invalidation import serializable_fields
+from .invalidation import serializable_fields, bucket_sizes, bucket_attname, bucket
+from .schemes import PARTITION_SUFFIX, partition
+
+# Number of query shapes to keep DNF templates for
+DNFS_CACHE_SIZE = 1000
 
 # This existed prior to Django 5.2
 try:
@@ -29,6 +36,124 @@ def dnfs(qs):
     Any negations, conditions with lookups other than __exact or __in,
     conditions on joined models and subrequests are ignored.
     __in is converted into = or = or = ...
+
+    DNFs are calculated once per query shape with placeholders for values,
+    which are substituted on each call.
+    """
+    params = []
+    queries = qs.query.combined_queries or (qs.query,)
+    shape = (
+        tuple(query_shape(q, params) for q in queries),
+        # Add any subqueries used for annotation
+        tuple(query_shape(getattr(q, 'query', q), params)
+              for q in qs.query.annotations.values() if isinstance(q, (Subquery, Query))),
+    )
+    query_templates, sub_templates = dnfs_template(shape)
+
+    dnfs_ = join_with(lcat, (substitute(t, params) for t in query_templates))
+    if sub_templates:
+        dnfs_.update(join_with(lcat, (substitute(t, params) for t in sub_templates)))
+    return dnfs_
+
+
+### Query shapes
+
+def query_shape(query, params):
+    """
+    Returns a hashable structure describing everything DNF depends on except values,
+    these are appended to params and referred by index.
+    """
+    joins = tuple(
+        (alias, join.table_name, join.parent_alias, tuple(join.join_cols))
+        if isinstance(join, Join) else (alias, join.table_name, None, ())
+        for alias, join in query.alias_map.items() if query.alias_refcount[alias]
+    )
+    return query.model._meta.db_table, joins, where_shape(query.where, params)
+
+
+def where_shape(where, params):
+    if isinstance(where, Lookup):
+        # If where.lhs don't refer to a field then don't bother
+        if not hasattr(where.lhs, 'target'):
+            return SOME_SHAPE
+        # Don't bother with complex right hand side either
+        if isinstance(where.rhs, (QuerySet, Query, BaseExpression)):
+            return SOME_SHAPE
+        # Skip conditions on non-serialized fields
+        if where.lhs.target not in serializable_fields(where.lhs.target.model):
+            return SOME_SHAPE
+
+        attname = where.lhs.target.attname
+        if isinstance(where, Exact):
+            params.append(where.rhs)
+            return ('exact', where.lhs.alias, attname, len(params) - 1)
+        elif isinstance(where, IsNull):
+            return ('isnull', where.lhs.alias, attname, bool(where.rhs))
+        elif isinstance(where, In) and len(where.rhs) < settings.CACHEOPS_LONG_DISJUNCTION:
+            start = len(params)
+            params.extend(distinct(where.rhs))
+            return ('in', where.lhs.alias, attname, start, len(params))
+        elif isinstance(where, In) and settings.CACHEOPS_LONG_DISJUNCTION_PARTITIONS:
+            return partitions_shape(where, params)
+        elif isinstance(where, BOUND_LOOKUPS) and bucket_sizes(where.lhs.target.model):
+            return bound_shape(where, params)
+        else:
+            return SOME_SHAPE
+    elif isinstance(where, NothingNode):
+        return ('nothing',)
+    elif isinstance(where, (ExtraWhere, SubqueryConstraint, Exists)):
+        return SOME_SHAPE
+    elif len(where) == 0:
+        return ('empty',)
+    else:
+        children = tuple(where_shape(child, params) for child in where.children)
+        return ('node', where.connector, where.negated, children)
+
+SOME_SHAPE = ('some',)
+
+def partitions_shape(where, params):
+    """Long __in lookups are converted to shorter ones on partitions of values"""
+    partitions = sorted({partition(v) for v in where.rhs})
+    # Touching all partitions means any change will invalidate anyway,
+    # and more than CACHEOPS_MAX_CONJS conjs would be collapsed into an unconditional one
+    if len(partitions) >= settings.CACHEOPS_LONG_DISJUNCTION_PARTITIONS \
+            or len(partitions) > settings.CACHEOPS_MAX_CONJS:
+        return SOME_SHAPE
+    start = len(params)
+    params.extend(partitions)
+    attname = where.lhs.target.attname + PARTITION_SUFFIX
+    return ('in', where.lhs.alias, attname, start, len(params))
+
+BOUND_LOOKUPS = (GreaterThan, GreaterThanOrEqual, LessThan, LessThanOrEqual, Range)
+
+def bound_shape(where, params):
+    """Range lookups on bucketed fields are converted to lower and upper bounds"""
+    field = where.lhs.target
+    size = bucket_sizes(field.model).get(field)
+    values = where.rhs if isinstance(where, Range) else [where.rhs]
+    if not size or any(v is None or isinstance(v, BaseExpression) for v in values):
+        return SOME_SHAPE
+
+    start = len(params)
+    params.extend(values)
+    if isinstance(where, Range):
+        return ('range', where.lhs.alias, bucket_attname(field), size, start)
+    side = 'lower' if isinstance(where, (GreaterThan, GreaterThanOrEqual)) else 'upper'
+    return ('bound', where.lhs.alias, bucket_attname(field), size, start, side)
+
+
+### DNF templates
+
+@lru_cache(maxsize=DNFS_CACHE_SIZE)
+def dnfs_template(shape):
+    query_shapes, sub_shapes = shape
+    return lmap(query_template, query_shapes), lmap(query_template, sub_shapes)
+
+
+def query_template(shape):
+    """
+    Returns a dict table -> list of conjs, each a tuple of (attname, value) pairs,
+    where values are Param or Bound placeholders or literal None.
     """
     SOME = Some()
     SOME_TREE = {frozenset({(None, None, SOME, True)})}
@@ -38,41 +163,39 @@ def dnfs(qs):
 
     def _dnf(where):
         """
-        Constructs DNF of where tree consisting of terms in form:
+        Constructs DNF of where shape consisting of terms in form:
             (alias, attribute, value, negation)
         meaning `alias.attribute = value`
          or `not alias.attribute = value` if negation is False
 
         Any conditions other then eq are dropped.
         """
-        if isinstance(where, Lookup):
-            # If where.lhs don't refer to a field then don't bother
-            if not hasattr(where.lhs, 'target'):
-                return SOME_TREE
-            # Don't bother with complex right hand side either
-            if isinstance(where.rhs, (QuerySet, Query, BaseExpression)):
-                return SOME_TREE
-            # Skip conditions on non-serialized fields
-            if where.lhs.target not in serializable_fields(where.lhs.target.model):
-                return SOME_TREE
-
-            attname = where.lhs.target.attname
-            if isinstance(where, Exact):
-                return {frozenset({(where.lhs.alias, attname, where.rhs, True)})}
-            elif isinstance(where, IsNull):
-                return {frozenset({(where.lhs.alias, attname, None, where.rhs)})}
-            elif isinstance(where, In) and len(where.rhs) < settings.CACHEOPS_LONG_DISJUNCTION:
-                return {frozenset({(where.lhs.alias, attname, v, True)}) for v in where.rhs}
-            else:
-                return SOME_TREE
-        elif isinstance(where, NothingNode):
-            return set()
-        elif isinstance(where, (ExtraWhere, SubqueryConstraint, Exists)):
+        kind = where[0]
+        if kind == 'exact':
+            _, alias, attname, index = where
+            return {frozenset({(alias, attname, Param(index), True)})}
+        elif kind == 'isnull':
+            _, alias, attname, isnull = where
+            return {frozenset({(alias, attname, None, isnull)})}
+        elif kind == 'in':
+            _, alias, attname, start, end = where
+            return {frozenset({(alias, attname, Param(i), True)}) for i in range(start, end)}
+        elif kind == 'bound':
+            _, alias, attname, size, index, side = where
+            return {frozenset({(alias, attname, Bound(side, index, size), True)})}
+        elif kind == 'range':
+            _, alias, attname, size, index = where
+            return {frozenset({(alias, attname, Bound('lower', index, size), True),
+                               (alias, attname, Bound('upper', index + 1, size), True)})}
+        elif kind == 'some':
             return SOME_TREE
-        elif len(where) == 0:
+        elif kind == 'nothing':
+            return set()
+        elif kind == 'empty':
             return {frozenset()}
         else:
-            children_dnfs = lmap(_dnf, where.children)
+            _, connector, negated, children = where
+            children_dnfs = lmap(_dnf, children)
 
             if len(children_dnfs) == 0:
                 return {frozenset()}
@@ -80,50 +203,40 @@ def dnfs(qs):
                 result = children_dnfs[0]
             else:
                 # Just unite children joined with OR
-                if where.connector == OR:
+                if connector == OR:
                     result = set(cat(children_dnfs))
                 # Use Cartesian product to AND children
                 else:
                     result = {frozenset(cat(conjs)) for conjs in product(*children_dnfs)}
 
             # Negating and expanding brackets
-            if where.negated:
+            if negated:
                 result = {frozenset(map(negate, conjs)) for conjs in product(*result)}
 
             return result
 
     def clean_conj(conj, for_alias):
-        conds = {}
-        for alias, attname, value, negation in conj:
-            # "SOME" conds, negated conds and conds for other aliases should be stripped
-            if value is not SOME and negation and alias == for_alias:
-                # Conjs with fields eq 2 different values will never cause invalidation
-                if attname in conds and conds[attname] != value:
-                    return None
-                conds[attname] = value
-        return conds
+        # "SOME" conds, negated conds and conds for other aliases should be stripped
+        return tuple((attname, value) for alias, attname, value, negation in conj
+                     if value is not SOME and negation and alias == for_alias)
 
     def clean_dnf(tree, aliases):
         cleaned = [clean_conj(conj, alias) for conj in tree for alias in aliases]
-        # Remove deleted conjunctions
-        cleaned = [conj for conj in cleaned if conj is not None]
-        # Any empty conjunction eats up the rest
-        # NOTE: a more elaborate DNF reduction is not really needed,
-        #       just keep your querysets sane.
+        # Any empty conjunction eats up the rest,
+        # the rest of the reduction depends on values, see reduce_dnf()
         if not all(cleaned):
-            return [{}]
+            return [()]
         return cleaned
 
-    def add_join_conds(dnf, query):
+    def add_join_conds(dnf, joins):
         from collections import defaultdict
 
         # A cond on parent (alias, col) means the same cond applies to target and vice a versa
         join_exts = defaultdict(list)
-        for alias, join in query.alias_map.items():
-            if query.alias_refcount[alias] and isinstance(join, Join):
-                for parent_col, target_col in join.join_cols:
-                    join_exts[join.parent_alias, parent_col].append((join.table_alias, target_col))
-                    join_exts[join.table_alias, target_col].append((join.parent_alias, parent_col))
+        for alias, _, parent_alias, join_cols in joins:
+            for parent_col, target_col in join_cols:
+                join_exts[parent_alias, parent_col].append((alias, target_col))
+                join_exts[alias, target_col].append((parent_alias, parent_col))
 
         if not join_exts:
             return dnf
@@ -137,39 +250,106 @@ def dnfs(qs):
             for conj in dnf
         }
 
-    def query_dnf(query):
-        def table_for(alias):
-            return alias if alias == main_alias else query.alias_map[alias].table_name
+    main_alias, joins, where = shape
 
-        dnf = _dnf(query.where)
-        dnf = add_join_conds(dnf, query)
+    def table_for(alias):
+        return alias if alias == main_alias else table_names[alias]
 
-        # NOTE: we exclude content_type as it never changes and will hold dead invalidation info
-        main_alias = query.model._meta.db_table
-        aliases = {alias for alias, join in query.alias_map.items()
-                   if query.alias_refcount[alias]} \
-                | {main_alias} - {'django_content_type'}
-        tables = group_by(table_for, aliases)
-        return {table: clean_dnf(dnf, table_aliases) for table, table_aliases in tables.items()}
+    dnf = _dnf(where)
+    dnf = add_join_conds(dnf, joins)
+
+    # NOTE: we exclude content_type as it never changes and will hold dead invalidation info
+    table_names = {alias: table_name for alias, table_name, _, _ in joins}
+    aliases = set(table_names) | {main_alias} - {'django_content_type'}
+    tables = group_by(table_for, aliases)
+    return {table: clean_dnf(dnf, table_aliases) for table, table_aliases in tables.items()}
 
-    if qs.query.combined_queries:
-        dnfs_ = join_with(lcat, (query_dnf(q) for q in qs.query.combined_queries))
-    else:
-        dnfs_ = query_dnf(qs.query)
-
-    # Add any subqueries used for annotation
-    if qs.query.annotations:
-        sub_dnfs = []
-        for q in qs.query.annotations.values():
-            if isinstance(q, Subquery):
-                sub_dnfs.append(query_dnf(getattr(q, 'query', None)))
-            elif isinstance(q, Query):
-                sub_dnfs.append(query_dnf(q))
-        dnfs_.update(join_with(lcat, sub_dnfs) or {})
 
+def substitute(template, params):
+    """Puts values into a DNF template, dropping conjs that will never cause invalidation"""
+    dnfs_ = {}
+    for table, conjs in template.items():
+        cleaned = []
+        for conj in conjs:
+            conds, bounds = {}, {}
+            for attname, value in conj:
+                if isinstance(value, Bound):
+                    bounds.setdefault(attname, []).append(value)
+                    continue
+                if isinstance(value, Param):
+                    value = params[value.index]
+                # Conjs with fields eq 2 different values will never cause invalidation
+                if attname in conds and conds[attname] != value:
+                    break
+                conds[attname] = value
+            else:
+                cleaned.extend(expand_bounds(conds, bounds, params) if bounds else [conds])
+        dnfs_[table] = reduce_dnf(distinct_conjs(cleaned))
     return dnfs_
 
 
+def distinct_conjs(conjs):
+    """Same values in different params make equal conjs, only one of them is needed"""
+    try:
+        return ldistinct(conjs, key=lambda conj: frozenset(conj.items()))
+    except TypeError:
+        # Some unhashable values, compare them then
+        return [conj for i, conj in enumerate(conjs) if conj not in conjs[:i]]
+
+
+def reduce_dnf(conjs):
+    """
+    Drops duplicate conjs and ones including others, these won't invalidate anything new.
+    Too many conjs are collapsed into one with conds common to all of them.
+    """
+    if len(conjs) <= 1:
+        return conjs
+    try:
+        conjs = sorted({frozenset(conj.items()) for conj in conjs}, key=len)
+    except TypeError:
+        # Some unhashable values, leave it as is
+        return conjs
+
+    # Any empty conjunction eats up the rest
+    reduced = []
+    for conj in conjs:
+        if not any(other <= conj for other in reduced):
+            reduced.append(conj)
+    if len(reduced) > settings.CACHEOPS_MAX_CONJS:
+        reduced = [frozenset.intersection(*reduced)]
+    return sorted(map(dict, reduced), key=lambda conj: repr(sorted(conj.items())))
+
+
+def expand_bounds(conds, bounds, params):
+    """
+    Converts closed ranges into eq conds on buckets, producing a conj for each combination.
+    Ranges spanning too many buckets are not restricting as well as open ones.
+    """
+    buckets = {}
+    for attname, attname_bounds in bounds.items():
+        lowers = [params[b.index] for b in attname_bounds if b.side == 'lower']
+        uppers = [params[b.index] for b in attname_bounds if b.side == 'upper']
+        if not lowers or not uppers:
+            continue
+        lower, upper = max(lowers), min(uppers)
+        # Empty range, such conj will never cause invalidation
+        if lower > upper:
+            return []
+        size = attname_bounds[0].size
+        attname_buckets = range(bucket(lower, size), bucket(upper, size) + 1)
+        if len(attname_buckets) < settings.CACHEOPS_LONG_DISJUNCTION:
+            buckets[attname] = attname_buckets
+
+    return [dict(conds, **dict(zip(buckets, values))) for values in product(*buckets.values())]
+
+
+class Param(namedtuple('Param', 'index')):
+    pass
+
+class Bound(namedtuple('Bound', 'side index size')):
+    pass
+
+
 class Some:
     def __str__(self):
         return 'SOME'
@@ -103,6 +103,9 @@ def cached_view_fab(_cached):
 
     def cached_view(*dargs, **dkwargs):
         def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                return async_decorator(func)
+
             cached_func = _cached(*dargs, **dkwargs)(compose(force_render, func))
 
             @wraps(func)
@@ -119,6 +122,27 @@ def cached_view_fab(_cached):
                 wrapper.key = cached_func.key
 
             return wrapper
+
+        def async_decorator(func):
+            @wraps(func)
+            async def render(*args, **kwargs):
+                return force_render(await func(*args, **kwargs))
+            cached_func = _cached(*dargs, **dkwargs)(render)
+
+            @wraps(func)
+            async def wrapper(request, *args, **kwargs):
+                assert isinstance(request, HttpRequest),                            \
+                       "A view should be passed with HttpRequest as first argument"
+                if request.method not in ('GET', 'HEAD'):
+                    return await func(request, *args, **kwargs)
+
+                return await cached_func(request, *args, **kwargs)
+
+            if hasattr(cached_func, 'invalidate'):
+                wrapper.invalidate = cached_func.invalidate
+                wrapper.key = cached_func.key
+
+            return wrapper
         return decorator
     return cached_view
 
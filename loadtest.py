@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Mixed read/write load test for cacheops.
+
+Spawns reader and writer processes working on tests models through cached querysets
+and reports throughput, latency percentiles, hit rate, redis CPU usage and stale reads.
+
+Usage:
+    ./loadtest.py [--readers=8] [--writers=2] [--duration=10]
+                  [--reads=get:6,filter:3,count:1] [--writes=update:9,create:1]
+
+Any settings switch understood by tests.settings works here too, e.g.:
+    CACHEOPS_INSIDEOUT=1 ./loadtest.py
+    CACHEOPS_DB=postgresql ./loadtest.py --readers=32 --writers=4
+"""
+import os, time, random, shutil, argparse
+import multiprocessing
+from collections import Counter, defaultdict
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+
+
+def parse_mix(s):
+    mix = {}
+    for part in s.split(','):
+        name, _, weight = part.partition(':')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument('--readers', type=int, default=8, help='number of reader processes')
+parser.add_argument('--writers', type=int, default=2, help='number of writer processes')
+parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+parser.add_argument('--reads', type=parse_mix, default='get:6,filter:3,count:1,related:1',
+                    help='weighted mix of read ops')
+parser.add_argument('--writes', type=parse_mix, default='update:9,create:1',
+                    help='weighted mix of write ops')
+parser.add_argument('--write-pause', type=float, default=0.01,
+                    help='seconds a writer sleeps between writes')
+parser.add_argument('--categories', type=int, default=20)
+parser.add_argument('--posts', type=int, default=1000)
+parser.add_argument('--stale-check', type=float, default=0.1,
+                    help='share of gets to verify against the database')
+options = parser.parse_args()
+
+
+import django
+from django.db import connection, connections
+from django.db.transaction import atomic
+from django.core.management import call_command
+
+django.setup()
+
+
+### Operations
+
+def read_get(state):
+    pk = random.choice(state['post_pks'])
+    if random.random() >= options.stale_check:
+        Post.objects.cache().get(pk=pk)
+        return
+
+    # Posts titles are version numbers, which writers only increase.
+    # A cached version older than one already committed to db is a stale read.
+    committed = int(Post.objects.nocache().get(pk=pk).title)
+    cached = int(Post.objects.cache().get(pk=pk).title)
+    state['stale_checks'] += 1
+    if cached < committed:
+        state['stale'] += 1
+
+def read_filter(state):
+    list(Post.objects.cache().filter(category=random.choice(state['category_pks'])))
+
+def read_count(state):
+    Post.objects.cache().filter(visible=True).count()
+
+def read_related(state):
+    list(Extra.objects.cache().filter(post__category=random.choice(state['category_pks'])))
+
+def write_update(state):
+    pk = random.choice(state['post_pks'])
+    with atomic():
+        post = Post.objects.select_for_update().get(pk=pk)
+        post.title = str(int(post.title) + 1)
+        post.visible = not post.visible
+        post.save()
+
+def write_create(state):
+    Post.objects.create(title='0', category_id=random.choice(state['category_pks']))
+
+READS = {'get': read_get, 'filter': read_filter, 'count': read_count, 'related': read_related}
+WRITES = {'update': write_update, 'create': write_create}
+
+
+### Workers
+
+def worker(kind, mix, deadline, results):
+    from cacheops.signals import cache_read
+
+    ops = {'reader': READS, 'writer': WRITES}[kind]
+    names, weights = zip(*mix.items())
+    state = {
+        'category_pks': list(Category.objects.values_list('pk', flat=True)),
+        'post_pks': list(Post.objects.values_list('pk', flat=True)),
+        'stale': 0, 'stale_checks': 0,
+    }
+    reads = Counter()
+    cache_read.connect(lambda hit, **kw: reads.update([hit]), weak=False)
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    while time.time() < deadline:
+        name = random.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            ops[name](state)
+        except Exception as e:
+            errors['%s: %s' % (name, e.__class__.__name__)] += 1
+        else:
+            latencies[name].append(time.perf_counter() - start)
+        if kind == 'writer' and options.write_pause:
+            time.sleep(options.write_pause)
+
+    connections.close_all()
+    results.put({
+        'latencies': dict(latencies), 'errors': errors,
+        'hits': reads[True], 'misses': reads[False],
+        'stale': state['stale'], 'stale_checks': state['stale_checks'],
+    })
+
+
+def run(redis_client):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    deadline = time.time() + options.duration
+    # Child processes should not share parent db connection
+    connections.close_all()
+
+    cpu_before = redis_cpu(redis_client)
+    start = time.time()
+    procs = [ctx.Process(target=worker, args=('reader', options.reads, deadline, results))
+             for _ in range(options.readers)]
+    procs += [ctx.Process(target=worker, args=('writer', options.writes, deadline, results))
+              for _ in range(options.writers)]
+    for p in procs:
+        p.start()
+    stats = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    elapsed = time.time() - start
+    cpu_used = redis_cpu(redis_client) - cpu_before
+
+    report(stats, elapsed, cpu_used)
+
+
+def redis_cpu(redis_client):
+    info = redis_client.info('cpu')
+    return info['used_cpu_sys'] + info['used_cpu_user']
+
+
+### Reporting
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def report(stats, elapsed, cpu_used):
+    latencies = defaultdict(list)
+    errors = Counter()
+    for s in stats:
+        for name, values in s['latencies'].items():
+            latencies[name].extend(values)
+        errors.update(s['errors'])
+
+    print('%-10s %10s %10s %10s %10s' % ('op', 'count', 'ops/s', 'p50, ms', 'p99, ms'))
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        print('%-10s %10d %10.1f %10.3f %10.3f' % (
+            name, len(values), len(values) / elapsed,
+            percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000))
+
+    total = sum(map(len, latencies.values()))
+    hits = sum(s['hits'] for s in stats)
+    reads = hits + sum(s['misses'] for s in stats)
+    stale = sum(s['stale'] for s in stats)
+    stale_checks = sum(s['stale_checks'] for s in stats)
+    print()
+    print('throughput: %.1f ops/s' % (total / elapsed))
+    print('hit rate:   %.1f%% of %d cache reads' % (100. * hits / reads if reads else 0, reads))
+    print('redis cpu:  %.2fs (%.1f%% of a core)' % (cpu_used, 100 * cpu_used / elapsed))
+    print('stale:      %d of %d checked gets' % (stale, stale_checks))
+    for error, count in errors.most_common():
+        print('error:      %s x %d' % (error, count))
+
+
+### Setup
+
+def populate():
+    categories = Category.objects.bulk_create(
+        Category(title='Category %d' % i) for i in range(options.categories))
+    posts = Post.objects.bulk_create(
+        Post(title='0', category=random.choice(categories)) for _ in range(options.posts))
+    # NOTE: bulk_create() doesn't set pks in some backends, so we refetch posts
+    posts = Post.objects.all()[:options.posts // 2]
+    Extra.objects.bulk_create(Extra(post=post, tag=post.pk) for post in posts)
+
+
+db_name = None
+try:
+    if connection.vendor == 'sqlite':
+        # Worker processes need a shared on-disk database
+        connection.settings_dict['TEST']['NAME'] = 'loadtest.sqlite3'
+        connection.settings_dict['OPTIONS'] = {'timeout': 30}
+        # Take write lock upfront, otherwise concurrent writers fail instead of waiting
+        if django.VERSION >= (5, 1):
+            connection.settings_dict['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+    shutil.rmtree('tests/migrations', True)
+    call_command('makemigrations', 'tests', verbosity=0)
+    db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    from cacheops.redis import redis_client
+    from tests.models import Category, Post, Extra
+    populate()
+    redis_client.flushdb()
+
+    print('%d readers, %d writers for %ss, reads %s, writes %s\n' % (
+        options.readers, options.writers, options.duration, options.reads, options.writes))
+    run(redis_client)
+except KeyboardInterrupt:
+    pass
+finally:
+    if db_name:
+        connection.creation.destroy_test_db(db_name, verbosity=0)
+    shutil.rmtree('tests/migrations', True)
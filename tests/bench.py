@@ -1,7 +1,7 @@
 from cacheops import invalidate_obj, invalidate_model
 from cacheops.conf import settings
 from cacheops.redis import redis_client
-from cacheops.tree import dnfs
+from cacheops.tree import dnfs, dnfs_template
 
 from .models import Category, Post, Extra
 
@@ -124,6 +124,24 @@ def do_complex_dnfs():
     dnfs(complex_qs)
 
 
+### DNFs of the same shape with different values
+
+dnfs_qss = [
+    Post.objects.filter(category=i, title='Hi %d' % i).exclude(visible=False)
+                .filter(Q(id__in=[i, i + 1]) | Q(category__title='Title %d' % i))
+    for i in range(10)
+]
+
+def do_dnfs():
+    for qs in dnfs_qss:
+        dnfs(qs)
+
+def do_dnfs_miss():
+    dnfs_template.cache_clear()
+    for qs in dnfs_qss:
+        dnfs(qs)
+
+
 ### More invalidation
 
 def prepare_cache():
@@ -158,6 +176,22 @@ def do_invalidate_model(obj):
     invalidate_model(obj.__class__)
 
 
+### File cache
+
+import tempfile
+from cacheops.simple import FileCache
+
+file_cache = FileCache(tempfile.mkdtemp(prefix='cacheops_bench_'))
+# A multi-MB report-like value
+report = [{'id': i, 'title': 'Row %d' % i, 'values': list(range(20))} for i in range(20000)]
+
+def do_file_cache_set_large():
+    file_cache.set('report', report)
+
+def do_file_cache_get_large():
+    file_cache.get('report')
+
+
 TESTS = [
     ('pickle', {'run': do_pickle}),
     ('unpickle', {'run': do_unpickle}),
@@ -193,6 +227,13 @@ TESTS = [
     ('complex_cache_key', {'run': do_complex_cache_key}),
     ('complex_dnfs', {'run': do_complex_dnfs}),
 
+    ('dnfs', {'prepare_once': do_dnfs, 'run': do_dnfs}),
+    ('dnfs_miss', {'run': do_dnfs_miss}),
+
     ('big_invalidate', {'prepare': prepare_cache, 'run': do_invalidate_obj}),
     ('model_invalidate', {'prepare': prepare_cache, 'run': do_invalidate_model}),
+
+    ('file_cache_set_large', {'run': do_file_cache_set_large}),
+    ('file_cache_get_large', {'prepare_once': do_file_cache_set_large,
+                              'run': do_file_cache_get_large}),
 ]
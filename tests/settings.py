@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 
 INSTALLED_APPS = [
     'cacheops',
@@ -102,12 +103,16 @@ CACHEOPS_REDIS = {
     'socket_timeout': 3,
 }
 CACHEOPS_DEFAULTS = {
-    'timeout': 60*60
+    'timeout': 60*60,
+    'snapshot_on_load': bool(os.environ.get('CACHEOPS_SNAPSHOT_ON_LOAD')),
 }
 CACHEOPS = {
     'tests.local': {'local_get': True},
     'tests.cacheonsavemodel': {'cache_on_save': True},
     'tests.dbbinded': {'db_agnostic': False},
+    'tests.profile': {'buckets': {'tag': 10}},
+    'tests.weird': {'buckets': {'date_field': timedelta(days=7),
+                                'datetime_field': timedelta(hours=1)}},
     'tests.*': {},
     'tests.noncachedvideoproxy': None,
     'tests.noncachedmedia': None,
@@ -119,6 +124,8 @@ if os.environ.get('CACHEOPS_PREFIX'):
     CACHEOPS_PREFIX = lambda q: 'p:'
 
 CACHEOPS_INSIDEOUT = bool(os.environ.get('CACHEOPS_INSIDEOUT'))
+CACHEOPS_GENERATIONS = bool(os.environ.get('CACHEOPS_GENERATIONS'))
+CACHEOPS_SORTED_CONJS = bool(os.environ.get('CACHEOPS_SORTED_CONJS'))
 CACHEOPS_DEGRADE_ON_FAILURE = bool(os.environ.get('CACHEOPS_DEGRADE_ON_FAILURE'))
 ALLOWED_HOSTS = ['testserver']
 
@@ -1,8 +1,12 @@
+import time
+
 from django.db import transaction
 from django.test import TestCase, override_settings
 
 from cacheops import cached_as, no_invalidation, invalidate_obj, invalidate_model, invalidate_all
+from cacheops import local
 from cacheops.conf import settings
+from cacheops.redis import redis_client
 from cacheops.signals import cache_read, cache_invalidated
 
 from .utils import BaseTestCase, make_inc
@@ -89,14 +93,18 @@ class SignalsTests(BaseTestCase):
 class LockingTests(BaseTestCase):
     def test_lock(self):
         import random
-        import threading
-        from .utils import ThreadWithReturnValue
-        from before_after import before
 
         @cached_as(Post, lock=True, timeout=60)
         def func():
             return random.random()
 
+        self._test_lock(func, 'redis.Redis.brpoplpush')
+
+    def _test_lock(self, func, block_on):
+        import threading
+        from .utils import ThreadWithReturnValue
+        from before_after import before
+
         results = []
         locked = threading.Event()
         thread = [None]
@@ -104,7 +112,7 @@ class LockingTests(BaseTestCase):
         def second_thread():
             def _target():
                 try:
-                    with before('redis.Redis.brpoplpush', lambda *a, **kw: locked.set()):
+                    with before(block_on, lambda *a, **kw: locked.set()):
                         results.append(func())
                 except Exception:
                     locked.set()
@@ -121,6 +129,26 @@ class LockingTests(BaseTestCase):
 
         self.assertEqual(results[0], results[1])
 
+    def test_cached_lock(self):
+        import random
+        from cacheops import cached
+
+        @cached(lock=True, timeout=60)
+        def func():
+            return random.random()
+
+        self._test_lock(func, 'redis.Redis.brpoplpush')
+
+    def test_file_cache_lock(self):
+        import random
+        import tempfile
+        from cacheops.simple import FileCache
+
+        @FileCache(tempfile.mkdtemp()).cached(lock=True, timeout=60)
+        def func():
+            return random.random()
+
+        self._test_lock(func, 'fcntl.flock')
 
 class NoInvalidationTests(BaseTestCase):
     fixtures = ['basic']
@@ -165,9 +193,42 @@ class LocalGetTests(BaseTestCase):
         Local.objects.create(pk=1)
         super(LocalGetTests, self).setUp()
 
+        # Local cache is only used once we listen to invalidation messages
+        deadline = time.time() + 5
+        while not local.cache.active() and time.time() < deadline:
+            time.sleep(0.01)
+
     def test_unhashable_args(self):
         Local.objects.cache().get(pk__in=[1, 2])
 
+    def test_cached(self):
+        Local.objects.cache().get(pk=1)
+        with self.assertNumQueries(0):
+            Local.objects.cache().get(pk=1)
+
+    def test_invalidated(self):
+        obj = Local.objects.cache().get(pk=1)
+        obj.tag = 5
+        obj.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Local.objects.cache().get(pk=1).tag, 5)
+
+    def test_invalidated_by_other_process(self):
+        Local.objects.cache().get(pk=1)
+        self.assertEqual(len(local.cache._data), 1)
+        redis_client.publish(local.cache.channel, Local._meta.db_table)
+        deadline = time.time() + 5
+        while local.cache._data and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(local.cache._data), 0)
+
+    @override_settings(CACHEOPS_LOCAL_GET_MAXSIZE=1)
+    def test_maxsize(self):
+        Local.objects.create(pk=2)
+        Local.objects.cache().get(pk=1)
+        Local.objects.cache().get(pk=2)
+        self.assertEqual(len(local.cache._data), 1)
+
 
 class DbAgnosticTests(BaseTestCase):
     databases = ('default', 'slave')
@@ -1,5 +1,7 @@
+import time
 import pytest
 
+from cacheops.conf import settings
 from cacheops.redis import redis_client
 
 from .models import User
@@ -20,3 +22,286 @@ def test_ttl(base):
     list(qs)
     assert 90 <= redis_client.ttl(qs._cache_key()) <= 100
     assert redis_client.ttl(f'{qs._prefix}conj:auth_user:id={user.id}') > 100
+
+
+@pytest.mark.skipif(settings.CACHEOPS_GENERATIONS, reason="conj keys are left to expire")
+def test_invalidate_model_uses_index(base):
+    from unittest.mock import patch
+    from cacheops import invalidate_model
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    list(qs)
+    conj_key = f'{qs._prefix}conj:auth_user:id={user.id}'
+    index_key = f'{qs._prefix}conjs:auth_user'
+    assert redis_client.sismember(index_key, conj_key)
+
+    with patch.object(redis_client, 'keys', side_effect=AssertionError('KEYS called')):
+        invalidate_model(User)
+    assert not redis_client.exists(conj_key)
+    assert not redis_client.sismember(index_key, conj_key)
+
+
+@pytest.mark.skipif(settings.CACHEOPS_GENERATIONS, reason="conj keys are left to expire")
+def test_invalidate_model_scan(base):
+    from cacheops import invalidate_model
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    list(qs)
+    # Emulate a conj key written before indexing
+    redis_client.delete(f'{qs._prefix}conjs:auth_user')
+
+    invalidate_model(User)
+    assert redis_client.exists(f'{qs._prefix}conj:auth_user:id={user.id}')
+
+    invalidate_model(User, scan=True)
+    assert not redis_client.exists(f'{qs._prefix}conj:auth_user:id={user.id}')
+
+
+@pytest.mark.skipif(not settings.CACHEOPS_GENERATIONS, reason="needs CACHEOPS_GENERATIONS")
+def test_generations(base, django_assert_num_queries):
+    from cacheops import invalidate_model, invalidate_all
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    list(qs)
+    redis_client.set('unrelated', 1)
+
+    invalidate_model(User)
+    assert redis_client.exists(f'{qs._prefix}conj:auth_user:id={user.id}')
+    with django_assert_num_queries(1):
+        list(qs.all())
+    with django_assert_num_queries(0):
+        list(qs.all())
+
+    invalidate_all()
+    assert redis_client.exists('unrelated')
+    with django_assert_num_queries(1):
+        list(qs.all())
+
+
+@pytest.mark.skipif(not settings.CACHEOPS_GENERATIONS, reason="needs CACHEOPS_GENERATIONS")
+def test_generations_unknown_prefix(base):
+    from django.test import override_settings
+    from cacheops import invalidate_all
+
+    redis_client.set('unrelated', 1)
+    # Can't tell all the prefixes stamps are stored under
+    with override_settings(CACHEOPS_PREFIX=lambda q: 'p%d:' % len(q._cond_dnfs)):
+        invalidate_all()
+    assert not redis_client.exists('unrelated')
+
+
+@pytest.mark.skipif(settings.CACHEOPS_INSIDEOUT or settings.CACHEOPS_SORTED_CONJS,
+                    reason="no conj sets to reap")
+def test_reap_conjs(base):
+    from cacheops import reap_conjs
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    expired_qs = User.objects.cache().filter(pk=user.pk).values('username')
+    list(qs)
+    list(expired_qs)
+    redis_client.delete(expired_qs._cache_key())
+    conj_key = f'{qs._prefix}conj:auth_user:id={user.id}'
+
+    stats = reap_conjs(min_conj_set_size=0, dry_run=True)
+    assert stats['removed'] >= 1
+    assert redis_client.scard(conj_key) == 2
+
+    stats = reap_conjs(chunk_size=1, min_conj_set_size=0, workers=2, max_ops=10000)
+    assert stats['removed'] >= 1
+    assert redis_client.smembers(conj_key) == {qs._cache_key().encode()}
+    assert not redis_client.exists(f'{qs._prefix}reaper')
+
+
+@pytest.mark.skipif(settings.CACHEOPS_INSIDEOUT or settings.CACHEOPS_SORTED_CONJS,
+                    reason="no conj sets to reap")
+def test_reap_conjs_resume(base):
+    from unittest.mock import patch
+    from cacheops import reap_conjs
+    from cacheops.redis import load_script
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    list(qs)
+    conj_key = f'{qs._prefix}conj:auth_user:id={user.id}'
+    redis_client.sadd(conj_key, *('expired%d' % i for i in range(300)))
+    state_key = f'{qs._prefix}reaper'
+
+    # Interrupt after the first batch
+    reap_conj = load_script('reap_conj')
+    def interrupting(**kwargs):
+        reap_conj(**kwargs)
+        raise KeyboardInterrupt
+    with patch('cacheops.reaper.load_script', return_value=interrupting):
+        with pytest.raises(KeyboardInterrupt):
+            reap_conjs(chunk_size=10, min_conj_set_size=0)
+    assert int(redis_client.hget(state_key, conj_key)) > 0
+    assert redis_client.scard(conj_key) < 301
+
+    reap_conjs(chunk_size=10, min_conj_set_size=0, workers=2)
+    assert not redis_client.exists(state_key)
+    assert redis_client.smembers(conj_key) == {qs._cache_key().encode()}
+
+
+def test_reap_conjs_index(base):
+    from cacheops import reap_conjs
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    list(qs)
+    conj_key = f'{qs._prefix}conj:auth_user:id={user.id}'
+    index_key = f'{qs._prefix}conjs:auth_user'
+    # Emulate an expired conj key
+    redis_client.delete(conj_key)
+    assert redis_client.sismember(index_key, conj_key)
+
+    stats = reap_conjs(min_conj_set_size=0)
+    assert stats['index_removed'] == 1
+    assert not redis_client.sismember(index_key, conj_key)
+
+
+@pytest.mark.skipif(settings.CACHEOPS_INSIDEOUT, reason="no conj sets to sample")
+def test_keyspace_stats(base):
+    import json
+    from io import StringIO
+    from django.core.management import call_command
+    from cacheops import keyspace_stats
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    expired_qs = User.objects.cache().filter(pk=user.pk).values('username')
+    list(qs)
+    list(expired_qs)
+    redis_client.delete(expired_qs._cache_key())
+    conj_key = f'{qs._prefix}conj:auth_user:id={user.id}'
+
+    stats = keyspace_stats(max_ops=10000)
+    assert stats['types']['q']['keys'] == 1
+    assert stats['types']['conj']['bytes'] > 0
+    table_stats = stats['tables']['auth_user']
+    assert table_stats['schemes'] == 1
+    assert table_stats['top_conjs'] == [[conj_key, 2]]
+    if not settings.CACHEOPS_SORTED_CONJS:
+        # Sorted conj members are only dead when they are past their expiry time
+        assert table_stats['dead_ratio'] == 0.5
+
+    assert keyspace_stats(limit=1)['keys'] == 1
+
+    out = StringIO()
+    call_command('cacheops_stats', '--json', stdout=out)
+    assert json.loads(out.getvalue())['tables']['auth_user']['top_conjs'] == [[conj_key, 2]]
+    out = StringIO()
+    call_command('cacheops_stats', stdout=out)
+    assert conj_key in out.getvalue()
+
+
+@pytest.mark.skipif(not settings.CACHEOPS_SORTED_CONJS or settings.CACHEOPS_INSIDEOUT,
+                    reason="needs CACHEOPS_SORTED_CONJS")
+def test_sorted_conjs(base):
+    from cacheops import invalidate_obj
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(pk=user.pk)
+    conj_key = f'{qs._prefix}conj:auth_user:id={user.id}'
+    redis_client.zadd(conj_key, {'expired': 1, 'live': 2**40})
+    redis_client.set('live', 1)
+
+    list(qs)
+    # Expired cache keys are trimmed on write
+    assert set(redis_client.zrange(conj_key, 0, -1)) == {b'live', qs._cache_key().encode()}
+    ttl = redis_client.ttl(qs._cache_key())
+    assert abs(redis_client.zscore(conj_key, qs._cache_key()) - time.time() - ttl) <= 2
+
+    invalidate_obj(user)
+    assert not redis_client.exists(conj_key, qs._cache_key(), 'live')
+
+
+def test_legacy_unsorted_scheme(base, django_assert_num_queries):
+    from cacheops.schemes import registry
+
+    user = User.objects.create(username='Suor')
+    qs = User.objects.cache().filter(username='Suor', is_active=True)
+    # Older versions added schemes with fields in any order
+    redis_client.sadd(f'{qs._prefix}schemes:auth_user', 'username,is_active')
+    redis_client.set(f'{qs._prefix}schemes_version:auth_user', 'legacy')
+    registry.clear()
+
+    list(qs)
+    user.save()
+    with django_assert_num_queries(1):
+        list(qs)
+
+
+def test_save_invalidates_at_once(base, django_assert_num_queries):
+    from unittest.mock import patch
+    from cacheops import invalidation
+
+    user = User.objects.create(username='Suor')
+    list(User.objects.cache().filter(username='Suor'))
+    with patch.object(invalidation, 'load_script', wraps=invalidation.load_script) as load_script:
+        user.username = 'Other'
+        user.save()
+    assert load_script.call_count == 1
+
+    with django_assert_num_queries(1):
+        assert list(User.objects.cache().filter(username='Suor')) == []
+
+
+def test_schemes_registry(base, django_assert_num_queries):
+    from unittest.mock import patch
+    from cacheops import invalidate_obj
+    from cacheops.schemes import registry
+
+    user = User.objects.create(username='Suor')
+    list(User.objects.cache().filter(pk=user.pk))
+    invalidate_obj(user)
+    # Now that schemes are known we neither fetch nor write them
+    with patch.object(registry, 'refresh', side_effect=AssertionError('refetched')):
+        list(User.objects.cache().filter(pk=user.pk))
+        invalidate_obj(user)
+
+    # Emulate another process adding a new scheme behind our back
+    stale = dict(registry._data)
+    list(User.objects.cache().filter(username='Suor'))
+    registry._data = stale
+    invalidate_obj(user)
+    with django_assert_num_queries(1):
+        list(User.objects.cache().filter(username='Suor'))
+
+
+def test_dnfs_template_reused():
+    from django.db.models import Q
+    from cacheops.tree import dnfs, dnfs_template
+
+    dnfs(User.objects.filter(Q(pk__in=[1, 2]) | Q(username='a')).filter(is_active=True))
+    hits = dnfs_template.cache_info().hits
+    dnfs_ = dnfs(User.objects.filter(Q(pk__in=[3, 4, 3]) | Q(username='b')).filter(is_active=False))
+    assert dnfs_template.cache_info().hits == hits + 1
+    assert len(dnfs_['auth_user']) == 3
+    assert {frozenset(conj.items()) for conj in dnfs_['auth_user']} == {
+        frozenset({'id': 3, 'is_active': False}.items()),
+        frozenset({'id': 4, 'is_active': False}.items()),
+        frozenset({'is_active': False, 'username': 'b'}.items()),
+    }
+    # Conflicting values are only known after substitution
+    assert dnfs(User.objects.filter(pk=1).filter(pk=2)) == {'auth_user': []}
+    assert dnfs(User.objects.filter(pk=1).filter(pk=1)) == {'auth_user': [{'id': 1}]}
+    assert dnfs(User.objects.filter(Q(pk=1) | Q(pk=1))) == {'auth_user': [{'id': 1}]}
+
+
+def test_dnfs_reduced():
+    from django.db.models import Q
+    from django.test import override_settings
+    from cacheops.tree import dnfs
+
+    qs = User.objects.filter(Q(pk=1) | Q(pk=1, username='a') | Q(pk=2) | Q(pk=2))
+    assert dnfs(qs) == {'auth_user': [{'id': 1}, {'id': 2}]}
+
+    qs = User.objects.filter(Q(pk=1, is_active=True) | Q(pk=2, is_active=True)
+                             | Q(pk=3, is_active=True))
+    assert len(dnfs(qs)['auth_user']) == 3
+    with override_settings(CACHEOPS_MAX_CONJS=2):
+        assert dnfs(qs) == {'auth_user': [{'is_active': True}]}
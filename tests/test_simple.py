@@ -1,3 +1,4 @@
+import asyncio
 from unittest.mock import patch
 
 from django.test import override_settings
@@ -8,7 +9,7 @@ from cacheops import cached, cached_view
 from cacheops.simple import RedisCache
 from cacheops.redis import redis_client
 
-from .utils import make_inc
+from .utils import make_inc, make_ainc
 
 
 def test_cached():
@@ -65,3 +66,523 @@ def test_degrade_get():
 
         assert get_calls(1) == 1
         assert get_calls(1) == 2  # Should miss cache and execute func again
+
+
+def test_file_cache(tmp_path):
+    from cacheops.simple import FileCache, CacheMiss
+
+    cache = FileCache(str(tmp_path))
+    get_calls = make_inc(cache.cached(timeout=100))
+
+    assert get_calls(1) == 1
+    assert get_calls(1) == 1
+    get_calls.invalidate(1)
+    assert get_calls(1) == 2
+
+    # Existing entries are overwritten
+    cache.set('key', 'old')
+    cache.set('key', 'new')
+    assert cache.get('key') == 'new'
+
+    # Nothing is left behind
+    assert not list(tmp_path.glob('*/*.tmp'))
+
+    # Stale entries are removed on read
+    cache = FileCache(str(tmp_path / 'stale'))
+    cache.set('key', 'stale', timeout=-1)
+    with pytest.raises(CacheMiss):
+        cache.get('key')
+    assert not list(tmp_path.glob('stale/*/*'))
+
+
+def test_file_cache_serializer(tmp_path):
+    import json
+    from types import SimpleNamespace
+    from cacheops.simple import FileCache
+
+    serializer = SimpleNamespace(dumps=lambda data: json.dumps(data).encode(), loads=json.loads)
+    with override_settings(CACHEOPS_SERIALIZER=serializer):
+        cache = FileCache(str(tmp_path))
+        cache.set('key', {'a': 1})
+        assert cache.get('key') == {'a': 1}
+
+
+def test_file_cache_failed_write(tmp_path):
+    from cacheops.simple import FileCache, CacheMiss
+
+    cache = FileCache(str(tmp_path))
+    cache.set('key', 'old')
+    with patch('cacheops.simple.os.replace', side_effect=OSError):
+        cache.set('key', 'new')
+    assert cache.get('key') == 'old'
+    assert not list(tmp_path.glob('*/*.tmp'))
+
+    # Crashed writes leave temporary files only, never truncated entries
+    with patch('cacheops.simple.os.utime', side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            cache.set('other', 'new')
+    with pytest.raises(CacheMiss):
+        cache.get('other')
+
+
+def test_file_cache_eviction(tmp_path):
+    import os
+    from cacheops.simple import FileCache, CacheMiss
+    from cacheops.sharding import get_prefix
+
+    cache = FileCache(str(tmp_path), max_entries=10)
+    for i in range(10):
+        cache.set('key%d' % i, i)
+    # Make key0 the most recently used one
+    filename = cache._key_to_filename(get_prefix() + 'key0')
+    os.utime(filename, (os.stat(filename).st_atime + 100, os.stat(filename).st_mtime))
+
+    cache.set('key10', 10)
+    assert len(list(tmp_path.glob('*/*'))) < 10
+    assert cache.get('key0') == 0
+    assert cache.get('key10') == 10
+
+    # Overwrites don't count as new entries
+    cache = FileCache(str(tmp_path / 'overwrite'), max_entries=2)
+    for _ in range(5):
+        cache.set('key0', 0)
+        cache.set('key1', 1)
+    assert cache.get('key0') == 0
+    assert cache.get('key1') == 1
+
+    cache = FileCache(str(tmp_path / 'size'), max_size=1000)
+    cache.set('big', 'x' * 2000)
+    with pytest.raises(CacheMiss):
+        cache.get('big')
+
+
+def test_file_cache_usage_sampled(tmp_path):
+    from unittest.mock import patch
+    from cacheops.simple import FileCache, USAGE_SAMPLE
+
+    cache = FileCache(str(tmp_path))
+    for i in range(500):
+        cache.set('key%d' % i, i)
+
+    cache = FileCache(str(tmp_path), max_entries=10000)
+    with patch.object(FileCache, '_scan', autospec=True, side_effect=FileCache._scan) as scan:
+        cache.set('key', 1)
+        cache.set('key', 2)
+    assert scan.call_count == USAGE_SAMPLE
+    # Estimate is extrapolated from a sample
+    assert 250 < cache._usage[1] < 1000
+
+
+def test_clean_file_cache(tmp_path):
+    import os
+    import time
+    from io import StringIO
+    from django.core.management import call_command
+    from cacheops.simple import FileCache, CacheMiss
+
+    cache = FileCache(str(tmp_path))
+    for i in range(20):
+        cache.set('key%d' % i, i, timeout=100 if i % 2 else -1)
+    # A temporary file left by a crashed write and one being written
+    stale_tmp = cache._key_to_filename('crashed') + '.1234.tmp'
+    fresh_tmp = cache._key_to_filename('writing') + '.1234.tmp'
+    for filename in (stale_tmp, fresh_tmp):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        open(filename, 'wb').close()
+    os.utime(stale_tmp, (0, time.time() - 3600))
+
+    out = StringIO()
+    call_command('cleanfilecache', str(tmp_path), '--workers=4', stdout=out)
+    assert out.getvalue().startswith('Removed 11 files')
+    assert not os.path.exists(stale_tmp)
+    assert os.path.exists(fresh_tmp)
+    assert cache.get('key1') == 1
+
+    stats = FileCache(str(tmp_path), max_entries=5).clean()
+    assert stats['files'] == 5
+    assert len(list(tmp_path.glob('*/*[!p]'))) == 5
+    with pytest.raises(CacheMiss):
+        cache.get('key0')
+
+
+def test_tiered_cache():
+    import time
+    from cacheops.simple import TieredCache, CacheMiss
+
+    redis_client.flushdb()
+    cache = TieredCache(redis_client)
+    # Local cache is only used once we listen to invalidation messages
+    deadline = time.time() + 5
+    while not cache._local.active() and time.time() < deadline:
+        time.sleep(0.01)
+
+    get_calls = make_inc(cache.cached(timeout=100, local_timeout=10))
+    assert get_calls(1) == 1
+    # Filled values are kept right away, not invalidated and announced as set ones
+    redis_client.flushdb()
+    assert get_calls(1) == 1
+    assert get_calls.key(1).get() == 1
+
+    get_calls.invalidate(1)
+    assert get_calls(1) == 2
+    get_calls.key(1).set(42)
+    assert get_calls(1) == 42
+    get_calls.key(1).delete()
+    with pytest.raises(CacheMiss):
+        get_calls.key(1).get()
+
+    assert get_calls.get_many([(1,), (2,)]) == [3, 4]
+    assert get_calls.get_many([(1,), (2,)]) == [3, 4]
+    redis_client.flushdb()
+    assert get_calls.get_many([(1,), (2,)]) == [3, 4]
+
+
+def test_tiered_cache_set_announced():
+    import time
+    from cacheops.simple import TieredCache
+
+    redis_client.flushdb()
+    cache = TieredCache(redis_client)
+    deadline = time.time() + 5
+    while not cache._local.active() and time.time() < deadline:
+        time.sleep(0.01)
+
+    get_calls = make_inc(cache.cached(timeout=100))
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe(cache._local.channel)
+    try:
+        assert pubsub.get_message(timeout=1)['type'] == 'subscribe'
+        assert get_calls(1) == 1
+        assert pubsub.get_message(timeout=0.1) is None
+        get_calls.key(1).set(42)
+        assert pubsub.get_message(timeout=1)['data'] == get_calls.key(1).encode()
+    finally:
+        pubsub.close()
+
+
+def test_local_cache_stamps():
+    from cacheops.local import LocalCache, VERSION_SLOTS
+
+    cache = LocalCache()
+    # Other table sharing a version counter would prevent storing
+    other = next(t for t in 'bcd' if hash(t) % VERSION_SLOTS != hash('a') % VERSION_SLOTS)
+    stamp = cache.stamp(['a'])
+    cache.invalidate(other)
+    cache.set('key', 1, 10, ['a'], stamp)
+    assert cache.get('key') == 1
+
+    stamp = cache.stamp(['a'])
+    cache.invalidate('a')
+    cache.set('key2', 2, 10, ['a'], stamp)
+    with pytest.raises(KeyError):
+        cache.get('key2')
+
+
+def test_tiered_cache_invalidated_by_other_process():
+    import time
+    from cacheops.simple import TieredCache
+
+    redis_client.flushdb()
+    cache = TieredCache(redis_client)
+    deadline = time.time() + 5
+    while not cache._local.active() and time.time() < deadline:
+        time.sleep(0.01)
+
+    get_calls = make_inc(cache.cached(timeout=100))
+    assert get_calls(1) == 1
+    key = get_calls.key(1)
+    # Another process deletes it
+    redis_client.delete(key)
+    redis_client.publish(cache._local.channel, key)
+    deadline = time.time() + 5
+    while cache._local._data and time.time() < deadline:
+        time.sleep(0.01)
+    assert get_calls(1) == 2
+
+
+def test_tiered_cache_listens_on_own_conn():
+    import time
+    import redis
+    from cacheops.simple import TieredCache
+
+    conn = redis.Redis(**dict(redis_client.connection_pool.connection_kwargs, db=14))
+    conn.flushdb()
+    cache = TieredCache(conn)
+    assert cache._local.channel.endswith(':14')
+    deadline = time.time() + 5
+    while not cache._local.active() and time.time() < deadline:
+        time.sleep(0.01)
+
+    get_calls = make_inc(cache.cached(timeout=100))
+    assert get_calls(1) == 1
+    assert get_calls(1) == 1
+    # Another process deletes it
+    key = get_calls.key(1)
+    conn.delete(key)
+    conn.publish(cache._local.channel, key)
+    while cache._local._data and time.time() < deadline:
+        time.sleep(0.01)
+    assert get_calls(1) == 2
+    conn.flushdb()
+
+
+def test_tiered_cached_view_copies_responses():
+    import time
+    from django.http import HttpResponse
+    from cacheops.simple import TieredCache
+
+    redis_client.flushdb()
+    cache = TieredCache(redis_client)
+    deadline = time.time() + 5
+    while not cache._local.active() and time.time() < deadline:
+        time.sleep(0.01)
+
+    @cache.cached_view(timeout=100)
+    def view(request):
+        return HttpResponse('hi')
+
+    request = RequestFactory().get('/hi')
+    view(request)
+    assert cache._local._data
+
+    response = view(request)
+    response.set_cookie('sessionid', 'userA')
+    next_response = view(request)
+    assert next_response is not response
+    assert 'sessionid' not in next_response.cookies
+
+
+def test_get_many():
+    from cacheops import cache
+
+    redis_client.flushdb()
+    cache.set_many({'a': 1, 'b': None}, timeout=100)
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'b': None}
+    cache.delete_many(['a', 'c'])
+    assert cache.get_many(['a', 'b']) == {'b': None}
+
+
+def test_file_cache_get_many(tmp_path):
+    from cacheops.simple import FileCache
+
+    cache = FileCache(str(tmp_path))
+    cache.set_many({'a': 1, 'b': 2})
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+    cache.delete_many(['a'])
+    assert cache.get_many(['a', 'b']) == {'b': 2}
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_cached_get_many(workers):
+    redis_client.flushdb()
+    calls = []
+
+    @cached(timeout=100)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert double(1) == 2
+    assert double.get_many([(1,), (2,), (3,), (2,)], workers=workers) == [2, 4, 6, 4]
+    assert sorted(calls) == [1, 2, 3]
+    assert double.get_many([(3,), (1,)]) == [6, 2]
+    assert double(2) == 4
+    assert sorted(calls) == [1, 2, 3]
+
+
+def test_get_many_locked():
+    from cacheops import cache
+    from cacheops.sharding import get_prefix
+
+    redis_client.flushdb()
+
+    @cached(timeout=60, lock=True)
+    def double(x):
+        return x * 2
+
+    # Emulate another caller computing a value
+    redis_client.set(double.key(1), 'LOCK')
+    redis_client.set(get_prefix() + 'locked', 'LOCK')
+    assert cache.get_many(['locked']) == {}
+    assert double.get_many([(1,), (2,)]) == [2, 4]
+
+
+def test_cached_lock_own_conn():
+    import redis
+
+    conn = redis.Redis(**dict(redis_client.connection_pool.connection_kwargs, db=14))
+    conn.flushdb()
+    redis_client.flushdb()
+    seen = []
+
+    @RedisCache(conn).cached(timeout=60, lock=True)
+    def func():
+        seen.append((conn.get(func.key()), redis_client.get(func.key())))
+        return 1
+
+    assert func() == 1
+    assert seen == [(b'LOCK', None)]
+    conn.flushdb()
+
+
+def test_cached_stale():
+    from django.core.exceptions import ImproperlyConfigured
+    from cacheops import file_cache
+
+    redis_client.flushdb()
+    calls = [0]
+    stale_results = []
+
+    @cached(timeout=60, stale=60)
+    def func():
+        calls[0] += 1
+        if calls[0] == 2:
+            # Others are served stale data while one caller refreshes it
+            stale_results.append(func())
+        return calls[0]
+
+    assert func() == 1
+    assert func() == 1
+    assert redis_client.ttl(func.key()) > 60
+
+    # Expire
+    redis_client.delete(func.key() + ':fresh')
+    assert func() == 2
+    assert stale_results == [1]
+    assert func() == 2
+
+    # Set by hand values are fresh
+    redis_client.delete(func.key() + ':fresh')
+    func.key().set(42)
+    assert func() == 42
+
+    with pytest.raises(ImproperlyConfigured):
+        file_cache.cached(timeout=60, stale=60)
+
+
+def test_cached_async():
+    redis_client.flushdb()
+    get_calls = make_ainc(cached(timeout=100))
+
+    async def run():
+        assert await get_calls(1) == 1
+        assert await get_calls(1) == 1
+        assert await get_calls(2) == 2
+        get_calls.invalidate(2)
+        assert await get_calls(2) == 3
+        get_calls.key(2).set(42)
+        assert await get_calls(2) == 42
+
+    asyncio.run(run())
+    # Shares cache with sync code
+    assert get_calls.key(1).get() == 1
+
+
+def test_cached_view_async():
+    from django.http import HttpResponse
+
+    redis_client.flushdb()
+    calls = [0]
+
+    @cached_view(timeout=100)
+    async def view(request):
+        calls[0] += 1
+        return HttpResponse(str(calls[0]))
+
+    factory = RequestFactory()
+
+    async def run():
+        assert (await view(factory.get('/hi'))).content == b'1'
+        assert (await view(factory.get('/hi'))).content == b'1'
+        assert (await view(factory.post('/hi'))).content == b'2'
+        assert (await view(factory.get('/bye'))).content == b'3'
+
+    asyncio.run(run())
+    assert asyncio.iscoroutinefunction(view)
+
+
+@pytest.mark.parametrize('stale', [None, 60])
+def test_cached_async_lock(stale):
+    redis_client.flushdb()
+    calls = [0]
+
+    @cached(timeout=60, lock=True, stale=stale)
+    async def func():
+        calls[0] += 1
+        await asyncio.sleep(0.1)
+        return calls[0]
+
+    async def run():
+        return await asyncio.gather(func(), func(), func())
+
+    assert asyncio.run(run()) == [1, 1, 1]
+    assert calls[0] == 1
+
+
+def test_cached_async_no_async_conn():
+    from django.core.exceptions import ImproperlyConfigured
+
+    cache = RedisCache(redis_client)
+    with pytest.raises(ImproperlyConfigured):
+        make_ainc(cache.cached(timeout=60, lock=True))
+    with pytest.raises(ImproperlyConfigured):
+        make_ainc(cache.cached(timeout=60, stale=60))
+    # Sync functions are fine
+    make_inc(cache.cached(timeout=60, lock=True))
+
+
+def test_file_cache_async_lock(tmp_path):
+    from cacheops.simple import FileCache
+
+    cache = FileCache(str(tmp_path))
+    get_calls = make_ainc(cache.cached(timeout=60, lock=True))
+
+    async def run():
+        return await asyncio.gather(get_calls(), get_calls())
+
+    assert asyncio.run(run()) == [1, 1]
+    assert not list(tmp_path.glob('*/*.lock'))
+
+
+def test_cached_async_stale():
+    redis_client.flushdb()
+    calls = [0]
+    stale_results = []
+
+    @cached(timeout=60, stale=60)
+    async def func():
+        calls[0] += 1
+        if calls[0] == 2:
+            stale_results.append(await func())
+        return calls[0]
+
+    async def run():
+        assert await func() == 1
+        redis_client.delete(func.key() + ':fresh')
+        assert await func() == 2
+        assert await func() == 2
+
+    asyncio.run(run())
+    assert stale_results == [1]
+
+
+def test_tiered_cache_async():
+    import time
+    from cacheops.simple import TieredCache
+    from cacheops.redis import async_redis_client
+
+    redis_client.flushdb()
+    cache = TieredCache(redis_client, async_conn=async_redis_client)
+    deadline = time.time() + 5
+    while not cache._local.active() and time.time() < deadline:
+        time.sleep(0.01)
+
+    get_calls = make_ainc(cache.cached(timeout=100))
+
+    async def run():
+        assert await get_calls(1) == 1
+        # Served from local memory
+        redis_client.flushdb()
+        assert await get_calls(1) == 1
+
+    asyncio.run(run())
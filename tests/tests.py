@@ -1,14 +1,17 @@
+import asyncio
 from contextlib import contextmanager
 from functools import reduce
 import operator
 import re
 import platform
+from time import sleep
 import unittest
 from unittest import mock
 
 import django
 from django.db import connection
 from django.db import DEFAULT_DB_ALIAS
+from django.db.transaction import atomic
 from django.test import override_settings
 from django.test.client import RequestFactory
 from django.template import Context, Template
@@ -17,12 +20,14 @@ from django.db.models.expressions import RawSQL
 
 from cacheops import invalidate_model, invalidate_obj, cached, cached_as, cached_view_as
 from cacheops import invalidate_fragment
+from cacheops.conf import settings, model_profile
+from cacheops.invalidator import run_invalidator, invalidator_stats
 from cacheops.query import invalidate_m2o
 from cacheops.templatetags.cacheops import register
 
 decorator_tag = register.decorator_tag
 from .models import *  # noqa
-from .utils import BaseTestCase, make_inc
+from .utils import BaseTestCase, make_inc, make_ainc
 
 
 class BasicTests(BaseTestCase):
@@ -185,6 +190,149 @@ class BasicTests(BaseTestCase):
         Post.objects.cache().filter(category__in=RawSQL("select 1", ())).count()
 
 
+class SnapshotTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(model_profile(Post), snapshot_on_load=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_refetch(self):
+        list(Post.objects.cache().filter(title='Cacheops'))
+        post = Post.objects.get(title='Cacheops')
+        post.title = 'Changed'
+        with self.assertNumQueries(1):
+            post.save()
+
+        # Both old and new values are invalidated
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache().filter(title='Cacheops')), [])
+        with self.assertNumQueries(1):
+            post.title = 'Changed again'
+            post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(title='Changed'))
+
+    def test_deferred(self):
+        post = Post.objects.only('title').get(pk=1)
+        post.title = 'Changed'
+        with self.assertNumQueries(2):
+            post.save()
+
+    def test_update_fields(self):
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        post.visible = False
+        post.save(update_fields=['title'])
+        self.assertEqual(post._cacheops_snapshot['visible'], True)
+
+        list(Post.objects.cache().filter(visible=True))
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(visible=True))
+
+    def test_refresh(self):
+        post = Post.objects.get(pk=1)
+        Post.objects.filter(pk=1).update(title='Changed')
+        post.refresh_from_db(fields=['title'])
+        self.assertEqual(post._cacheops_snapshot['title'], 'Changed')
+
+    def test_dirty_transaction(self):
+        with atomic():
+            Post.objects.filter(pk=1).update(title='Changed')
+            post = Post.objects.get(pk=1)
+        self.assertNotIn('_cacheops_snapshot', post.__dict__)
+
+    def test_not_pickled(self):
+        import pickle
+
+        post = Post.objects.get(pk=1)
+        self.assertIn('_cacheops_snapshot', post.__dict__)
+        self.assertNotIn('_cacheops_snapshot', pickle.loads(pickle.dumps(post)).__dict__)
+        self.assertIn('_cacheops_snapshot', post.__dict__)
+
+        Post.objects.cache().get(pk=1)
+        with self.assertNumQueries(0):
+            post = Post.objects.cache().get(pk=1)
+        self.assertNotIn('_cacheops_snapshot', post.__dict__)
+
+
+class AsyncInvalidationTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(model_profile(Post), async_invalidation=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_applied_by_worker(self):
+        list(Post.objects.cache().filter(title='Cacheops'))
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        post.save()
+
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(title='Cacheops'))
+        self.assertEqual(invalidator_stats()['queued'], 1)
+
+        run_invalidator('test', block=10, once=True)
+        self.assertEqual(invalidator_stats()['queued'], 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache().filter(title='Cacheops')), [])
+
+    @override_settings(CACHEOPS_ASYNC_INVALIDATION_LAG=0)
+    def test_lag_fallback(self):
+        Post.objects.get(pk=1).save()
+        sleep(0.01)
+
+        list(Post.objects.cache().filter(title='Cacheops'))
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        post.save()
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(title='Cacheops'))
+        # Overdue queued invalidation is applied by writer too
+        self.assertEqual(invalidator_stats()['queued'], 0)
+
+    @override_settings(CACHEOPS_ASYNC_INVALIDATION_LAG=0)
+    def test_lag_fallback_drains_queue(self):
+        list(Post.objects.cache().filter(title='Cacheops'))
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        post.save()
+        self.assertEqual(invalidator_stats()['queued'], 1)
+        sleep(0.01)
+
+        # Doesn't touch cached query by itself, but applies the queued invalidation
+        post.save()
+        self.assertEqual(invalidator_stats()['queued'], 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache().filter(title='Cacheops')), [])
+
+    def test_failed_entry(self):
+        import json
+        from cacheops.redis import redis_client
+        from cacheops.sharding import get_prefix
+
+        list(Post.objects.cache().filter(title='Cacheops'))
+        # A model removed since invalidation was queued
+        stream = get_prefix(dbs=[DEFAULT_DB_ALIAS]) + 'invalidations'
+        redis_client.xadd(stream, {'data': json.dumps(
+            {'prefix': get_prefix(dbs=[DEFAULT_DB_ALIAS]), 'dicts': [['tests.Gone', {'id': 1}]]}
+        )})
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        post.save()
+
+        run_invalidator('test', block=10, once=True)
+        self.assertEqual(invalidator_stats()['queued'], 0)
+        self.assertEqual(invalidator_stats()['failed'], 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache().filter(title='Cacheops')), [])
+
 class ValuesTests(BaseTestCase):
     fixtures = ['basic']
 
@@ -283,6 +431,55 @@ class DecoratorTests(BaseTestCase):
         self.assertEqual(get_calls(r2), 1) # hit, since only url is considered
         self.assertEqual(get_calls(r3), 2) # miss
 
+    def test_cached_as_async(self):
+        get_calls = make_ainc(cached_as(Category.objects.filter(title='test')))
+
+        self.assertEqual(asyncio.run(get_calls()), 1)   # cache
+        Category.objects.create(title='miss')           # don't invalidate
+        self.assertEqual(asyncio.run(get_calls()), 1)   # hit
+        Category.objects.create(title='test')           # invalidate
+        self.assertEqual(asyncio.run(get_calls()), 2)   # miss
+
+    def test_cached_as_async_no_sync_calls(self):
+        from cacheops import redis as cacheops_redis
+        get_calls = make_ainc(cached_as(Category.objects.filter(title__isnull=True)))
+
+        # Server specifics are fetched with async client, not blocking event loop
+        with mock.patch.dict(cacheops_redis._server, clear=True), \
+                mock.patch.object(cacheops_redis, 'redis_client', None):
+            self.assertEqual(asyncio.run(get_calls()), 1)
+        self.assertEqual(asyncio.run(get_calls()), 1)
+
+    def test_cached_as_async_keep_fresh(self):
+        c = Category.objects.create(title='test')
+        calls = [0]
+
+        @cached_as(c, keep_fresh=True, lock=True)
+        async def get_calls(_=None, **kw):
+            if calls[0] < 1:
+                invalidate_obj(c)
+            calls[0] += 1
+            return calls[0]
+
+        self.assertEqual(asyncio.run(get_calls()), 1)   # miss, stale result not cached.
+        self.assertEqual(asyncio.run(get_calls()), 2)   # miss and cache
+        self.assertEqual(asyncio.run(get_calls()), 2)   # hit
+
+    def test_cached_view_as_async(self):
+        from django.http import HttpResponse
+        calls = [0]
+
+        @cached_view_as(Category)
+        async def view(request):
+            calls[0] += 1
+            return HttpResponse(str(calls[0]))
+
+        factory = RequestFactory()
+        self.assertEqual(asyncio.run(view(factory.get('/hi'))).content, b'1')  # cache
+        self.assertEqual(asyncio.run(view(factory.get('/hi'))).content, b'1')  # hit
+        Category.objects.create(title='test')                                  # invalidate
+        self.assertEqual(asyncio.run(view(factory.get('/hi'))).content, b'2')  # miss
+
     def test_cached_view_on_template_response(self):
         from django.template.response import TemplateResponse
         from django.template import engines
@@ -296,7 +493,7 @@ class DecoratorTests(BaseTestCase):
         view(factory.get('/hi'))
 
 
-from datetime import date, time
+from datetime import date, time, timedelta
 from django.utils import timezone
 
 class WeirdTests(BaseTestCase):
@@ -342,6 +539,161 @@ class WeirdTests(BaseTestCase):
         list(Weird.customs.cache())
 
 
+class BucketsTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='Suor')
+
+    def test_dnfs(self):
+        from cacheops.tree import dnfs
+
+        self.assertEqual(dnfs(Profile.objects.filter(tag__range=(5, 25))),
+                         {'tests_profile': [{'tag__bucket': 0}, {'tag__bucket': 1},
+                                            {'tag__bucket': 2}]})
+        self.assertEqual(dnfs(Profile.objects.filter(tag__gte=5, tag__lt=15, user=1)),
+                         {'tests_profile': [{'tag__bucket': 0, 'user_id': 1},
+                                            {'tag__bucket': 1, 'user_id': 1}]})
+        # Open, empty and too wide ranges
+        self.assertEqual(dnfs(Profile.objects.filter(tag__gte=5)), {'tests_profile': [{}]})
+        self.assertEqual(dnfs(Profile.objects.filter(tag__gte=5, tag__lt=3)),
+                         {'tests_profile': []})
+        self.assertEqual(dnfs(Profile.objects.filter(tag__range=(0, 1000))),
+                         {'tests_profile': [{}]})
+
+    def test_invalidation(self):
+        profile = Profile.objects.create(user=self.user, tag=55)
+
+        def get_profiles():
+            return list(Profile.objects.cache().filter(tag__gte=0, tag__lt=20))
+        get_profiles()
+
+        profile.tag = 57
+        profile.save()
+        with self.assertNumQueries(0):
+            get_profiles()
+
+        profile.tag = 15
+        profile.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_profiles(), [profile])
+
+    def test_dates(self):
+        now = timezone.now()
+
+        def get_weirds():
+            return list(Weird.objects.cache()
+                             .filter(datetime_field__range=(now, now + timedelta(hours=2))))
+        get_weirds()
+
+        Weird.objects.create(datetime_field=now + timedelta(hours=5))
+        with self.assertNumQueries(0):
+            get_weirds()
+        Weird.objects.create(datetime_field=now + timedelta(hours=1))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(get_weirds()), 1)
+
+
+@override_settings(CACHEOPS_LONG_DISJUNCTION_PARTITIONS=64)
+class LongDisjunctionTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_dnfs(self):
+        from cacheops.schemes import partition
+        from cacheops.tree import dnfs
+
+        ids = list(range(100, 110))
+        conjs = dnfs(Post.objects.filter(pk__in=ids))['tests_post']
+        self.assertEqual(sorted(conj['id__part'] for conj in conjs),
+                         sorted({partition(pk) for pk in ids}))
+        # All partitions touched
+        self.assertEqual(dnfs(Post.objects.filter(pk__in=range(1000))), {'tests_post': [{}]})
+
+    def test_invalidation(self):
+        from cacheops.schemes import partition
+
+        ids = [pk for pk in range(100, 1000) if partition(pk) != partition(1)][:10]
+
+        def get_posts():
+            return list(Post.objects.cache().filter(pk__in=ids + [2]))
+        get_posts()
+
+        Post.objects.get(pk=1).save()
+        with self.assertNumQueries(0):
+            get_posts()
+        Post.objects.get(pk=2).save()
+        with self.assertNumQueries(1):
+            get_posts()
+
+    def test_max_conjs(self):
+        from cacheops.tree import dnfs
+
+        # These would be collapsed anyway
+        self.assertEqual(dnfs(Post.objects.filter(pk__in=range(100, 180))), {'tests_post': [{}]})
+
+    @override_settings(CACHEOPS_LONG_DISJUNCTION_PARTITIONS=1024, CACHEOPS_MAX_CONJS=512)
+    def test_hundreds(self):
+        from cacheops.schemes import partition
+        from cacheops.tree import dnfs
+
+        ids = [pk for pk in range(100, 10000) if partition(pk) != partition(1)][:300]
+        conjs = dnfs(Post.objects.filter(pk__in=ids + [2]))['tests_post']
+        self.assertEqual(len(conjs), len({partition(pk) for pk in ids + [2]}))
+
+        def get_posts():
+            return list(Post.objects.cache().filter(pk__in=ids + [2]))
+        get_posts()
+
+        Post.objects.get(pk=1).save()
+        with self.assertNumQueries(0):
+            get_posts()
+        Post.objects.get(pk=2).save()
+        with self.assertNumQueries(1):
+            get_posts()
+
+
+class ExplainTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_explain_cache(self):
+        from cacheops import explain_cache
+
+        info = explain_cache(Category.objects.filter(pk=1, title='Django'))
+        self.assertEqual(info['dnfs'], {'tests_category': [{'id': 1, 'title': 'Django'}]})
+        self.assertEqual(info['schemes'], {'tests_category': ['id,title']})
+        self.assertEqual(len(info['conj_keys']), 1)
+
+    def test_explain_invalidation(self):
+        from cacheops import explain_invalidation
+
+        list(Category.objects.cache().filter(pk=1))
+        list(Category.objects.cache().filter(pk=2))
+        list(Category.objects.cache().all())
+
+        cat = Category.objects.get(pk=1)
+        info = explain_invalidation(cat)
+        self.assertEqual(info['table'], 'tests_category')
+        self.assertEqual(info, explain_invalidation({'id': 1, 'title': cat.title}, Category))
+        # Unconditional queries depend on a generation stamp instead
+        if settings.CACHEOPS_GENERATIONS and not settings.CACHEOPS_INSIDEOUT:
+            self.assertEqual(info['schemes'], [('id',)])
+        else:
+            self.assertEqual(set(info['schemes']), {('id',), ()})
+        if not settings.CACHEOPS_INSIDEOUT:
+            self.assertEqual(info['cache_keys'], len(info['schemes']))
+            self.assertGreater(info['bytes'], 0)
+            self.assertFalse(info['estimated'])
+
+            # Larger conjs are sampled
+            list(Category.objects.cache().filter(pk__in=[1, 2]))
+            info = explain_invalidation(cat, sample=1)
+            self.assertTrue(info['estimated'])
+            self.assertEqual(info['cache_keys'], len(info['schemes']) + 1)
+
+        # Nothing is invalidated
+        with self.assertNumQueries(0):
+            list(Category.objects.cache().filter(pk=1))
+
+
 @unittest.skipIf(connection.vendor != 'postgresql', "Only for PostgreSQL")
 class PostgresTests(BaseTestCase):
     def test_array_contains(self):
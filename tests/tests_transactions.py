@@ -1,10 +1,12 @@
 import unittest
+from unittest.mock import patch
 
 from django.db import connection, IntegrityError
 from django.db.transaction import atomic
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
 
-from cacheops.transaction import is_sql_dirty, queue_when_in_transaction
+from cacheops import invalidate_obj, invalidate_model
+from cacheops.transaction import is_sql_dirty, sql_dirty_tables, queue_when_in_transaction
 
 from .models import Category, Post
 from .utils import run_in_thread
@@ -98,6 +100,86 @@ class TransactionSupportTests(TransactionTestCase):
             with self.assertNumQueries(1):
                 get_category()
 
+    @override_settings(CACHEOPS_DIRTY_BY_TABLE=True)
+    def test_dirty_by_table(self):
+        with atomic():
+            get_category()
+            Post.objects.filter(pk=1).update(title='Changed')
+            with self.assertNumQueries(0):
+                get_category()
+
+            Category.objects.filter(pk=2).update(title='Changed')
+            with self.assertNumQueries(1):
+                get_category()
+
+    @override_settings(CACHEOPS_TRANSACTION_CACHE=True)
+    def test_transaction_cache(self):
+        def get_categories():
+            return list(Category.objects.cache().filter(pk__in=[1, 2]))
+
+        with atomic():
+            Category.objects.filter(pk=2).update(title='Changed')
+            with self.assertNumQueries(1):
+                get_categories()
+            with self.assertNumQueries(0):
+                self.assertEqual(get_categories()[1].title, 'Changed')
+
+            # Writes drop cached results
+            obj = get_category()
+            obj.title = 'Changed again'
+            obj.save()
+            with self.assertNumQueries(1):
+                self.assertEqual(get_categories()[0].title, 'Changed again')
+
+            try:
+                with atomic():
+                    Post.objects.filter(pk=1).update(title='Changed')
+                    get_categories()
+                    raise IntentionalRollback()
+            except IntentionalRollback:
+                pass
+            with self.assertNumQueries(1):
+                get_categories()
+
+        # Nothing seen in transaction was written to cache
+        self.assertEqual('Changed', run_in_thread(lambda: get_categories()[1].title))
+
+    @override_settings(CACHEOPS_TRANSACTION_CACHE=True, CACHEOPS_TRANSACTION_CACHE_MAXSIZE=2)
+    def test_transaction_cache_maxsize(self):
+        def get(pk):
+            return Category.objects.cache().get(pk=pk)
+
+        with atomic():
+            Post.objects.filter(pk=1).update(title='Changed')
+            get(1)
+            get(2)
+            get(1)
+            get(3)  # Evicts least recently used 2
+            with self.assertNumQueries(0):
+                get(1)
+                get(3)
+            with self.assertNumQueries(1):
+                get(2)
+
+    @override_settings(CACHEOPS_DIRTY_BY_TABLE=True)
+    def test_sql_dirty_tables(self):
+        self.assertEqual(sql_dirty_tables('INSERT INTO "tests_post" ("title") VALUES (%s)'),
+                         {'tests_post'})
+        self.assertEqual(sql_dirty_tables('UPDATE `tests_post` SET `title` = %s'), {'tests_post'})
+        self.assertEqual(sql_dirty_tables('delete from tests_post where id = 1'), {'tests_post'})
+        self.assertEqual(sql_dirty_tables('INSERT OR IGNORE INTO "tests_post" ("title") ...'),
+                         {'tests_post'})
+        self.assertEqual(sql_dirty_tables('UPDATE ONLY "tests_post" SET title = 1'),
+                         {'tests_post'})
+        self.assertEqual(sql_dirty_tables('DELETE FROM ONLY tests_post'), {'tests_post'})
+        self.assertEqual(sql_dirty_tables('UPDATE Tests_Post SET title = 1'), {'tests_post'})
+        # Can't tell
+        self.assertIsNone(sql_dirty_tables('UPDATE "public"."tests_post" SET title = 1'))
+        self.assertIsNone(sql_dirty_tables('UPDATE t1, t2 SET t1.a = t2.a'))
+        self.assertIsNone(sql_dirty_tables('WITH x AS (SELECT 1) DELETE FROM t'))
+        self.assertIsNone(sql_dirty_tables('DELETE FROM t1; DELETE FROM t2'))
+        self.assertIsNone(sql_dirty_tables('DELETE FROM unknown_table'))
+
     def test_rollback_during_integrity_error(self):
         # store category in cache
         get_category()
@@ -128,6 +210,29 @@ class TransactionSupportTests(TransactionTestCase):
 
         self.assertEqual(calls, ['cacheops', 'django'])
 
+    def test_coalesce_invalidations(self):
+        with patch('cacheops.invalidation._invalidate_dicts') as invalidate_dicts, \
+                patch('cacheops.invalidation._invalidate_model') as invalidate_model_:
+            with atomic():
+                obj = get_category()
+                for i in range(3):
+                    obj.title = 'Changed %d' % i
+                    obj.save()
+                with atomic():
+                    invalidate_obj(obj)
+                post = Post.objects.get(pk=1)
+                post.save()
+                invalidate_model(Post)
+
+        # Same objects are only invalidated once, posts are covered by model invalidation
+        invalidate_dicts.assert_called_once()
+        model_dicts, using = invalidate_dicts.call_args[0]
+        self.assertEqual(using, 'default')
+        self.assertEqual({model for model, _ in model_dicts}, {Category})
+        self.assertEqual(sorted(d['title'] for _, d in model_dicts),
+                         ['Changed 0', 'Changed 1', 'Changed 2', 'Django'])
+        invalidate_model_.assert_called_once_with(Post, 'default', False)
+
     @unittest.skipUnless(sql, "psycopg2 not installed")
     def test_is_sql_dirty_with_composed_objects(self):
         """sql.Composed/sql.SQL objects should not crash is_sql_dirty (#377)."""
@@ -1,6 +1,8 @@
 from django.test import TestCase
 
 from cacheops import invalidate_all
+from cacheops.conf import settings
+from cacheops.redis import redis_client
 from cacheops.transaction import transaction_states
 
 
@@ -14,6 +16,9 @@ class BaseTestCase(TestCase):
             = empty(transaction_states._states), transaction_states._states
 
         invalidate_all()
+        # Generations mode doesn't flush, but we still want to start clean
+        if settings.CACHEOPS_GENERATIONS:
+            redis_client.flushdb()
 
     def tearDown(self):
         transaction_states._states = self._states
@@ -31,6 +36,18 @@ def make_inc(deco=lambda x: x):
     return inc
 
 
+def make_ainc(deco=lambda x: x):
+    calls = [0]
+
+    @deco
+    async def inc(_=None, **kw):
+        calls[0] += 1
+        return calls[0]
+
+    inc.get = lambda: calls[0]
+    return inc
+
+
 # Thread utilities
 from threading import Thread
 